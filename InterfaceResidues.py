@@ -1,7 +1,7 @@
 from pymol import cmd, stored
 
 
-def interfaceResidues(cmpx, cA='c. A', cB='c. B', cutoff=1.0, selName="interface"):
+def interfaceResidues(cmpx, cA='c. A', cB='c. B', cutoff=1.0, selName="interface", txtfile='temp/temp.txt', dasafile=None):
 	"""
 	interfaceResidues -- finds 'interface' residues between two chains in a complex.
 	
@@ -25,6 +25,13 @@ def interfaceResidues(cmpx, cA='c. A', cB='c. B', cutoff=1.0, selName="interface
 			
 		selName
 			The name of the selection to return.
+
+		txtfile
+			File the interface residues are written to, one per line.
+
+		dasafile
+			If given, file the interface residues are written to with their
+			dASA summed over all atoms, as residue<TAB>dASA.
 			
 	RETURNS
 		* A selection of interface residues is created and named
@@ -114,10 +121,17 @@ def interfaceResidues(cmpx, cA='c. A', cB='c. B', cutoff=1.0, selName="interface
 	
 	# reset users settings
 	cmd.set("dot_solvent", oldDS)
-	txtfile = 'temp/temp.txt'.format(cmpx)
-	ffile = open(txtfile,'w')
-	for x in ans:
-		ffile.write(x+'\n')
+	with open(txtfile,'w') as ffile:
+		for x in ans:
+			ffile.write(x+'\n')
+	if dasafile is not None:
+		dasa = {}
+		for (model,resi,diff) in stored.r:
+			keyy=resi+"_"+model
+			dasa[keyy] = dasa.get(keyy, 0.0) + abs(diff)
+		with open(dasafile,'w') as ffile:
+			for x in ans:
+				ffile.write('%s\t%.2f\n' % (x, dasa[x]))
 	return rVal,ans
 
 cmd.extend("interfaceResidues", interfaceResidues)
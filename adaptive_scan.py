@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Adaptive saturation scans of large interfaces.
+
+A full scan spends 19 FoldX builds on every interface position, although
+most positions are neutral to every substitution. Here positions are ordered
+by cheap signals, and the scan runs in rounds through pipeline.py:
+
+    prior      the dASA of the position on binding (dasa.txt, written by
+               gen_interface.py) and the number of partner heavy atoms
+               within 6 A of its atoms in the wildtype structure, each
+               scaled to the largest value among the positions
+    probes     every position first gets --probes substitutions (alanine,
+               a charge, a bulky and a backbone-changing residue first);
+               a position whose probes all have |ddG| < --neutral stops
+    follow-up  the remaining substitutions of the other positions, those
+               with the largest |ddG| so far first
+
+The scan ends when every position is done or --budget mutations have been
+predicted. FoldX interfaces and wildtype models are built once and shared
+by all rounds.
+
+--replay replays the scheduler on the output of a finished full scan
+(pipeline.py, triage.py or this script, with pdb, mutation, partners and ddg
+columns), and reports which fraction of the high-|ddG| mutations it finds
+within a range of budgets, without building anything.
+
+Usage:
+    python adaptive_scan.py [pdb file] [partnerA_partnerB] [--positions "KW84 HL112"] [--budget N]
+                            [--probes 3] [--neutral 0.5] [--round-size 64] [pipeline.py options] [-o FILE]
+    python adaptive_scan.py --replay full_scan.csv [--high 1.0] [--probes 3] [--neutral 0.5]
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import os.path as path
+import shutil
+import time
+
+import numpy as np
+
+from run import AA_CODES, AMINO_ACIDS
+
+# order of the substitutions at each position: the probes come first
+PROBE_ORDER = 'ADWPRGKELFYHQNSTVIMC'
+CONTACT_RADIUS = 6.0
+
+
+class Site(object):
+    """One position of the scan and the substitutions still to predict"""
+    def __init__(self, pdbfile, partners, position, prior=0.0):
+        self.pdbfile = pdbfile
+        self.partners = partners
+        self.position = position
+        self.prior = prior
+        self.todo = [position + x for x in PROBE_ORDER if x != position[0]]
+        self.results = {}
+        self.in_flight = 0
+        self.state = 'probing'  # then 'active', 'neutral' or 'failed'
+
+    def effect(self):
+        ddgs = [abs(x) for x in self.results.values() if x is not None]
+        return max(ddgs) if ddgs else 0.0
+
+
+class AdaptiveScheduler(object):
+    def __init__(self, sites, probes=3, neutral=0.5):
+        self.sites = sites
+        self.probes = probes
+        self.neutral = neutral
+
+    def next_batch(self, size):
+        """Up to size (site, mutation) pairs, probes of the highest priors first"""
+        candidates = []
+        for site in self.sites:
+            if not site.todo or site.state in ('neutral', 'failed'):
+                continue
+            if site.state == 'probing':
+                allowed = self.probes - len(site.results) - site.in_flight
+                if allowed > 0:
+                    candidates.append(((0, -site.prior), site, allowed))
+            else:
+                candidates.append(((1, -site.effect(), -site.prior), site, len(site.todo)))
+        batch = []
+        for _, site, allowed in sorted(candidates, key=lambda x: x[0]):
+            for mutation in site.todo[:min(allowed, size - len(batch))]:
+                batch.append((site, mutation))
+            if len(batch) >= size:
+                break
+        for site, mutation in batch:
+            site.todo.remove(mutation)
+            site.in_flight += 1
+        return batch
+
+    def report(self, site, mutation, ddg):
+        site.results[mutation] = ddg
+        site.in_flight -= 1
+        if site.state == 'probing' and len(site.results) >= self.probes and site.in_flight == 0:
+            ddgs = [x for x in site.results.values() if x is not None]
+            if not ddgs:
+                site.state = 'failed'
+            elif max(abs(x) for x in ddgs) < self.neutral:
+                site.state = 'neutral'
+            else:
+                site.state = 'active'
+
+
+def scan(scheduler, evaluate, budget=None, round_size=64, verbose=True):
+    """Predict rounds of next_batch with evaluate([(site, mutation)]) -> ddGs until done; returns the count"""
+    spent, rounds = 0, 0
+    while budget is None or spent < budget:
+        size = round_size if budget is None else min(round_size, budget - spent)
+        batch = scheduler.next_batch(size)
+        if not batch:
+            break
+        for (site, mutation), ddg in zip(batch, evaluate(batch)):
+            scheduler.report(site, mutation, ddg)
+        spent += len(batch)
+        rounds += 1
+        if verbose:
+            states = [site.state for site in scheduler.sites]
+            print('Round {}: {} mutations ({} in total); {} positions probing, {} active, {} neutral'.format(
+                rounds, len(batch), spent, states.count('probing'), states.count('active'), states.count('neutral')))
+    return spent
+
+
+def read_dasa(dasafile):
+    """chain_resid -> dASA (A^2) from gen_interface.py's dasa.txt; empty if the file is missing"""
+    dasa = {}
+    if path.exists(dasafile):
+        with open(dasafile) as f:
+            for line in f:
+                if line.strip():
+                    residue, value = line.split()
+                    key = '_'.join(residue.split('_')[2:])
+                    dasa[key] = max(dasa.get(key, 0.0), float(value))
+    return dasa
+
+
+def close_pairs(coords_a, coords_b, radius, block=100000):
+    """Index pairs (i, j) of the atoms of a and b within radius of each other (cell lists)"""
+    if len(coords_a) == 0 or len(coords_b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    origin = np.minimum(coords_a.min(0), coords_b.min(0))
+    cells_a = np.floor((coords_a - origin) / radius).astype(np.int64) + 1
+    cells_b = np.floor((coords_b - origin) / radius).astype(np.int64) + 1
+    span = np.maximum(cells_a.max(0), cells_b.max(0)) + 2
+    keys_a = (cells_a[:, 0]*span[1] + cells_a[:, 1])*span[2] + cells_a[:, 2]
+    keys_b = (cells_b[:, 0]*span[1] + cells_b[:, 1])*span[2] + cells_b[:, 2]
+    order = np.argsort(keys_b, kind='stable')
+    sorted_b = keys_b[order]
+    found_a, found_b = [], []
+    for start in range(0, len(coords_a), block):
+        atoms = np.arange(start, min(start + block, len(coords_a)))
+        for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+            neighbors = keys_a[atoms] + (dx*span[1] + dy)*span[2] + dz
+            first, last = np.searchsorted(sorted_b, neighbors, 'left'), np.searchsorted(sorted_b, neighbors, 'right')
+            counts = last - first
+            if not counts.any():
+                continue
+            a = np.repeat(atoms, counts)
+            b = order[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            close = ((coords_a[a] - coords_b[b])**2).sum(1) <= radius*radius
+            found_a.append(a[close])
+            found_b.append(b[close])
+    if not found_a:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(found_a), np.concatenate(found_b)
+
+
+def contact_counts(pdbfile, partners, residues, radius=CONTACT_RADIUS):
+    """Heavy atoms of the binding partner within radius of each residue (chain_resid)"""
+    from crop import read_records, residue_key
+    records = [line for line in read_records(pdbfile) if line[0:4] == 'ATOM' and line[76:78].strip() != 'H'
+               and not line[12:16].strip().startswith('H')]
+    counts = dict((residue, 0) for residue in residues)
+    if not records:
+        return counts
+    # residue index of every atom, -1 outside the requested residues
+    index = dict((residue, i) for i, residue in enumerate(counts))
+    owner = np.array([index.get('_'.join(residue_key(line)), -1) for line in records])
+    chains = np.array([line[21] for line in records])
+    coords = np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])] for line in records])
+    sides = partners.split('_')
+    found = np.zeros(len(index), dtype=np.int64)
+    for side in sides:
+        own = np.flatnonzero((owner >= 0) & np.isin(chains, list(side)))
+        other = np.flatnonzero(~np.isin(chains, list(side)) & np.isin(chains, list(''.join(sides))))
+        a, b = close_pairs(coords[own], coords[other], radius)
+        # distinct partner atoms per residue
+        pairs = np.unique(owner[own][a]*len(coords) + b)
+        found += np.bincount(pairs // len(coords), minlength=len(index))
+    for residue, i in index.items():
+        counts[residue] = int(found[i])
+    return counts
+
+
+def priors(signals):
+    """Mean of the signals (dicts of residue -> value), each scaled to its largest value"""
+    residues = set().union(*signals) if signals else set()
+    scaled = []
+    for signal in signals:
+        top = max(signal.values()) if signal else 0.0
+        if top > 0:
+            scaled.append(dict((x, signal.get(x, 0.0)/top) for x in residues))
+    return dict((x, float(np.mean([s[x] for s in scaled])) if scaled else 0.0) for x in residues)
+
+
+def interface_positions(pdbfile, interfacefile):
+    """Positions such as KW84 of the residues in interface.txt, in file order"""
+    names = {}
+    with open(pdbfile) as f:
+        for line in f:
+            if line[0:4] == 'ATOM':
+                names.setdefault('{}_{}'.format(line[21], line[22:28].strip()), AA_CODES.get(line[17:20]))
+    positions = []
+    with open(interfacefile) as f:
+        for line in f:
+            residue = '_'.join(line.strip().split('_')[2:])
+            position = '{}{}{}'.format(names.get(residue), residue[0], residue[2:])
+            if names.get(residue) and position not in positions:
+                positions.append(position)
+    return positions
+
+
+def replay(rows, high, probes, neutral, round_size, fractions=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0)):
+    """Recall of mutations with |ddG| >= high at several budgets, on finished full-scan rows"""
+    table = dict(((pdb, mutation, partners), ddg) for pdb, mutation, partners, ddg in rows)
+    positions = []
+    for pdb, mutation, partners, _ in rows:
+        if (pdb, partners, mutation[:-1]) not in positions:
+            positions.append((pdb, partners, mutation[:-1]))
+    contacts = {}
+    for pdb, partners in set((pdb, partners) for pdb, partners, _ in positions):
+        if path.exists(pdb):
+            residues = ['{}_{}'.format(x[1], x[2:]) for p, q, x in positions if p == pdb and q == partners]
+            contacts[pdb, partners] = contact_counts(pdb, partners, residues)
+
+    targets = set(key for key, ddg in table.items() if ddg is not None and abs(ddg) >= high)
+    total = sum(1 for pdb, partners, position in positions for x in AMINO_ACIDS
+                if x != position[0] and (pdb, position + x, partners) in table)
+    print('{} positions, {} mutations, {} with |ddG| >= {}'.format(len(positions), total, len(targets), high))
+    print('{:>8s} {:>10s} {:>8s}'.format('budget', 'mutations', 'recall'))
+    report = []
+    for fraction in fractions:
+        sites = []
+        for pdb, partners, position in positions:
+            prior = contacts.get((pdb, partners), {}).get('{}_{}'.format(position[1], position[2:]), 0)
+            sites.append(Site(pdb, partners, position, prior))
+        scheduler = AdaptiveScheduler(sites, probes, neutral)
+        evaluate = lambda batch: [table.get((site.pdbfile, mutation, site.partners)) for site, mutation in batch]
+        spent = scan(scheduler, evaluate, int(round(fraction*total)), round_size, verbose=False)
+        found = set((site.pdbfile, mutation, site.partners) for site in sites for mutation in site.results)
+        recall = len(found & targets)/float(len(targets)) if targets else None
+        report.append((fraction, spent, recall))
+        print('{:>7.0f}% {:>10d} {:>8s}'.format(100*fraction, spent, 'n/a' if recall is None else '{:.3f}'.format(recall)))
+    return report
+
+
+def read_rows(csvfile):
+    with open(csvfile, newline='') as f:
+        rows = []
+        for row in csv.DictReader(f):
+            try:
+                ddg = float(row['ddg'])
+            except ValueError:
+                ddg = None
+            rows.append((row['pdb'], row['mutation'], row['partners'], ddg))
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Saturation scan that prioritizes positions and stops neutral ones early')
+    parser.add_argument('pdbfile', nargs='?')
+    parser.add_argument('partners', nargs='?', help='Binding partners, e.g. WV_HL')
+    parser.add_argument('--positions', help='Positions such as "KW84 HL112" (default: every interface residue)')
+    parser.add_argument('--budget', type=int, help='Predict at most this many mutations')
+    parser.add_argument('--probes', type=int, default=3, help='Substitutions tried at a position before it may stop')
+    parser.add_argument('--neutral', type=float, default=0.5, help='A position stops if all probes have |ddG| below this')
+    parser.add_argument('--round-size', type=int, default=64)
+    parser.add_argument('--replay', metavar='CSV', help='Simulate on the output of a full scan instead')
+    parser.add_argument('--high', type=float, default=1.0, help='|ddG| of the mutations --replay should find')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--crop', type=float, metavar='SHELL')
+    parser.add_argument('--graph-store', metavar='DIR')
+    parser.add_argument('--feature-store', metavar='DIR')
+    parser.add_argument('--cache', metavar='FILE', help='Prediction cache (default: $GEOPPI_CACHE)')
+    parser.add_argument('--scratch', default='adaptive_tmp')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(read_rows(args.replay), args.high, args.probes, args.neutral, args.round_size)
+        return
+    if not args.partners:
+        parser.error('give [pdb file] [partners] or --replay')
+
+    from pipeline import Job, StructureBuilder, run_pipeline
+    from run import load_models
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    model, forest, sorted_idx = load_models(precision=precision)
+    features = None
+    if args.feature_store:
+        from feature_store import FeatureStore, encoder_id
+        features = FeatureStore(args.feature_store, encoder_id(precision=precision))
+    from prediction_cache import open_cache
+    cache = open_cache(args.cache, precision, crop=args.crop)
+    builder = StructureBuilder(args.scratch, args.crop)
+    structdir, _ = builder.structure(args.pdbfile, args.partners)
+
+    positions = args.positions.split() if args.positions else \
+        interface_positions(args.pdbfile, path.join(structdir, 'interface.txt'))
+    residues = ['{}_{}'.format(x[1], x[2:]) for x in positions]
+    dasa = read_dasa(path.join(structdir, 'dasa.txt'))
+    prior = priors([x for x in (dasa, contact_counts(args.pdbfile, args.partners, residues)) if x])
+    sites = [Site(args.pdbfile, args.partners, x, prior.get(residue, 0.0)) for x, residue in zip(positions, residues)]
+    print('{} positions ({} mutations for a full scan); dASA {}available'.format(
+        len(sites), sum(len(site.todo) for site in sites), '' if dasa else 'not '))
+
+    results = []
+    def evaluate(batch):
+        jobs = [Job(len(results) + i, site.pdbfile, mutation, site.partners) for i, (site, mutation) in enumerate(batch)]
+        done, _, _ = run_pipeline(jobs, model, forest, sorted_idx, args.foldx_workers, args.feature_workers,
+                                  args.batch_size, crop=args.crop, graph_store=args.graph_store, features=features,
+                                  scratch=args.scratch, keep_builds=args.keep, keep_scratch=True, verbose=False,
+                                  builder=builder, cache=cache)
+        results.extend(done)
+        return [job.ddg if job.error is None else None for job in done]
+
+    start = time.time()
+    spent = scan(AdaptiveScheduler(sites, args.probes, args.neutral), evaluate, args.budget, args.round_size)
+    wall = time.time() - start
+    if not args.keep:
+        shutil.rmtree(args.scratch, ignore_errors=True)
+
+    output = args.output or path.basename(args.pdbfile).split('.')[0] + '_adaptive_ddg.csv'
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pdb', 'mutation', 'partners', 'ddg', 'error'])
+        for job in results:
+            writer.writerow([job.pdbfile, job.mutation, job.partners,
+                             job.ddg if job.error is None else 'error', job.error or ''])
+    states = [site.state for site in sites]
+    print('\n{} of {} mutations predicted in {:.1f} s; {} positions stopped as neutral, {} failed'.format(
+        spent, spent + sum(len(site.todo) for site in sites), wall, states.count('neutral'), states.count('failed')))
+    if cache is not None:
+        print(cache.summary())
+    print('Results written to {}'.format(output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Accuracy and speed of cropped FoldX builds (crop.py) against full builds.
+
+Every single mutation of a benchmark set is predicted once with the full
+complex and once per crop shell. For each shell the report gives the
+deviation from the full-build ddG, the Pearson correlation of both with the
+experimental ddG, and the mean structure-building time.
+
+Usage:
+    python benchmarks/crop_accuracy.py --pdb-dir PDBS [--dataset data/benchmarkDatasets/S1131.csv]
+                                       [--shells 14 20 26] [--limit 100] [-o crop_accuracy.json]
+
+    # run from the GeoPPI directory; needs FoldX, PyMOL and the benchmark structures
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pearson(x, y):
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(x) < 3 or x.std() == 0 or y.std() == 0:
+        return None
+    return float(np.corrcoef(x, y)[0, 1])
+
+
+def predict(entry, model, forest, sorted_idx, plan, crop):
+    """Returns (ddg, seconds spent building and featurizing)"""
+    from models import GeoPPIpredict
+    from run import prepare_sample
+    start = time.time()
+    A, E, A_m, E_m, flag = prepare_sample(entry.pdbfile, entry.mutations[0], entry.partners, crop=crop)
+    seconds = time.time() - start
+    return GeoPPIpredict(A, E, A_m, E_m, model, forest, sorted_idx, flag, plan), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare cropped and full FoldX builds on a benchmark set')
+    parser.add_argument('--dataset', default='data/benchmarkDatasets/S1131.csv')
+    parser.add_argument('--pdb-dir', required=True, help='Directory with the benchmark structures ({pdb}.pdb)')
+    parser.add_argument('--shells', nargs='+', type=float, default=[14.0, 20.0, 26.0])
+    parser.add_argument('--limit', type=int, help='Evaluate at most this many mutations')
+    parser.add_argument('-o', '--output', help='Also write the report as JSON')
+    args = parser.parse_args()
+
+    from datasets import read_benchmark
+    from models import FeaturePlan, n_selected
+    from run import load_models
+
+    entries = [x for x in read_benchmark(args.dataset, args.pdb_dir) if x.pdbfile is not None]
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print('Error: no structures of {} found in {}'.format(args.dataset, args.pdb_dir))
+        sys.exit(1)
+    model, forest, sorted_idx = load_models()
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+
+    settings = [None] + args.shells
+    rows = []
+    for i, entry in enumerate(entries):
+        row = {'pdb': entry.pdb, 'mutation': entry.mutations[0], 'experimental': entry.ddg}
+        try:
+            for crop in settings:
+                row[str(crop)] = predict(entry, model, forest, sorted_idx, plan, crop)
+        except Exception as e:
+            print('  skipping {} {}: {}'.format(entry.pdb, entry.mutations[0], e))
+            continue
+        rows.append(row)
+        print('[{}/{}] {} {}: '.format(i + 1, len(entries), entry.pdb, entry.mutations[0]) +
+              ', '.join('{} {:.2f} ({:.0f} s)'.format('full' if crop is None else '{:g} A'.format(crop), *row[str(crop)])
+                        for crop in settings))
+
+    if not rows:
+        print('Error: no mutation could be built')
+        sys.exit(1)
+    experimental = [row['experimental'] for row in rows]
+    full = np.array([row['None'][0] for row in rows])
+    full_time = np.mean([row['None'][1] for row in rows])
+    report = {'dataset': args.dataset, 'mutations': len(rows), 'settings': {}}
+
+    print('\n{:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s}'.format(
+        'shell', 'mean|dev|', 'max|dev|', 'r(exp)', 'seconds', 'speedup'))
+    for crop in settings:
+        ddg = np.array([row[str(crop)][0] for row in rows])
+        seconds = np.mean([row[str(crop)][1] for row in rows])
+        deviation = np.abs(ddg - full)
+        r = pearson(ddg, experimental) if None not in experimental else None
+        label = 'full' if crop is None else '{:g}'.format(crop)
+        report['settings'][label] = {
+            'mean_abs_dev': float(deviation.mean()),
+            'max_abs_dev': float(deviation.max()),
+            'pearson_experimental': r,
+            'seconds_per_mutation': float(seconds),
+            'speedup': float(full_time/seconds),
+        }
+        print('{:>8s} {:>10.3f} {:>10.3f} {:>10s} {:>10.1f} {:>7.2f}x'.format(
+            label, deviation.mean(), deviation.max(), 'n/a' if r is None else '{:.3f}'.format(r),
+            seconds, full_time/seconds))
+
+    if args.output:
+        report['rows'] = rows
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Report written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
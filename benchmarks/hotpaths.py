@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the hot paths on the bundled structures.
+
+Each case is a structure with a mutation and its binding partners: the test
+examples of data/testExamples and 41D1/41D1_forGeoPPI.pdb. For every case
+the suite times
+
+    read_inter_result    parsing interface.txt
+    build_graph          the wildtype graph from the PDB lines
+    cgat_forward         the first (CGAT) layer of the eager encoder
+    encoder_step         the four graph layers of one graph (model.embed)
+    gen_features         both graphs and the pooled 18x256 features
+    gbt_predict          the GBT head on the selected features
+    predict              gen_features and GBT together (GeoPPIpredict)
+    interface_detection  gen_interface.py (PyMOL), when pymol is installed
+
+FoldX is not run. The wildtype and mutant models and interface.txt of each
+case come from benchmarks/fixtures/<case>/, which --build-fixtures fills once
+with FoldX and PyMOL (run from the GeoPPI directory). --build-fixtures --ideal
+builds them without either: the input structure is the wildtype, the mutant
+gets its new side chain in ideal geometry (ideal_mutant.py) and the interface
+is every residue with a heavy atom within 5 A of another chain of the
+partners. fixture.json in each directory says how it was built. The committed
+fixtures are ideal ones, not the graphs FoldX builds would give, so the
+numerical baseline in baseline.json only holds for them. Without fixtures the
+input structure stands in for both models; the JSON records which source each
+case used.
+
+Every benchmark is run once to warm up, then --repeat times, each time in a
+loop of as many calls as fill --min-time. The output JSON has the min,
+median, mean and standard deviation of the seconds per call, the peak
+resident memory above the level before the benchmark (Linux) and graph
+sizes. For numerical checks (benchmarks/regression_gate.py), build_graph
+also records a sha256 of the wildtype graph, gen_features the rounded
+features the GBT reads, and predict the ddG. Without the GBT, gbt_predict and
+predict are skipped.
+
+Usage:
+    python benchmarks/hotpaths.py [--cases 1PPF 1CZ8] [--bench build_graph gen_features]
+                                  [--repeat 5] [--min-time 0.2] [--threads N] [-o hotpaths.json]
+    python benchmarks/hotpaths.py --build-fixtures [--ideal]
+
+    # run from the GeoPPI directory
+"""
+
+import argparse
+import ctypes
+import gc
+import hashlib
+import importlib.util
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+# name, structure, mutation, partners
+CASES = [
+    ('1PPF', 'data/testExamples/1PPF.pdb', 'TI17R', 'E_I'),
+    ('1CSE', 'data/testExamples/1CSE.pdb', 'LI38I', 'E_I'),
+    ('3SGB', 'data/testExamples/3SGB.pdb', 'KI7L', 'E_I'),
+    ('1A22', 'data/testExamples/1A22.pdb', 'WB35A', 'A_B'),
+    ('3BT1', 'data/testExamples/3BT1.pdb', 'PU149A', 'U_A'),
+    ('1MHP', 'data/testExamples/1MHP.pdb', 'EA48A', 'HL_A'),
+    ('1CZ8', 'data/testExamples/1CZ8.pdb', 'KW84A', 'WV_HL'),
+    ('41D1', '41D1/41D1_forGeoPPI.pdb', 'YB139A', 'AB_C'),
+]
+BENCHMARKS = ['read_inter_result', 'build_graph', 'cgat_forward', 'encoder_step', 'gen_features',
+              'gbt_predict', 'predict', 'interface_detection']
+
+
+def contact_interface(pdbfile, partners, cutoff=5.0):
+    """interface.txt lines of residues with a heavy atom within cutoff A of another chain of partners"""
+    from run import read_atoms
+    chains = partners.replace('_', '')
+    with open(pdbfile) as f:
+        table = read_atoms(f.read().splitlines())
+    heavy = [i for i, (atom, chain) in enumerate(zip(table.atom, table.chain))
+             if chain in chains and not atom.startswith('H')]
+    coords = np.array([table.coords[i] for i in heavy])
+    chain = np.array([table.chain[i] for i in heavy])
+    lines = []
+    for a in range(len(chains)):
+        for b in range(a + 1, len(chains)):
+            first, second = chain == chains[a], chain == chains[b]
+            if not first.any() or not second.any():
+                continue
+            d2 = ((coords[first][:, None, :] - coords[second][None, :, :])**2).sum(2)
+            near = d2 <= cutoff*cutoff
+            for side, mask, hits in ((chains[a], first, near.any(1)), (chains[b], second, near.any(0))):
+                residues = [table.resid[heavy[i]] for i in np.flatnonzero(mask)[hits]]
+                lines += ['{}_{}_{}_{}'.format(chains[a], chains[b], side, x) for x in dict.fromkeys(residues)]
+    return lines
+
+
+def write_fixture_info(name, mutation, partners, source, note):
+    with open(os.path.join(FIXTURES, name, 'fixture.json'), 'w') as f:
+        json.dump({'mutation': mutation, 'partners': partners, 'source': source, 'note': note}, f, indent=1)
+
+
+def build_fixture(name, pdbfile, mutation, partners):
+    """FoldX models and interface of a case in benchmarks/fixtures/<name> (needs FoldX and PyMOL)"""
+    from run import build_structures
+    local = os.path.basename(pdbfile)
+    workdir = 'fixture_tmp'
+    shutil.copy(os.path.join(ROOT, pdbfile), local)
+    try:
+        wildtypefile, mutantfile, interfacefile, _, _ = build_structures(local, mutation, partners, workdir)
+        target = os.path.join(FIXTURES, name)
+        os.makedirs(target, exist_ok=True)
+        for source, filename in ((wildtypefile, 'wildtype.pdb'), (mutantfile, 'mutant.pdb'),
+                                 (interfacefile, 'interface.txt')):
+            shutil.copy(source, os.path.join(target, filename))
+        write_fixture_info(name, mutation, partners, 'foldx', 'FoldX BuildModel models, PyMOL interface')
+    finally:
+        os.remove(local)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if os.path.exists('individual_list.txt'):
+            os.remove('individual_list.txt')
+
+
+def build_ideal_fixture(name, pdbfile, mutation, partners):
+    """Fixtures of a case without FoldX or PyMOL (see ideal_mutant.py)"""
+    from ideal_mutant import ideal_mutant
+    pdbpath = os.path.join(ROOT, pdbfile)
+    target = os.path.join(FIXTURES, name)
+    os.makedirs(target, exist_ok=True)
+    with open(pdbpath) as f:
+        lines = f.read().splitlines()
+    shutil.copy(pdbpath, os.path.join(target, 'wildtype.pdb'))
+    with open(os.path.join(target, 'mutant.pdb'), 'w') as f:
+        f.write('\n'.join(ideal_mutant(lines, mutation)) + '\n')
+    with open(os.path.join(target, 'interface.txt'), 'w') as f:
+        f.write('\n'.join(contact_interface(pdbpath, partners)) + '\n')
+    write_fixture_info(name, mutation, partners, 'ideal',
+                       'input structure as wildtype; mutant side chain in ideal geometry, not repacked; '
+                       'interface by 5 A heavy-atom contacts')
+
+
+def load_fixture(name, pdbfile, mutation, partners, scratch):
+    """Returns wildtype model, mutant model, interface file and the fixture source"""
+    files = [os.path.join(FIXTURES, name, x) for x in ('wildtype.pdb', 'mutant.pdb', 'interface.txt')]
+    if all(os.path.exists(x) for x in files):
+        infofile = os.path.join(FIXTURES, name, 'fixture.json')
+        info = {}
+        if os.path.exists(infofile):
+            with open(infofile) as f:
+                info = json.load(f)
+        if info.get('mutation', mutation) != mutation or info.get('partners', partners) != partners:
+            raise ValueError('benchmarks/fixtures/{} is for {} {}, not {} {}; rebuild it with --build-fixtures'.format(
+                name, info.get('mutation'), info.get('partners'), mutation, partners))
+        return files + [info.get('source', 'foldx')]
+    interfacefile = os.path.join(scratch, '{}_interface.txt'.format(name))
+    with open(interfacefile, 'w') as f:
+        f.write('\n'.join(contact_interface(pdbfile, partners)) + '\n')
+    return [pdbfile, pdbfile, interfacefile, 'input']
+
+
+def _status_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def reset_peak():
+    """Reset the peak resident memory of this process (Linux); False where unsupported"""
+    # return freed memory to the system first, so every benchmark allocates its working set
+    # anew and the peak does not depend on what the benchmarks before it left in malloc
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Time func: warm-up, then repeat samples of enough calls to fill min_time"""
+    start = time.perf_counter()
+    func()
+    once = time.perf_counter() - start
+    number = max(1, int(math.ceil(min_time / max(once, 1e-9))))
+    tracked = reset_peak()
+    before = _status_mb('VmRSS') if tracked else None
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    peak = _status_mb('VmHWM') - before if tracked else None
+    return {
+        'seconds': {'min': min(samples), 'median': statistics.median(samples), 'mean': statistics.mean(samples),
+                    'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0},
+        'repeat': repeat,
+        'number': number,
+        'peak_mb': None if peak is None else round(max(peak, 0.0), 1),
+    }
+
+
+def eager_encoder(gnnfile='trainedmodels/GeoEnc.tor'):
+    """The eager GeometricEncoder, for cgat_forward; None without torch_geometric"""
+    import torch
+    try:
+        from models import GeometricEncoder
+        model = GeometricEncoder(256)
+    except ImportError:
+        return None
+    model.load_state_dict(torch.load(gnnfile, map_location='cpu'))
+    return model.eval()
+
+
+def graph_hash(A, E):
+    digest = hashlib.sha256()
+    for tensor in (A, E):
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def cgat_inputs(X, E):
+    """The inputs of conv1 as GeometricEncoder.step prepares them"""
+    import torch
+    x_init = X[:, :-1]
+    resid_max = torch.max(x_init[:, 27]).item()/6.283
+    x = torch.cat([x_init[:, :27], torch.sin(x_init[:, 27:28]/resid_max), torch.cos(x_init[:, 27:28]/resid_max),
+                   x_init[:, 28:]], 1)
+    return x, E.t(), E.reshape(-1)
+
+
+def run_case(case, selected, model, eager, forest, sorted_idx, plan, scratch, repeat, min_time):
+    import torch
+    from models import GeoPPIpredict, GeoPPIregress
+    from run import build_graph, read_inter_result
+
+    name, pdbfile, mutation, partners = case
+    pdbpath = os.path.join(ROOT, pdbfile)
+    wildtypefile, mutantfile, interfacefile, source = load_fixture(name, pdbpath, mutation, partners, scratch)
+    chainid, resid = mutation[1], mutation[2:-1]
+    mutinfo = ['{}_{}'.format(chainid, resid)]
+    with open(wildtypefile) as f:
+        lines = f.read().splitlines()
+    with open(mutantfile) as f:
+        mutant_lines = f.read().splitlines()
+    interface = read_inter_result(interfacefile, partners, [chainid])
+    A, E, _ = build_graph(lines, list(interface), mutinfo, 3, 12)
+    A_m, E_m, _ = build_graph(mutant_lines, list(interface), mutinfo, 3, 12)
+    flag = mutation[0] == mutation[-1]
+    with torch.no_grad():
+        features = np.round(model.gen_features(A, E, E, A_m, E_m, E_m, blocks=plan.blocks).numpy(), 3)[None, plan.index]
+
+    info = {'case': name, 'pdb': pdbfile, 'mutation': mutation, 'partners': partners, 'fixture': source,
+            'atoms': int(A.shape[0]), 'edges': int(E.shape[0]), 'interface_residues': len(interface)}
+    results = []
+
+    def record(bench, func, **extra):
+        if bench not in selected:
+            return
+        entry = dict(info, name=bench, **extra)
+        if 'skipped' not in extra:
+            with torch.no_grad():
+                entry.update(measure(func, repeat, min_time))
+        results.append(entry)
+        seconds = entry.get('seconds')
+        print('{:6s} {:20s} {}'.format(name, bench, extra['skipped'] if seconds is None else
+                                       '{:10.3f} ms  (peak +{} MB)'.format(1e3*seconds['median'], entry['peak_mb'])))
+
+    record('read_inter_result', lambda: read_inter_result(interfacefile, partners, [chainid]))
+    record('build_graph', lambda: build_graph(lines, list(interface), mutinfo, 3, 12), graph_sha256=graph_hash(A, E))
+    if eager is None:
+        record('cgat_forward', None, skipped='needs torch_geometric for the eager encoder')
+    else:
+        x, edge_index, edge_attr = cgat_inputs(A, E)
+        record('cgat_forward', lambda: eager.conv1(x, edge_index, edge_attr))
+    if hasattr(model, 'embed'):
+        record('encoder_step', lambda: model.embed(A, E))
+    else:
+        record('encoder_step', None, skipped='the TorchScript export predates embed; rerun python jit_encoder.py')
+    record('gen_features', lambda: model.gen_features(A, E, E, A_m, E_m, E_m, blocks=plan.blocks),
+           features=[float(x) for x in features[0]])
+    if forest is None:
+        record('gbt_predict', None, skipped='needs the GBT (trainedmodels/gbt-s4169.pkl)')
+        record('predict', None, skipped='needs the GBT (trainedmodels/gbt-s4169.pkl)')
+    else:
+        record('gbt_predict', lambda: GeoPPIregress(features, forest, [flag]))
+        record('predict', lambda: GeoPPIpredict(A, E, A_m, E_m, model, forest, sorted_idx, flag, plan),
+               ddg=float(GeoPPIpredict(A, E, A_m, E_m, model, forest, sorted_idx, flag, plan)))
+    if importlib.util.find_spec('pymol') is None:
+        record('interface_detection', None, skipped='needs pymol')
+    else:
+        copy = os.path.join(scratch, os.path.basename(pdbfile))
+        def detect():
+            shutil.copy(pdbpath, copy)
+            subprocess.run([sys.executable, os.path.join(ROOT, 'gen_interface.py'), copy, partners, scratch],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT, check=True)
+        record('interface_detection', detect)
+    return results
+
+
+def cpu_model():
+    """The CPU model name (platform.processor() is empty on most Linux systems)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+
+def environment(threads):
+    import torch
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': cpu_model(),
+            'cpus': os.cpu_count(), 'torch': torch.__version__, 'numpy': np.__version__,
+            'torch_threads': threads, 'precision': os.environ.get('GEOPPI_PRECISION', 'fp32'), 'commit': commit}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths on the bundled structures')
+    parser.add_argument('--cases', nargs='+', help='Case names (default: all of {})'.format(
+        ', '.join(x[0] for x in CASES)))
+    parser.add_argument('--bench', nargs='+', choices=BENCHMARKS, help='Benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds per sample (calls are looped to fill it)')
+    parser.add_argument('--threads', type=int, help='torch threads (default: torch default)')
+    parser.add_argument('--build-fixtures', action='store_true', help='Build the FoldX fixtures of the cases and exit')
+    parser.add_argument('--ideal', action='store_true',
+                        help='With --build-fixtures: build the mutants in ideal geometry, without FoldX or PyMOL')
+    parser.add_argument('-o', '--output', default='hotpaths.json')
+    args = parser.parse_args()
+
+    cases = [x for x in CASES if args.cases is None or x[0] in args.cases]
+    if args.cases and len(cases) < len(args.cases):
+        parser.error('unknown cases: {}'.format(' '.join(sorted(set(args.cases) - set(x[0] for x in cases)))))
+    if args.build_fixtures:
+        for case in cases:
+            (build_ideal_fixture if args.ideal else build_fixture)(*case)
+            print('Built fixtures of {}'.format(case[0]))
+        return
+
+    import torch
+    from models import FeaturePlan, n_selected
+    from run import load_models
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, forest, sorted_idx = load_models(precision=os.environ.get('GEOPPI_PRECISION', 'fp32'))
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+    eager = eager_encoder()
+    selected = set(args.bench or BENCHMARKS)
+
+    results = []
+    scratch = tempfile.mkdtemp(prefix='hotpaths_')
+    try:
+        for case in cases:
+            results += run_case(case, selected, model, eager, forest, sorted_idx, plan, scratch,
+                                args.repeat, args.min_time)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'suite': 'hotpaths', 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'environment': environment(torch.get_num_threads()),
+                   'config': {'repeat': args.repeat, 'min_time': args.min_time}, 'results': results}, f, indent=1)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Mutant models without FoldX, for benchmark fixtures.
+
+The hot-path benchmarks need a wildtype and a mutant model per case, and
+FoldX is not available everywhere they run. ideal_mutant keeps every atom of
+the structure but the side chain of the mutated residue, which it rebuilds
+beyond CB from ideal bond lengths and angles. Of the staggered rotamers
+(every chi at the common value or 120 degrees either side of it) it keeps the
+one farthest from the atoms around it, the most common first on ties.
+Nothing else is repacked or minimized, so the model is not
+a FoldX model and its ddG is not a prediction to compare with experiment; it
+gives the graph builder and the encoder a real mutant graph of the right
+size and composition.
+
+Aromatic residues and proline are not supported.
+
+Usage:
+    python benchmarks/ideal_mutant.py [pdb file] [mutation, e.g. TI17R] [output pdb file]
+"""
+
+import itertools
+import sys
+
+import numpy as np
+
+from synthetic import ONE_LETTER
+
+THREE_LETTER = dict((one, three) for three, one in ONE_LETTER.items())
+# CB of a new side chain: bond CA-CB, angle N-CA-CB and dihedral C-N-CA-CB
+CB_GEOMETRY = (1.53, 110.5, -122.6)
+# atoms after CB, in order: name, the three atoms it is placed from, bond, angle and dihedral (degrees),
+# the dihedrals being those of the most common rotamer
+SIDE_CHAINS = {
+    'ALA': [],
+    'GLY': [],
+    'SER': [('OG', 'N', 'CA', 'CB', 1.42, 111.1, 62.0)],
+    'CYS': [('SG', 'N', 'CA', 'CB', 1.81, 114.0, -65.0)],
+    'VAL': [('CG1', 'N', 'CA', 'CB', 1.53, 110.5, 175.0), ('CG2', 'N', 'CA', 'CB', 1.53, 110.5, -65.0)],
+    'THR': [('OG1', 'N', 'CA', 'CB', 1.43, 109.2, 60.0), ('CG2', 'N', 'CA', 'CB', 1.53, 111.1, -60.0)],
+    'LEU': [('CG', 'N', 'CA', 'CB', 1.53, 116.1, -65.0), ('CD1', 'CA', 'CB', 'CG', 1.52, 110.5, 175.0),
+            ('CD2', 'CA', 'CB', 'CG', 1.52, 110.5, -65.0)],
+    'ILE': [('CG1', 'N', 'CA', 'CB', 1.53, 110.4, -65.0), ('CG2', 'N', 'CA', 'CB', 1.53, 110.5, 175.0),
+            ('CD1', 'CA', 'CB', 'CG1', 1.51, 113.8, 170.0)],
+    'MET': [('CG', 'N', 'CA', 'CB', 1.52, 113.7, -65.0), ('SD', 'CA', 'CB', 'CG', 1.81, 112.7, 180.0),
+            ('CE', 'CB', 'CG', 'SD', 1.79, 100.6, -70.0)],
+    'LYS': [('CG', 'N', 'CA', 'CB', 1.52, 113.8, -65.0), ('CD', 'CA', 'CB', 'CG', 1.52, 111.8, 180.0),
+            ('CE', 'CB', 'CG', 'CD', 1.52, 111.8, 180.0), ('NZ', 'CG', 'CD', 'CE', 1.49, 111.7, 180.0)],
+    'ARG': [('CG', 'N', 'CA', 'CB', 1.52, 113.8, -65.0), ('CD', 'CA', 'CB', 'CG', 1.52, 111.8, 180.0),
+            ('NE', 'CB', 'CG', 'CD', 1.46, 111.7, 180.0), ('CZ', 'CG', 'CD', 'NE', 1.33, 124.2, 180.0),
+            ('NH1', 'CD', 'NE', 'CZ', 1.33, 120.5, 0.0), ('NH2', 'CD', 'NE', 'CZ', 1.33, 120.0, 180.0)],
+    'ASP': [('CG', 'N', 'CA', 'CB', 1.52, 113.0, -65.0), ('OD1', 'CA', 'CB', 'CG', 1.25, 119.2, -30.0),
+            ('OD2', 'CA', 'CB', 'CG', 1.25, 118.2, 150.0)],
+    'ASN': [('CG', 'N', 'CA', 'CB', 1.52, 112.6, -65.0), ('OD1', 'CA', 'CB', 'CG', 1.23, 120.8, -40.0),
+            ('ND2', 'CA', 'CB', 'CG', 1.33, 116.4, 140.0)],
+    'GLU': [('CG', 'N', 'CA', 'CB', 1.52, 113.8, -65.0), ('CD', 'CA', 'CB', 'CG', 1.52, 113.3, 180.0),
+            ('OE1', 'CB', 'CG', 'CD', 1.25, 119.0, 0.0), ('OE2', 'CB', 'CG', 'CD', 1.25, 118.0, 180.0)],
+    'GLN': [('CG', 'N', 'CA', 'CB', 1.52, 113.8, -65.0), ('CD', 'CA', 'CB', 'CG', 1.52, 112.8, 180.0),
+            ('OE1', 'CB', 'CG', 'CD', 1.23, 120.9, 0.0), ('NE2', 'CB', 'CG', 'CD', 1.33, 116.5, 180.0)],
+}
+BACKBONE = ('N', 'CA', 'C', 'O', 'OXT')
+# the rotation axis of each chi angle; atoms placed about another axis (planar groups) do not move
+CHI_AXES = [('CA', 'CB'), ('CB', 'CG'), ('CB', 'CG1'), ('CG', 'CD'), ('CG', 'SD'), ('CD', 'NE'), ('CD', 'CE')]
+STAGGERED = (0.0, 120.0, -120.0)
+# atoms within this distance of CA are checked for clashes
+NEIGHBOURHOOD = 12.0
+
+
+def place(a, b, c, bond, angle, dihedral):
+    """Position of d with |cd| = bond, angle bcd and dihedral abcd (degrees)"""
+    angle, dihedral = np.radians(angle), np.radians(dihedral)
+    bc = (c - b) / np.linalg.norm(c - b)
+    n = np.cross(b - a, bc)
+    n /= np.linalg.norm(n)
+    d = np.array([-bond*np.cos(angle), bond*np.sin(angle)*np.cos(dihedral), bond*np.sin(angle)*np.sin(dihedral)])
+    return c + np.dot(np.array([bc, np.cross(n, bc), n]).T, d)
+
+
+def rotamers(side_chain):
+    """Dihedral offsets of every staggered rotamer, one per atom of side_chain, the common rotamer first"""
+    axes = [(b, c) for _, _, b, c, _, _, _ in side_chain]
+    chis = [x for x in CHI_AXES if x in axes]
+    for shifts in itertools.product(STAGGERED, repeat=len(chis)):
+        offset = dict(zip(chis, shifts))
+        yield [offset.get(axis, 0.0) for axis in axes]
+
+
+def _atom_line(template, serial, name, resname, coord):
+    element = name[0]
+    return '{}{:>5d} {:<4s}{}{:>3s}{}{:8.3f}{:8.3f}{:8.3f}{}{:>2s}'.format(
+        'ATOM  ', serial % 100000, ' ' + name if len(name) < 4 else name, template[16], resname,
+        template[20:30], coord[0], coord[1], coord[2], template[54:76].ljust(22), element)
+
+
+def _coords(line):
+    return np.array([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+
+
+def _heavy(line):
+    element = line[76:78].strip() or line[12:16].strip().lstrip('0123456789')[:1]
+    return element not in ('H', 'D')
+
+
+def build_side_chain(coords, resname, environment):
+    """Coordinates of the side chain atoms after CB, in the staggered rotamer farthest from environment"""
+    side_chain = SIDE_CHAINS[resname]
+    best, best_distance = {}, -1.0
+    for offsets in rotamers(side_chain):
+        placed = dict(coords)
+        for (name, a, b, c, bond, angle, dihedral), offset in zip(side_chain, offsets):
+            placed[name] = place(placed[a], placed[b], placed[c], bond, angle, dihedral + offset)
+        if not side_chain or not len(environment):
+            return placed
+        atoms = np.array([placed[x[0]] for x in side_chain])
+        distance = np.sqrt(((atoms[:, None, :] - environment[None, :, :])**2).sum(2)).min()
+        if distance > best_distance + 1e-6:
+            best, best_distance = placed, distance
+    return best
+
+
+def ideal_mutant(lines, mutation):
+    """PDB lines of the structure with mutation (e.g. TI17R) applied; atoms are renumbered"""
+    wildtype, chain, resid, mutant = mutation[0], mutation[1], mutation[2:-1], mutation[-1]
+    resname = THREE_LETTER.get(mutant)
+    if resname not in SIDE_CHAINS:
+        raise ValueError('cannot build {} side chains (supported: {})'.format(
+            resname or mutant, ' '.join(sorted(SIDE_CHAINS))))
+    site = [i for i, line in enumerate(lines) if line[0:4] == 'ATOM' and line[21] == chain
+            and line[22:27].strip() == resid]
+    if not site:
+        raise ValueError('residue {}{} not found'.format(chain, resid))
+    if ONE_LETTER.get(lines[site[0]][17:20]) != wildtype:
+        raise ValueError('residue {}{} is {}, not {}'.format(chain, resid, lines[site[0]][17:20], wildtype))
+
+    coords = dict((lines[i][12:16].strip(), _coords(lines[i])) for i in site)
+    backbone = [lines[i] for i in site if lines[i][12:16].strip() in BACKBONE]
+    template = backbone[0]
+    if resname != 'GLY':
+        if 'CB' not in coords:
+            coords['CB'] = place(coords['C'], coords['N'], coords['CA'], *CB_GEOMETRY)
+        names = ['CB'] + [x[0] for x in SIDE_CHAINS[resname]]
+        skip = set(site)
+        environment = np.array([_coords(line) for i, line in enumerate(lines) if line[0:6] in ('ATOM  ', 'HETATM')
+                                and i not in skip and _heavy(line)]).reshape(-1, 3)
+        environment = environment[((environment - coords['CA'])**2).sum(1) <= NEIGHBOURHOOD**2]
+        coords = build_side_chain(dict((x, coords[x]) for x in ('N', 'CA', 'C', 'CB')), resname, environment)
+    else:
+        names = []
+    residue = [line[:17] + resname + line[20:] for line in backbone]
+    # side chain after O, before OXT
+    position = len([x for x in backbone if x[12:16].strip() != 'OXT'])
+    residue[position:position] = [_atom_line(template, 0, name, resname, coords[name]) for name in names]
+
+    skip = set(site)
+    output = lines[:site[0]] + residue + [x for i, x in enumerate(lines[site[0]:], site[0]) if i not in skip]
+    serial = 0
+    for i, line in enumerate(output):
+        if line[0:6] in ('ATOM  ', 'HETATM'):
+            serial += 1
+            output[i] = line[:6] + '{:>5d}'.format(serial % 100000) + line[11:]
+    return output
+
+
+def main():
+    if len(sys.argv) != 4:
+        print('Usage: python benchmarks/ideal_mutant.py [pdb file] [mutation] [output pdb file]')
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        lines = f.read().splitlines()
+    with open(sys.argv[3], 'w') as f:
+        f.write('\n'.join(ideal_mutant(lines, sys.argv[2])) + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Import-time report for the GeoPPI entry points.
+
+Each entry point is imported in a fresh interpreter under `python -X importtime`
+and the modules with the largest cumulative import time are listed, together
+with the wall time of `run.py --help` and `run.py --dry-run` (the paths that
+short tasks take before any model is loaded).
+
+Usage:
+    python benchmarks/importtime.py [--top 15] [-o importtime.json]
+
+    # run from the GeoPPI directory
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = ['run', 'models', 'jit_encoder', 'fastgbt', 'precision']
+COMMANDS = {
+    'run.py --help': ['run.py', '--help'],
+    'run.py --dry-run': ['run.py', 'data/testExamples/1PPF.pdb', 'TI17R', 'E_I', '--dry-run'],
+}
+
+
+def import_times(module):
+    """Return (wall seconds, [(cumulative us, self us, module)]) for importing module"""
+    start = time.time()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(self_us), name.rstrip()))
+    return wall, rows
+
+
+def command_time(argv, repeat=3):
+    """Best wall time of running a Python command"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.run([sys.executable] + argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the import time of the GeoPPI entry points')
+    parser.add_argument('--top', type=int, default=15, help='Modules to list per entry point (default: 15)')
+    parser.add_argument('-o', '--output', help='Also write the report as JSON')
+    args = parser.parse_args()
+
+    report = {'python': sys.version.split()[0], 'baseline_s': command_time(['-c', 'pass']), 'imports': {}, 'commands': {}}
+    print('Interpreter startup: {:.0f} ms'.format(1000*report['baseline_s']))
+
+    for module in ENTRY_POINTS:
+        try:
+            wall, rows = import_times(module)
+        except RuntimeError as e:
+            print('\nimport {}: failed ({})'.format(module, e))
+            report['imports'][module] = {'error': str(e)}
+            continue
+        rows.sort(reverse=True)
+        # nesting is shown by indentation; top-level modules add up to the total import time
+        total = sum(cumulative for cumulative, _, name in rows if not name.startswith('  '))
+        report['imports'][module] = {
+            'wall_s': wall,
+            'import_s': total/1e6,
+            'top': [{'module': name.strip(), 'cumulative_us': c, 'self_us': s} for c, s, name in rows[:args.top]],
+        }
+        print('\nimport {}: {:.0f} ms of imports, {:.0f} ms wall'.format(module, total/1e3, 1000*wall))
+        for cumulative, self_us, name in rows[:args.top]:
+            print('  {:>9.1f} ms  {:>8.1f} ms self  {}'.format(cumulative/1e3, self_us/1e3, name.strip()))
+
+    print()
+    for label, argv in COMMANDS.items():
+        report['commands'][label] = command_time(argv)
+        print('{:20s} {:.0f} ms'.format(label, 1000*report['commands'][label]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Report written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Performance and numerical regression gate for the hot paths.
+
+Runs benchmarks/hotpaths.py (or reads its JSON with --results) and compares
+every benchmark with the baseline file, benchmarks/baseline.json:
+
+    time       the seconds per call (the fastest of the --repeat samples, the
+               least noisy) may exceed the baseline by the benchmark's time
+               tolerance (default 20%)
+    memory     the peak memory increase may exceed the baseline by the
+               memory tolerance (default 25%) plus a slack in MB (default 16)
+    ran        every benchmark of the baseline must have run (of the --cases
+               given, if any); a skipped or missing one fails
+    graph      the sha256 of build_graph's output must not change
+    features   the rounded features the GBT reads (gen_features) may differ
+               by at most the features tolerance (default 0.002, a flip of
+               the 3rd decimal)
+    ddG        the predicted ddG (predict) may differ by at most the ddg
+               tolerance (default 0, i.e. identical to 2 decimals)
+    baseline   every baseline entry must hold the values these checks need:
+               time and memory for all, and the graph, features or ddG of
+               the benchmarks above; a missing one fails, and so does a case
+               without a predict entry, since its ddG would go unchecked
+
+The report lists every comparison, and the command exits with status 1 when
+one fails, so it can gate a merge. A faster build_graph or encoder that
+changes the graphs, features or ddGs fails even when it is faster.
+
+The baseline holds the timings, memory and outputs of a reference run, the
+environment it ran in, and the tolerances. Tolerances are set per benchmark
+name (e.g. "build_graph") or per case and name ("1CZ8/build_graph") in its
+"tolerances" object, over "default". Its "note" says what the reference run
+was (machine, fixtures, models). --update writes the current run as the new
+baseline, keeping the tolerances; record it on the machine that runs the gate,
+with the real models, and commit it with the change that justifies it.
+
+Usage:
+    python benchmarks/regression_gate.py [--baseline benchmarks/baseline.json] [--results hotpaths.json]
+                                         [--cases 1PPF 1CZ8] [--repeat 5] [--min-time 0.2] [--threads N]
+    python benchmarks/regression_gate.py --update [--note "reference machine, fixtures and models"]
+
+    # run from the GeoPPI directory
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_TOLERANCES = {'time': 0.20, 'memory': 0.25, 'memory_mb': 16.0, 'ddg': 0.0, 'features': 0.002}
+# environment fields that make timings incomparable when they differ
+ENVIRONMENT_KEYS = ['cpus', 'processor', 'torch', 'numpy', 'torch_threads', 'precision']
+# the check of each baseline value, and the values each benchmark's entry must hold
+CHECKS = {'seconds': 'time', 'peak_mb': 'memory', 'graph_sha256': 'graph', 'features': 'features', 'ddg': 'ddg'}
+OUTPUTS = {'build_graph': ['graph_sha256'], 'gen_features': ['features'], 'predict': ['ddg']}
+
+
+def required(key):
+    """Baseline values the entry of a case/name key must hold"""
+    return ['seconds', 'peak_mb'] + OUTPUTS.get(key.split('/', 1)[1], [])
+
+
+def run_hotpaths(args, output):
+    command = [sys.executable, os.path.join(ROOT, 'benchmarks', 'hotpaths.py'), '-o', output,
+               '--repeat', str(args.repeat), '--min-time', str(args.min_time)]
+    if args.cases:
+        command += ['--cases'] + args.cases
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    subprocess.run(command, check=True)
+
+
+def by_name(results):
+    """{case/name: entry} of the benchmarks that ran"""
+    return dict(('{}/{}'.format(x['case'], x['name']), x) for x in results if 'skipped' not in x)
+
+
+def tolerances(baseline, key):
+    """Tolerances of a case/name key: default, then name, then case/name entries of the baseline"""
+    configured = baseline.get('tolerances', {})
+    merged = dict(DEFAULT_TOLERANCES, **configured.get('default', {}))
+    merged.update(configured.get(key.split('/', 1)[1], {}))
+    merged.update(configured.get(key, {}))
+    return merged
+
+
+def compare(baseline, current, cases=None):
+    """
+    Returns rows of (key, check, baseline value, current value, limit, ok) and notes. A baseline
+    benchmark that did not run fails; with cases, only the baseline entries of those cases are compared.
+    """
+    rows, notes = [], []
+    reference = baseline['benchmarks']
+    results = current['results']
+    if cases:
+        reference = dict((key, entry) for key, entry in reference.items() if key.split('/', 1)[0] in cases)
+        results = [x for x in results if x['case'] in cases]
+    measured = by_name(results)
+    skipped = dict(('{}/{}'.format(x['case'], x['name']), x['skipped']) for x in results if 'skipped' in x)
+    for key in sorted(set(reference) - set(measured)):
+        rows.append((key, 'ran', 'yes', 'skipped' if key in skipped else 'no', 'must run', False))
+        if key in skipped:
+            notes.append('{} was skipped: {}'.format(key, skipped[key]))
+    for key in sorted(set(measured) - set(reference)):
+        notes.append('{} is new (not in the baseline)'.format(key))
+    for case in sorted(set(key.split('/', 1)[0] for key in reference)):
+        # e.g. a baseline recorded without the GBT
+        key = '{}/predict'.format(case)
+        if key not in reference:
+            ddg = measured.get(key, {}).get('ddg')
+            rows.append((key, 'ddg', 'missing', '-' if ddg is None else ddg, 'in baseline', False))
+
+    for key in sorted(set(reference) & set(measured)):
+        old, new, tol = reference[key], measured[key], tolerances(baseline, key)
+        for name in required(key):
+            if old.get(name) is None:
+                rows.append((key, CHECKS[name], 'missing', '-', 'in baseline', False))
+        if old.get('seconds') is not None:
+            limit = old['seconds']*(1 + tol['time'])
+            rows.append((key, 'time', old['seconds'], new['seconds']['min'], limit, new['seconds']['min'] <= limit))
+        if old.get('peak_mb') is not None:
+            # without a current peak (not Linux) the memory check cannot pass
+            limit = old['peak_mb']*(1 + tol['memory']) + tol['memory_mb']
+            ok = new.get('peak_mb') is not None and new['peak_mb'] <= limit
+            rows.append((key, 'memory', old['peak_mb'], '-' if new.get('peak_mb') is None else new['peak_mb'], limit, ok))
+        if old.get('graph_sha256') is not None:
+            same = old['graph_sha256'] == new.get('graph_sha256')
+            rows.append((key, 'graph', old['graph_sha256'][:12], (new.get('graph_sha256') or '-')[:12], 'equal', same))
+        if old.get('ddg') is not None:
+            diff = abs(new.get('ddg', float('inf')) - old['ddg'])
+            rows.append((key, 'ddg', old['ddg'], new['ddg'], tol['ddg'], diff <= tol['ddg'] + 1e-9))
+        if old.get('features') is not None:
+            if len(old['features']) != len(new.get('features') or []):
+                rows.append((key, 'features', len(old['features']), len(new.get('features') or []), 'same length', False))
+            else:
+                diff = max([abs(a - b) for a, b in zip(old['features'], new['features'])] or [0.0])
+                rows.append((key, 'features', 0.0, diff, tol['features'], diff <= tol['features'] + 1e-9))
+
+    environment = baseline.get('environment', {})
+    changed = [x for x in ENVIRONMENT_KEYS if environment.get(x) != current['environment'].get(x)]
+    if changed:
+        notes.append('the environment differs from the baseline ({}); timings may not be comparable'.format(
+            ', '.join('{} {} -> {}'.format(x, environment.get(x), current['environment'].get(x)) for x in changed)))
+    return rows, notes
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return str(value)
+
+
+def report(rows, notes):
+    print('{:28s} {:9s} {:>14s} {:>14s} {:>14s} {:>8s}  {}'.format(
+        'benchmark', 'check', 'baseline', 'current', 'limit', 'change', 'status'))
+    for key, check, old, new, limit, ok in rows:
+        change = ''
+        if check in ('time', 'memory') and isinstance(old, float) and isinstance(new, float) and old:
+            change = '{:+.0%}'.format(new/old - 1)
+        print('{:28s} {:9s} {:>14s} {:>14s} {:>14s} {:>8s}  {}'.format(
+            key, check, _format(old), _format(new), _format(limit), change, 'ok' if ok else 'FAIL'))
+    for note in notes:
+        print('Note: {}'.format(note))
+    failed = [row for row in rows if not row[5]]
+    if failed:
+        print('\n{} of {} checks failed:'.format(len(failed), len(rows)))
+        for key, check, old, new, limit, _ in failed:
+            print('  {} {}: {} -> {} (limit {})'.format(key, check, _format(old), _format(new), _format(limit)))
+    else:
+        print('\nAll {} checks passed'.format(len(rows)))
+    return not failed
+
+
+def baseline_from(current, previous=None, note=None):
+    benchmarks = {}
+    for key, entry in by_name(current['results']).items():
+        benchmarks[key] = dict((name, entry[name]) for name in ('peak_mb', 'graph_sha256', 'ddg', 'features', 'fixture')
+                               if name in entry)
+        benchmarks[key]['seconds'] = entry['seconds']['min']
+        missing = [name for name in required(key) if benchmarks[key].get(name) is None]
+        if missing:
+            print('Warning: {} has no {}; the gate will fail on it'.format(key, ', '.join(missing)))
+    return {'created': current['created'], 'note': note, 'environment': current['environment'],
+            'tolerances': (previous or {}).get('tolerances', {'default': DEFAULT_TOLERANCES}),
+            'benchmarks': benchmarks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the hot-path benchmarks with a stored baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--results', help='Output of benchmarks/hotpaths.py, instead of running it')
+    parser.add_argument('--update', action='store_true', help='Write the current run as the baseline')
+    parser.add_argument('--note', help='With --update: the reference machine, fixtures and models of the run')
+    parser.add_argument('--cases', nargs='+', help='Run and compare only these cases')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as f:
+            current = json.load(f)
+    else:
+        with tempfile.TemporaryDirectory() as scratch:
+            output = os.path.join(scratch, 'hotpaths.json')
+            run_hotpaths(args, output)
+            with open(output) as f:
+                current = json.load(f)
+
+    previous = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            previous = json.load(f)
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline_from(current, previous, args.note), f, indent=1)
+        print('Baseline of {} benchmarks written to {}'.format(len(by_name(current['results'])), args.baseline))
+        return
+    if previous is None:
+        print('Error: no baseline at {}; record one with --update'.format(args.baseline))
+        sys.exit(2)
+
+    rows, notes = compare(previous, current, args.cases)
+    if previous.get('note'):
+        notes.append('baseline: {}'.format(previous['note']))
+    if not report(rows, notes):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Scaling of the pipeline stages with complex size and interface size.
+
+Two sweeps of synthetic complexes (benchmarks/synthetic.py): --atoms at
+--base-interface interface residues, and --interface at --base-atoms atoms.
+For every complex, in a fresh process, the suite times
+
+    parse                read_atoms on the PDB lines
+    interface_detection  gen_interface.py (PyMOL), when pymol is installed
+    read_inter_result    parsing interface.txt
+    build_graph          the wildtype graph (the 12 A selection around the
+                         interface and the dense distance step)
+    encoder_step         the four graph layers of one graph (model.embed)
+    gen_features         both graphs and the pooled 18x256 features
+
+and records the seconds (the fastest of --repeat calls), the peak resident
+memory above the level before the stage (Linux), and the graph's nodes and
+edges. The GBT sees 240 features whatever the complex and is left out. A
+complex that exceeds --timeout or is killed (usually by running out of
+memory) records the stage it stopped in, and the stages after it are not run:
+that is where the stage stops scaling.
+
+--plot draws time and peak memory of every stage against atom count and
+against interface residues (needs matplotlib); --results redraws the plot of
+an earlier run.
+
+Usage:
+    python benchmarks/scaling.py [--atoms 5000 20000 50000 ...] [--base-interface 100]
+                                 [--interface 25 100 400 ...] [--base-atoms 50000]
+                                 [--repeat 1] [--timeout 1800] [-o scaling.json] [--plot scaling.png]
+    python benchmarks/scaling.py --results scaling.json --plot scaling.png
+
+    # run from the GeoPPI directory
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from hotpaths import ROOT, _status_mb, environment, reset_peak
+from synthetic import make_complex
+
+STAGES = ['parse', 'interface_detection', 'read_inter_result', 'build_graph', 'encoder_step', 'gen_features']
+DEFAULT_ATOMS = [5000, 10000, 20000, 50000, 100000, 200000, 500000]
+DEFAULT_INTERFACE = [25, 50, 100, 200, 400, 800, 1600]
+
+
+def run_stage(func, repeat):
+    """Seconds (fastest of repeat calls) and peak memory increase in MB (None where unsupported) of func"""
+    gc.collect()
+    tracked = reset_peak()
+    before = _status_mb('VmRSS') if tracked else None
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = _status_mb('VmHWM') - before if tracked else None
+    return output, best, None if peak is None else round(max(peak, 0.0), 1)
+
+
+def child(pdbfile, interfacefile, mutation, partners, output, repeat):
+    """Run the stages on one complex, appending a JSON line per stage to output as it finishes"""
+    import torch
+    from run import build_graph, load_models, read_atoms, read_inter_result
+
+    model, forest, sorted_idx = load_models(precision=os.environ.get('GEOPPI_PRECISION', 'fp32'))
+    from models import FeaturePlan, n_selected
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+    chainid, resid = mutation[1], mutation[2:-1]
+    mutinfo = ['{}_{}'.format(chainid, resid)]
+    with open(pdbfile) as f:
+        lines = f.read().splitlines()
+    scratch = os.path.dirname(os.path.abspath(pdbfile))
+
+    def emit(stage, **fields):
+        with open(output, 'a') as f:
+            f.write(json.dumps(dict(name=stage, **fields)) + '\n')
+
+    def record(stage, func):
+        result, seconds, peak = run_stage(func, repeat)
+        emit(stage, seconds=seconds, peak_mb=peak)
+        return result
+
+    record('parse', lambda: read_atoms(lines))
+    if importlib.util.find_spec('pymol') is None:
+        emit('interface_detection', skipped='needs pymol')
+    else:
+        copy = os.path.join(scratch, 'detect', os.path.basename(pdbfile))
+        os.makedirs(os.path.dirname(copy), exist_ok=True)
+        def detect():
+            shutil.copy(pdbfile, copy)
+            subprocess.run([sys.executable, os.path.join(ROOT, 'gen_interface.py'), copy, partners,
+                            os.path.dirname(copy)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           cwd=ROOT, check=True)
+        record('interface_detection', detect)
+    interface = record('read_inter_result', lambda: read_inter_result(interfacefile, partners, [chainid]))
+    with torch.no_grad():
+        A, E, _ = record('build_graph', lambda: build_graph(lines, list(interface), mutinfo, 3, 12))
+        emit('graph', nodes=int(A.shape[0]), edges=int(E.shape[0]))
+        if hasattr(model, 'embed'):
+            record('encoder_step', lambda: model.embed(A, E))
+        else:
+            emit('encoder_step', skipped='the TorchScript export predates embed; rerun python jit_encoder.py')
+        record('gen_features', lambda: model.gen_features(A, E, E, A, E, E, blocks=plan.blocks))
+
+
+def run_point(info, sweep, args, scratch):
+    """Results of the stages on one complex, in a fresh process"""
+    output = os.path.join(scratch, 'stages.jsonl')
+    if os.path.exists(output):
+        os.remove(output)
+    command = [sys.executable, os.path.abspath(__file__), '--child', info['pdb'], info['interface_file'],
+               info['mutation'], info['partners'], output, '--repeat', str(args.repeat)]
+    failure = None
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 universal_newlines=True, timeout=args.timeout)
+        if process.returncode < 0:
+            failure = 'killed by signal {} (out of memory?)'.format(-process.returncode)
+        elif process.returncode > 0:
+            failure = 'failed: {}'.format((process.stderr.strip().splitlines() or ['exit status {}'.format(
+                process.returncode)])[-1])
+    except subprocess.TimeoutExpired:
+        failure = 'timed out after {} s'.format(args.timeout)
+
+    stages = []
+    if os.path.exists(output):
+        with open(output) as f:
+            stages = [json.loads(line) for line in f]
+    graph = dict((x['name'], x) for x in stages).pop('graph', {})
+    point = {'sweep': sweep, 'atoms': info['atoms'], 'chains': info['chains'], 'interface_target': info['target'],
+             'interface_residues': info['interface_residues'], 'nodes': graph.get('nodes'), 'edges': graph.get('edges')}
+    results = [dict(point, **x) for x in stages if x['name'] != 'graph']
+    if failure is not None:
+        done = set(x['name'] for x in results)
+        pending = [x for x in STAGES if x not in done]
+        if pending:
+            results.append(dict(point, name=pending[0], failed=failure))
+    return results
+
+
+def plot(results, outfile):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('Error: plotting needs matplotlib (pip install matplotlib)')
+        sys.exit(1)
+    figure, axes = plt.subplots(2, 2, figsize=(12, 9))
+    for column, (sweep, x_field, x_label) in enumerate((('atoms', 'atoms', 'atoms'),
+                                                       ('interface', 'interface_residues', 'interface residues (A-B)'))):
+        for row, (y_field, y_label) in enumerate((('seconds', 'seconds'), ('peak_mb', 'peak memory (MB)'))):
+            ax = axes[row][column]
+            for stage in STAGES:
+                points = sorted((x[x_field], x[y_field]) for x in results if x['sweep'] == sweep and
+                                x['name'] == stage and x.get(y_field) is not None)
+                if points:
+                    ax.plot([p[0] for p in points], [p[1] for p in points], marker='o', label=stage)
+                for failed in [x for x in results if x['sweep'] == sweep and x['name'] == stage and 'failed' in x]:
+                    ax.axvline(failed[x_field], color='grey', linestyle=':')
+                    ax.annotate('{} {}'.format(stage, failed['failed'].split(' ')[0]), (failed[x_field], 1),
+                                xycoords=('data', 'axes fraction'), rotation=90, va='top', fontsize=7)
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+            ax.set_xlabel(x_label)
+            ax.set_ylabel(y_label)
+            ax.grid(True, which='both', alpha=0.3)
+    axes[0][0].legend(fontsize=8)
+    figure.tight_layout()
+    figure.savefig(outfile, dpi=120)
+    print('Plot written to {}'.format(outfile))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the pipeline stages on synthetic complexes of growing size')
+    parser.add_argument('--atoms', type=int, nargs='+', default=DEFAULT_ATOMS, help='Atom counts of the atom sweep')
+    parser.add_argument('--base-interface', type=int, default=100, help='Interface residues of the atom sweep')
+    parser.add_argument('--interface', type=int, nargs='+', default=DEFAULT_INTERFACE,
+                        help='Interface residues of the interface sweep')
+    parser.add_argument('--base-atoms', type=int, default=50000, help='Atom count of the interface sweep')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds allowed for all stages of one complex')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='scaling.json')
+    parser.add_argument('--plot', help='Draw the curves to this image file')
+    parser.add_argument('--results', help='Plot the results of an earlier run instead of running')
+    parser.add_argument('--child', nargs=5, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*(args.child + [args.repeat]))
+        return
+    if args.results:
+        if not args.plot:
+            parser.error('--results needs --plot')
+        with open(args.results) as f:
+            plot(json.load(f)['results'], args.plot)
+        return
+
+    points = [('atoms', x, args.base_interface) for x in args.atoms] + \
+             [('interface', args.base_atoms, x) for x in args.interface]
+    results = []
+    scratch = tempfile.mkdtemp(prefix='scaling_')
+    try:
+        for sweep, atoms, interface in points:
+            info = make_complex(os.path.join(scratch, 'synthetic.pdb'), atoms, None, interface, args.seed)
+            info['target'] = interface
+            point = run_point(info, sweep, args, scratch)
+            results += point
+            for entry in point:
+                print('{:9s} {:>7d} atoms {:>5d} interface  {:20s} {}'.format(
+                    sweep, entry['atoms'], entry['interface_residues'], entry['name'],
+                    entry.get('failed') or entry.get('skipped') or
+                    '{:10.3f} s  (peak +{} MB)'.format(entry['seconds'], entry['peak_mb'])))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    import torch
+    with open(args.output, 'w') as f:
+        json.dump({'suite': 'scaling', 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'environment': environment(torch.get_num_threads()),
+                   'config': {'atoms': args.atoms, 'base_interface': args.base_interface, 'interface': args.interface,
+                              'base_atoms': args.base_atoms, 'repeat': args.repeat, 'timeout': args.timeout,
+                              'seed': args.seed},
+                   'results': results}, f, indent=1)
+    print('Results written to {}'.format(args.output))
+    if args.plot:
+        plot(results, args.plot)
+
+if __name__ == "__main__":
+    main()
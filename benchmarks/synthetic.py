@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Synthetic protein complexes of any size, for scaling measurements.
+
+The bundled structures stop at a few thousand atoms. make_complex writes a PDB
+complex of a given number of heavy atoms, chains and interface residues:
+
+    every chain is a block of residues on a cubic lattice (5.4 A apart), each
+    residue a real residue type with its real heavy-atom names, placed on a
+    small grid inside its lattice cell, so the atom density is close to that
+    of a protein core
+    the chains are lined up along x; every chain but the first touches the
+    flat back face of the one before with a square patch of residues that
+    protrudes from its block (3.8 A between the closest atoms, 9.2 A from the
+    rest of the block), so the interface of every neighbouring pair is about
+    --interface residues (residues within 5 A of the other chain) whatever the
+    chain size
+
+PDB residue numbers have four digits, so a chain holds at most 9999 residues
+(about 79,000 atoms); larger complexes need more chains, and make_complex adds
+them when chains is None. <name>_interface.txt next to the PDB file <name>.pdb
+lists the residues within 5 A of another chain, in gen_interface.py's format, and the
+mutation is a residue of chain A at the centre of its interface with chain B.
+
+Usage:
+    python benchmarks/synthetic.py [--atoms 100000] [--chains 2] [--interface 100] [--seed 0] [-o synthetic.pdb]
+"""
+
+import argparse
+import itertools
+import math
+import os
+import string
+import time
+
+import numpy as np
+
+# heavy atoms of each residue after the backbone N, CA, C, O
+SIDE_CHAINS = {
+    'ALA': ['CB'], 'ARG': ['CB', 'CG', 'CD', 'NE', 'CZ', 'NH1', 'NH2'], 'ASN': ['CB', 'CG', 'OD1', 'ND2'],
+    'ASP': ['CB', 'CG', 'OD1', 'OD2'], 'CYS': ['CB', 'SG'], 'GLN': ['CB', 'CG', 'CD', 'OE1', 'NE2'],
+    'GLU': ['CB', 'CG', 'CD', 'OE1', 'OE2'], 'GLY': [], 'HIS': ['CB', 'CG', 'ND1', 'CD2', 'CE1', 'NE2'],
+    'ILE': ['CB', 'CG1', 'CG2', 'CD1'], 'LEU': ['CB', 'CG', 'CD1', 'CD2'], 'LYS': ['CB', 'CG', 'CD', 'CE', 'NZ'],
+    'MET': ['CB', 'CG', 'SD', 'CE'], 'PHE': ['CB', 'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'],
+    'PRO': ['CB', 'CG', 'CD'], 'SER': ['CB', 'OG'], 'THR': ['CB', 'OG1', 'CG2'],
+    'TRP': ['CB', 'CG', 'CD1', 'CD2', 'NE1', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2'],
+    'TYR': ['CB', 'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ', 'OH'], 'VAL': ['CB', 'CG1', 'CG2'],
+}
+RESIDUES = sorted(SIDE_CHAINS)
+ONE_LETTER = dict(zip(RESIDUES, 'ARNDCQEGHILKMFPSTWYV'))
+ATOMS_PER_RESIDUE = 4 + np.mean([len(x) for x in SIDE_CHAINS.values()])
+CELL = 5.4
+# atom sites inside a lattice cell: a 3x3x2 grid, visited so that consecutive atoms are neighbours
+SITES = np.array([(x*1.6, (y if x % 2 == 0 else 2 - y)*1.6, z*2.2)
+                  for z in range(2) for x in range(3) for y in range(3)])
+SITES = np.concatenate([SITES[:9], SITES[9:][::-1]])
+# lattice distance of a patch from the face it touches and from its own chain: the closest atoms
+# of the patch and the face are 3.8 A apart, those of the face and the rest of the chain 9.2 A
+PATCH_GAP = 7.0
+CHAIN_IDS = string.ascii_uppercase + string.ascii_lowercase + string.digits
+MAX_RESIDUES = 9999
+CONTACT = 5.0
+
+
+def contact_masks(coords_a, coords_b, cutoff=CONTACT):
+    """Which atoms of a have an atom of b within cutoff, and which of b have one of a (cell lists)"""
+    near_a = np.zeros(len(coords_a), dtype=bool)
+    near_b = np.zeros(len(coords_b), dtype=bool)
+    if len(coords_a) == 0 or len(coords_b) == 0:
+        return near_a, near_b
+    origin = np.minimum(coords_a.min(0), coords_b.min(0))
+    cells_a = np.floor((coords_a - origin) / cutoff).astype(np.int64)
+    cells_b = np.floor((coords_b - origin) / cutoff).astype(np.int64)
+    span = np.maximum(cells_a.max(0), cells_b.max(0)) + 3
+    keys_b = ((cells_b[:, 0] + 1)*span[1] + cells_b[:, 1] + 1)*span[2] + cells_b[:, 2] + 1
+    order = np.argsort(keys_b, kind='stable')
+    keys_b = keys_b[order]
+    for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+        keys = ((cells_a[:, 0] + 1 + dx)*span[1] + cells_a[:, 1] + 1 + dy)*span[2] + cells_a[:, 2] + 1 + dz
+        start, end = np.searchsorted(keys_b, keys, 'left'), np.searchsorted(keys_b, keys, 'right')
+        counts = end - start
+        if not counts.any():
+            continue
+        first = np.repeat(np.arange(len(coords_a)), counts)
+        second = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        close = ((coords_a[first] - coords_b[second])**2).sum(1) <= cutoff*cutoff
+        near_a[first[close]] = True
+        near_b[second[close]] = True
+    return near_a, near_b
+
+
+def make_complex(outfile, atoms=100000, chains=None, interface=100, seed=0):
+    """
+    Write a synthetic complex of about atoms heavy atoms to outfile and its interface
+    to <outfile stem>_interface.txt in the same directory. Returns a dict with the mutation, partners,
+    chain count, atom and interface residue counts and the interface file.
+    """
+    rng = np.random.RandomState(seed)
+    residues = int(round(atoms / ATOMS_PER_RESIDUE))
+    needed = int(math.ceil(residues / float(MAX_RESIDUES)))
+    chains = max(chains or 2, needed, 2)
+    if chains > len(CHAIN_IDS):
+        raise ValueError('{} atoms need more than {} chains'.format(atoms, len(CHAIN_IDS)))
+    if needed > chains:
+        raise ValueError('{} atoms do not fit {} chains of at most {} residues'.format(atoms, chains, MAX_RESIDUES))
+    per_chain = residues // chains
+    # about as many residues of the face touch the patch as the patch has
+    patch = max(int(round(math.sqrt(interface / 2.0))), 1)
+    side = max(int(math.ceil(per_chain ** (1/3.0))), patch)
+    low = (side - patch) // 2
+
+    lines, coords, owners = [], [], []
+    serial, origin_x = 0, 0.0
+    mutation = None
+    for c in range(chains):
+        chain = CHAIN_IDS[c]
+        # the patch is layer 0 of every chain but the first; the back layer is always full,
+        # so the next chain's patch faces residues, and a partial layer goes to the front
+        cells = [(0, y, z) for y in range(low, low + patch) for z in range(low, low + patch)] if c > 0 else []
+        first = 1 if c > 0 else 0
+        inner = max(per_chain - len(cells), side*side)
+        layers = int(math.ceil(inner / float(side*side)))
+        back = first + layers - 1
+        block = [(x, y, z) for x in range(back, first - 1, -1) for y in range(side) for z in range(side)][:inner]
+        cells += sorted(block)
+        names = rng.randint(len(RESIDUES), size=len(cells))
+        for number, ((x, y, z), name) in enumerate(zip(cells, names), 1):
+            resname = RESIDUES[name]
+            corner = np.array([origin_x + (x*CELL if c == 0 or x == 0 else PATCH_GAP + (x - 1)*CELL), y*CELL, z*CELL])
+            if c == 0 and x == back and y == low + patch // 2 and z == low + patch // 2:
+                mutation = '{}{}{}{}'.format(ONE_LETTER[resname], chain, number, 'G' if resname == 'ALA' else 'A')
+            for atom, site in zip(['N', 'CA', 'C', 'O'] + SIDE_CHAINS[resname], SITES):
+                serial += 1
+                x_, y_, z_ = corner + site + rng.uniform(-0.15, 0.15, 3)
+                lines.append('ATOM  {:>5d} {:<4s} {:>3s} {}{:>4d}    {:8.3f}{:8.3f}{:8.3f}  1.00  0.00          {:>2s}\n'.format(
+                    serial % 100000, ' ' + atom if len(atom) < 4 else atom, resname, chain, number,
+                    x_, y_, z_, atom[0]))
+                coords.append((x_, y_, z_))
+                owners.append((c, number))
+        lines.append('TER\n')
+        # the next chain's patch starts PATCH_GAP after this chain's back layer
+        origin_x += (back*CELL if c == 0 else PATCH_GAP + (back - 1)*CELL) + PATCH_GAP
+    lines.append('END\n')
+    with open(outfile, 'w') as f:
+        f.writelines(lines)
+
+    coords = np.array(coords)
+    owners = np.array(owners)
+    interface_lines = []
+    for c in range(chains - 1):
+        first, second = owners[:, 0] == c, owners[:, 0] == c + 1
+        near_a, near_b = contact_masks(coords[first], coords[second])
+        pair = '{}_{}'.format(CHAIN_IDS[c], CHAIN_IDS[c + 1])
+        for side, mask, near in ((CHAIN_IDS[c], first, near_a), (CHAIN_IDS[c + 1], second, near_b)):
+            for number in dict.fromkeys(owners[mask][near, 1].tolist()):
+                interface_lines.append('{}_{}_{}'.format(pair, side, number))
+    interfacefile = os.path.splitext(os.path.abspath(outfile))[0] + '_interface.txt'
+    with open(interfacefile, 'w') as f:
+        f.write('\n'.join(interface_lines) + '\n')
+    interface_ab = sum(line.startswith('A_B_') for line in interface_lines)
+    return {'pdb': outfile, 'interface_file': interfacefile, 'mutation': mutation,
+            'partners': 'A_' + CHAIN_IDS[1:chains], 'chains': chains, 'atoms': len(coords),
+            'residues': int(owners.shape[0] and len(set(map(tuple, owners.tolist())))),
+            'interface_residues': interface_ab}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic protein complex')
+    parser.add_argument('--atoms', type=int, default=100000, help='Heavy atoms (approximately)')
+    parser.add_argument('--chains', type=int, help='Chains (default: 2, or as many as the atoms need)')
+    parser.add_argument('--interface', type=int, default=100, help='Interface residues of each neighbouring chain pair')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='synthetic.pdb')
+    args = parser.parse_args()
+
+    start = time.time()
+    info = make_complex(args.output, args.atoms, args.chains, args.interface, args.seed)
+    print('{} atoms, {} residues in {} chains written to {} in {:.1f} s'.format(
+        info['atoms'], info['residues'], info['chains'], info['pdb'], time.time() - start))
+    print('{} interface residues between A and B (interface in {})'.format(info['interface_residues'],
+                                                                         info['interface_file']))
+    print('Example: python run.py {} {} {}'.format(info['pdb'], info['mutation'], info['partners']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Recall of the in-graph triage ranking (triage.py) against full FoldX runs.
+
+Every substitution at the mutated positions of a benchmark set is predicted
+by triage, with and without --trim, and by the full path of pipeline.py. For
+each k, recall@k is the fraction of the k best substitutions of a position
+under the full predictions that are among the k best under triage, averaged
+over positions. The report also gives the Spearman correlation of the two
+rankings and the time per substitution of each tier.
+
+Usage:
+    python benchmarks/triage_recall.py --pdb-dir PDBS [--dataset data/benchmarkDatasets/S1131.csv]
+                                       [--positions 50] [--k 1 3 5] [--rank-by magnitude]
+                                       [--graph-store DIR] [-o triage_recall.json]
+
+    # run from the GeoPPI directory; needs FoldX, PyMOL and the benchmark structures
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def spearman(x, y):
+    rx, ry = np.argsort(np.argsort(x)), np.argsort(np.argsort(y))
+    if len(x) < 3 or rx.std() == 0:
+        return None
+    return float(np.corrcoef(rx, ry)[0, 1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall of triage rankings against full FoldX runs')
+    parser.add_argument('--dataset', default='data/benchmarkDatasets/S1131.csv')
+    parser.add_argument('--pdb-dir', required=True, help='Directory with the benchmark structures ({pdb}.pdb)')
+    parser.add_argument('--positions', type=int, default=50, help='Evaluate at most this many positions')
+    parser.add_argument('--k', nargs='+', type=int, default=[1, 3, 5])
+    parser.add_argument('--rank-by', choices=['magnitude', 'destabilizing', 'stabilizing'], default='magnitude')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--graph-store', metavar='DIR', help='Reuse the full-path graphs of earlier runs')
+    parser.add_argument('--scratch', default='triage_recall_tmp')
+    parser.add_argument('-o', '--output', help='Also write the report as JSON')
+    args = parser.parse_args()
+
+    from datasets import read_benchmark
+    from pipeline import Job, StructureBuilder, run_pipeline
+    from run import load_models
+    from triage import select, triage
+
+    positions = []
+    for entry in read_benchmark(args.dataset, args.pdb_dir):
+        position = (entry.pdbfile, entry.partners, entry.mutations[0][:-1])
+        if entry.pdbfile is not None and position not in positions:
+            positions.append(position)
+    positions = positions[:args.positions]
+    if not positions:
+        print('Error: no structures of {} found in {}'.format(args.dataset, args.pdb_dir))
+        sys.exit(1)
+    model, forest, sorted_idx = load_models()
+    builder = StructureBuilder(args.scratch)
+
+    # the wildtype models are built once and shared by all three runs; time them apart
+    start = time.time()
+    for pdbfile, partners, site in positions:
+        try:
+            builder.position(pdbfile, partners, site[0], site[1], site[2:])
+        except Exception as e:
+            print('  {} {}: {}'.format(pdbfile, site, e))
+    wildtype_seconds = time.time() - start
+
+    runs, seconds = {}, {}
+    for trim in (False, True):
+        start = time.time()
+        runs[trim] = triage(positions, model, forest, sorted_idx, builder, args.foldx_workers,
+                            args.feature_workers, trim)
+        seconds[trim] = time.time() - start
+    rows = runs[False]
+    jobs = [Job(i, pdbfile, mutation, partners) for i, (pdbfile, mutation, partners, _, _) in enumerate(rows)]
+    start = time.time()
+    results, _, _ = run_pipeline(jobs, model, forest, sorted_idx, args.foldx_workers, args.feature_workers,
+                                 graph_store=args.graph_store, scratch=args.scratch, keep_scratch=True, verbose=False,
+                                 builder=builder)
+    seconds['full'] = time.time() - start
+    shutil.rmtree(args.scratch, ignore_errors=True)
+    full = dict(((job.pdbfile, job.mutation, job.partners), job.ddg) for job in results if job.error is None)
+
+    report = {'dataset': args.dataset, 'positions': len(positions), 'rank_by': args.rank_by,
+              'wildtype_seconds': wildtype_seconds, 'modes': {}}
+    reference = select([(p, m, q, full.get((p, m, q)), None) for p, m, q, _, _ in rows], rank_by=args.rank_by)
+    print('\n{:>8s} {:>10s} {:>10s} '.format('mode', 'spearman', 's/subst') +
+          ' '.join('{:>9s}'.format('recall@{}'.format(k)) for k in args.k))
+    for mode, label in ((False, 'plain'), (True, 'trim'), ('full', 'full')):
+        triaged = rows if mode == 'full' else runs[mode]
+        if mode == 'full':
+            ranking = reference
+        else:
+            # only positions and substitutions that both tiers scored
+            ranking = select([row for row in triaged if (row[0], row[1], row[2]) in full], rank_by=args.rank_by)
+        recall = dict((k, []) for k in args.k)
+        correlations = []
+        for pdbfile, partners, site in positions:
+            mine = [row[1] for row in ranking if row[0] == pdbfile and row[2] == partners and row[1][:-1] == site]
+            truth = [row[1] for row in reference if row[0] == pdbfile and row[2] == partners and row[1][:-1] == site]
+            if not truth or not mine:
+                continue
+            for k in args.k:
+                recall[k].append(len(set(mine[:k]) & set(truth[:k]))/float(min(k, len(truth))))
+            correlations.append(spearman([mine.index(x) for x in truth if x in mine], range(len(truth))))
+        correlations = [x for x in correlations if x is not None]
+        result = {
+            'spearman': float(np.mean(correlations)) if correlations else None,
+            'seconds_per_substitution': seconds[mode]/max(len(rows), 1),
+            'recall': dict((str(k), float(np.mean(values)) if values else None) for k, values in recall.items()),
+        }
+        report['modes'][label] = result
+        print('{:>8s} {:>10s} {:>10.3f} '.format(label, 'n/a' if result['spearman'] is None else '{:.3f}'.format(result['spearman']),
+                                                  result['seconds_per_substitution']) +
+              ' '.join('{:>9s}'.format('n/a' if result['recall'][str(k)] is None else '{:.3f}'.format(result['recall'][str(k)]))
+                       for k in args.k))
+    print('Wildtype models (shared by all modes): {:.1f} s'.format(wildtype_seconds))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Report written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
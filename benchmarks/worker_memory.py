@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Memory of pipeline.py's feature stage as feature workers are added.
+
+For every --workers count, in a fresh process, the suite loads the encoder as
+the inference process does, starts the feature pool (spawned processes with
+pipeline._init_feature_worker) and the shared-memory slots, and featurizes
+the committed fixtures (benchmarks/fixtures) through featurize_shared until
+every worker has built graphs. It then records the resident memory of the
+inference process and of each worker:
+
+    rss    VmRSS, counting the pages processes share (e.g. the torch
+           libraries) once per process
+    pss    proportional set size (/proc/<pid>/smaps_rollup), dividing shared
+           pages between the processes that map them; the sum over all
+           processes is what the node actually spends
+    peak   VmHWM of each worker
+
+The report gives the totals and the cost of each worker beyond the first.
+Workers import torch (gen_graph_data builds tensors), so that cost is not
+zero; the shared-memory slots only keep the graphs from being copied into
+the inference process.
+
+Usage:
+    python benchmarks/worker_memory.py [--workers 1 2 4 8] [--jobs-per-worker 2] [-o worker_memory.json]
+
+    # run from the GeoPPI directory; Linux only
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from hotpaths import CASES, FIXTURES, ROOT, environment, load_fixture
+
+DEFAULT_WORKERS = [1, 2, 4, 8]
+
+
+def _kb_field(path, field):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+
+def process_memory(pid):
+    """rss, pss and peak of a process in MB"""
+    status = '/proc/{}/status'.format(pid)
+    return {'rss': _kb_field(status, 'VmRSS') / 1024,
+            'pss': _kb_field('/proc/{}/smaps_rollup'.format(pid), 'Pss') / 1024,
+            'peak': _kb_field(status, 'VmHWM') / 1024}
+
+
+def child(workers, jobs_per_worker):
+    """Measure one worker count in this process; prints one JSON line"""
+    from pipeline import _init_feature_worker, featurize_shared
+    from run import load_models
+    from shared_graphs import SharedGraphSlots
+
+    # the inference process holds the encoder (the GBT adds little)
+    model, _, _ = load_models(precision=os.environ.get('GEOPPI_PRECISION', 'fp32'), regressor=False)
+    inputs = []
+    for name, pdbfile, mutation, partners in CASES:
+        if os.path.exists(os.path.join(FIXTURES, name, 'wildtype.pdb')):
+            wildtypefile, mutantfile, interfacefile, _ = load_fixture(name, os.path.join(ROOT, pdbfile), mutation,
+                                                                      partners, None)
+            graph_mutinfo = ['{}_{}'.format(mutation[1], mutation[2:-1])]
+            inputs.append((wildtypefile, mutantfile, interfacefile, graph_mutinfo, partners))
+    if not inputs:
+        raise SystemExit('no fixtures in {}; build them with python benchmarks/hotpaths.py --build-fixtures'.format(
+            FIXTURES))
+
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_feature_worker)
+    slots = SharedGraphSlots(workers, 64 << 20)
+    try:
+        jobs = [inputs[i % len(inputs)] for i in range(workers*jobs_per_worker)]
+        # one job per slot at a time, as Featurizer does
+        for start in range(0, len(jobs), workers):
+            futures = [pool.submit(featurize_shared, slots.name, slot, slots.slot_bytes, *args)
+                       for slot, args in enumerate(jobs[start:start + workers])]
+            for future in futures:
+                future.result()
+        inference = process_memory(os.getpid())
+        worker_memory = [process_memory(pid) for pid in pool._processes]
+    finally:
+        pool.shutdown()
+        slots.close()
+    print(json.dumps({'workers': workers, 'jobs': len(jobs), 'inference': inference, 'workers_memory': worker_memory}))
+
+
+def measure(workers, jobs_per_worker):
+    command = [sys.executable, os.path.abspath(__file__), '--child', str(workers),
+               '--jobs-per-worker', str(jobs_per_worker)]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+                             cwd=ROOT, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def summarize(point):
+    workers = point['workers_memory']
+    point['total_rss'] = point['inference']['rss'] + sum(x['rss'] for x in workers)
+    point['total_pss'] = point['inference']['pss'] + sum(x['pss'] for x in workers)
+    point['worker_pss'] = sum(x['pss'] for x in workers) / len(workers)
+    point['worker_peak'] = max(x['peak'] for x in workers)
+    return point
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory of the feature stage with 1, 2, 4 and 8 workers')
+    parser.add_argument('--workers', nargs='+', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--jobs-per-worker', type=int, default=2)
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('-o', '--output', default='worker_memory.json')
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.jobs_per_worker)
+        return
+
+    import torch
+    points = []
+    print('{:>7s} {:>14s} {:>14s} {:>14s} {:>16s} {:>16s}'.format(
+        'workers', 'inference MB', 'total RSS MB', 'total PSS MB', 'PSS/worker MB', 'worker peak MB'))
+    for workers in args.workers:
+        point = summarize(measure(workers, args.jobs_per_worker))
+        points.append(point)
+        print('{:7d} {:14.0f} {:14.0f} {:14.0f} {:16.0f} {:16.0f}'.format(
+            workers, point['inference']['pss'], point['total_rss'], point['total_pss'], point['worker_pss'],
+            point['worker_peak']))
+    if len(points) > 1:
+        first, last = points[0], points[-1]
+        print('Each worker beyond the first adds {:.0f} MB PSS ({:.0f} MB RSS)'.format(
+            (last['total_pss'] - first['total_pss']) / (last['workers'] - first['workers']),
+            (last['total_rss'] - first['total_rss']) / (last['workers'] - first['workers'])))
+
+    with open(args.output, 'w') as f:
+        json.dump({'suite': 'worker_memory', 'environment': environment(torch.get_num_threads()),
+                   'jobs_per_worker': args.jobs_per_worker, 'results': points}, f, indent=1)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Cropped-complex FoldX builds.
+
+build_graph only keeps atoms within max_dis (12 A) of the interface and the
+mutation site, but FoldX BuildModel reads and repairs the whole complex, so on
+large assemblies most of its time goes to residues the graph never sees. In
+cropped mode FoldX is given only the residues within a shell around those
+sites (chain IDs and residue numbering unchanged), and the models it builds
+are spliced back into the full structure. Residues outside the shell keep their
+input coordinates, and the residue order that build_graph's residue-index
+features are based on is preserved.
+
+The shell should exceed max_dis, so that residues at the edge of the graph
+keep the neighbours FoldX packs them against; benchmarks/crop_accuracy.py
+compares cropped against full builds on a benchmark set.
+"""
+
+import numpy as np
+
+DEFAULT_SHELL = 20.0
+
+
+def residue_key(line):
+    """(chain, residue number with insertion code) of an ATOM/HETATM record"""
+    return line[21], line[22:27].strip()
+
+
+def read_records(pdbfile):
+    with open(pdbfile) as f:
+        return [line for line in f.read().splitlines() if line[0:6] in ('ATOM  ', 'HETATM')]
+
+
+def crop_structure(pdbfile, outfile, sites, shell=DEFAULT_SHELL, chunk=1024):
+    """
+    Write the residues of pdbfile with any atom within shell A of a site residue.
+    sites are chain_resid tokens as used by build_graph (e.g. I_17).
+    Returns the number of residues kept.
+    """
+    records = read_records(pdbfile)
+    keys = [residue_key(line) for line in records]
+    coords = np.array([[float(line[30:38]), float(line[38:46]), float(line[46:54])] for line in records])
+
+    site_keys = set(tuple(x.split('_', 1)) for x in sites)
+    centers = coords[[i for i, key in enumerate(keys) if key in site_keys]]
+    if len(centers) == 0:
+        raise ValueError('None of the sites {} are in {}'.format(', '.join(sites), pdbfile))
+
+    # squared distances as |a|^2 + |b|^2 - 2ab, a block of atoms at a time
+    near = np.zeros(len(records), dtype=bool)
+    center_norm = (centers**2).sum(1)
+    for start in range(0, len(records), chunk):
+        block = coords[start:start + chunk]
+        d2 = (block**2).sum(1)[:, None] + center_norm[None, :] - 2*block.dot(centers.T)
+        near[start:start + chunk] = (d2 <= shell*shell).any(1)
+
+    kept = set(key for key, flag in zip(keys, near) if flag)
+    with open(outfile, 'w') as f:
+        previous_chain = None
+        for line, key in zip(records, keys):
+            if key not in kept:
+                continue
+            if previous_chain is not None and key[0] != previous_chain:
+                f.write('TER\n')
+            previous_chain = key[0]
+            f.write(line + '\n')
+        f.write('TER\nEND\n')
+    return len(kept)
+
+
+def splice_structure(fullfile, modelfile, outfile):
+    """
+    Replace the residues of fullfile that modelfile contains by the model's
+    atoms, in the order of fullfile, and write the ATOM records to outfile.
+    """
+    model = {}
+    for line in read_records(modelfile):
+        model.setdefault(residue_key(line), []).append(line)
+
+    lines, written = [], set()
+    for line in read_records(fullfile):
+        key = residue_key(line)
+        if key in model:
+            if key not in written:
+                lines += model[key]
+                written.add(key)
+        else:
+            lines.append(line)
+
+    with open(outfile, 'w') as f:
+        f.write('\n'.join(lines) + '\nEND\n')
@@ -0,0 +1,78 @@
+"""
+Readers for the bundled test examples and benchmark sets.
+
+The benchmark CSVs in data/benchmarkDatasets use different column layouts
+(S4169/S1131/S641: protein, Partners(A_B), mutation, DDG; S645/M1101:
+#PDB, ..., Mutation, ddG(kcal/mol); M1707: PDB id, Partner1, ...,
+Mutation(s)_cleaned, DDGexp) and two mutation notations (A:D8A and DA8A).
+read_benchmark normalizes every row to run.py's mutation format.
+"""
+
+import csv
+import os
+from collections import namedtuple
+
+# (pdb file, mutation, partners) of the examples in readme.md
+TEST_EXAMPLES = [
+    ('data/testExamples/1PPF.pdb', 'TI17R', 'E_I'),
+    ('data/testExamples/1CZ8.pdb', 'KW84A', 'WV_HL'),
+    ('data/testExamples/1CSE.pdb', 'LI38I', 'E_I'),
+    ('data/testExamples/3SGB.pdb', 'KI7L', 'E_I'),
+    ('data/testExamples/3BT1.pdb', 'PU149A', 'U_A'),
+]
+
+BenchmarkEntry = namedtuple("BenchmarkEntry", ["pdb", "partners", "mutations", "ddg", "pdbfile"])
+
+
+def normalize_mutation(token):
+    """Convert A:D8A or DA8A to run.py's format (wildtype, chain, residue index, mutant)"""
+    token = token.strip()
+    if ':' in token:
+        chain, rest = token.split(':', 1)
+        return '{}{}{}'.format(rest[0], chain, rest[1:])
+    return token
+
+
+def _find_column(header, *keywords):
+    for keyword in keywords:
+        for i, name in enumerate(header):
+            if keyword in name.lower():
+                return i
+    raise ValueError('No column matching {} in {}'.format(keywords, header))
+
+
+def read_benchmark(csvfile, pdb_dir=None, single_only=True, limit=None):
+    """
+    Yield a BenchmarkEntry per row of a benchmark CSV.
+    pdbfile is {pdb_dir}/{pdb}.pdb, or None when pdb_dir is not given or the structure is missing.
+    """
+    with open(csvfile, newline='', encoding='utf-8-sig', errors='replace') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        mut_col = _find_column(header, 'cleaned', 'mutation')
+        ddg_col = _find_column(header, 'ddgexp', 'ddg')
+
+        count = 0
+        for row in reader:
+            if not row:
+                continue
+            mutations = [normalize_mutation(x) for x in row[mut_col].split(',') if x.strip()]
+            if single_only and len(mutations) != 1:
+                continue
+
+            pdb = row[0].strip()
+            pdbfile = None
+            if pdb_dir is not None:
+                candidate = os.path.join(pdb_dir, '{}.pdb'.format(pdb))
+                if os.path.exists(candidate):
+                    pdbfile = candidate
+
+            try:
+                ddg = float(row[ddg_col])
+            except ValueError:
+                ddg = None
+
+            yield BenchmarkEntry(pdb, row[1].strip(), mutations, ddg, pdbfile)
+            count += 1
+            if limit is not None and count >= limit:
+                break
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Double-mutant scans of interface positions, for epistasis.
+
+Scoring every pair of substitutions through run.py repeats interface
+detection, both FoldX builds, both graphs and both encoder passes for each
+pair. Here the pairs are grouped by their two positions:
+
+    structures  interface detection once per structure; per position pair,
+                one FoldX BuildModel call builds the wildtype (both
+                positions mutated to themselves) and the double mutants,
+                --foldx-batch of them per call, several calls in parallel
+    features    gen_graph_data of every model, in worker processes
+    inference   the wildtype graph of a position pair is embedded once and
+                shared by all its double mutants, which are pooled and
+                scored through the GBT in batches
+
+Pairs are chosen from candidate single mutations: every substitution at
+--positions, or the mutations of a single-mutant scan (--singles, the output
+of pipeline.py, triage.py or adaptive_scan.py), optionally cut to the --top
+largest |ddG|. --pairs all combines every two candidates at different
+positions; --pairs adjacent only those whose residues have heavy atoms
+within --distance A of each other. With --singles, the output also gives the
+single ddGs and the epistasis ddG(AB) - ddG(A) - ddG(B).
+
+Usage:
+    python doubles.py [pdb file] [partnerA_partnerB] (--positions "TI17 LI18" | --singles scan.csv)
+                      [--pairs all|adjacent] [--distance 8] [--top N] [--substitutions AVDE]
+                      [--foldx-workers N] [--feature-workers N] [--foldx-batch 50] [-o FILE]
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import os.path as path
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from run import AMINO_ACIDS, run_foldx
+
+
+def residue_coords(pdbfile):
+    """chain_resid -> heavy-atom coordinates"""
+    from crop import read_records, residue_key
+    coords = {}
+    for line in read_records(pdbfile):
+        if line[0:4] == 'ATOM' and not line[12:16].strip().startswith('H'):
+            coords.setdefault('_'.join(residue_key(line)), []).append(
+                [float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return dict((key, np.array(value)) for key, value in coords.items())
+
+
+def select_pairs(singles, mode='all', coords=None, distance=8.0):
+    """Pairs of single mutations at different positions; adjacent pairs need coords from residue_coords"""
+    pairs = []
+    for first, second in itertools.combinations(singles, 2):
+        if first[:-1] == second[:-1]:
+            continue
+        if mode == 'adjacent':
+            a = coords.get('{}_{}'.format(first[1], first[2:-1]))
+            b = coords.get('{}_{}'.format(second[1], second[2:-1]))
+            if a is None or b is None or ((a[:, None, :] - b[None, :, :])**2).sum(2).min() > distance*distance:
+                continue
+        pairs.append(order_pair(first, second))
+    return pairs
+
+
+def order_pair(first, second):
+    """The two single mutations of a double mutant ordered by position, so that a position pair has one order"""
+    return tuple(sorted((first, second), key=lambda x: x[:-1]))
+
+
+def build_pair(builder, pdbfile, partners, sites, mutations, workdir, foldx_batch):
+    """
+    FoldX models of the wildtype of two positions (sites, e.g. TI17 and LI18) and of the double
+    mutants; returns the wildtype model and one model per mutation, in order.
+    """
+    structdir, name = builder.structure(pdbfile, partners)
+    stem = name.split('.')[0]
+    wildtype = ','.join(site + site[0] for site in sites)
+    models = []
+    for start in range(0, len(mutations), foldx_batch):
+        chunk = mutations[start:start + foldx_batch]
+        lines = ([wildtype] if start == 0 else []) + chunk
+        chunkdir = path.join(workdir, 'batch{}'.format(start // foldx_batch))
+        os.makedirs(chunkdir, exist_ok=True)
+        run_foldx(name, lines, chunkdir, listfile=path.join(chunkdir, 'individual_list.txt'), pdb_dir=structdir)
+        built = [path.join(chunkdir, '{}_{}.pdb'.format(stem, i + 1)) for i in range(len(lines))]
+        missing = [x for x, model in zip(lines, built) if not path.exists(model)]
+        if missing:
+            raise RuntimeError('FoldX did not build {} (see {}/foldx.log)'.format(', '.join(missing), chunkdir))
+        models += built
+    return models[0], models[1:], path.join(structdir, 'interface.txt')
+
+
+def featurize_models(modelfiles, interfacefile, mutinfo, partners, cutoff=3):
+    """gen_graph_data of several models of one position pair; returns [A, E] of each; runs in a worker process"""
+    from run import gen_graph_data
+    graphs = []
+    for modelfile in modelfiles:
+        graph = gen_graph_data(modelfile, mutinfo, interfacefile, cutoff, partners)
+        if graph is None:
+            raise ValueError('fewer than 5 atoms near the interface')
+        graphs.append(graph[:2])
+    return graphs
+
+
+def scan_pairs(pairs, pdbfile, partners, model, forest, sorted_idx, builder, scratch, foldx_workers=4,
+               feature_workers=2, foldx_batch=50, batch_size=64, cache=None):
+    """
+    Predict double mutants, pairs of single mutations such as (TI17R, LI18A); returns [(mutation, ddG, error)].
+    With cache (prediction_cache.open_cache), cached double mutants are not built, and new ddGs are saved.
+    """
+    import torch
+    from models import FeaturePlan, n_selected, GeoPPIpredictShared
+    from pipeline import _init_feature_worker
+
+    # one order per position pair: one wildtype build and embedding, one name per double mutant
+    pairs = list(dict.fromkeys(order_pair(*pair) for pair in pairs))
+    mutations = ['{},{}'.format(first, second) for first, second in pairs]
+    cached = [None]*len(pairs) if cache is None else cache.lookup([(pdbfile, x, partners) for x in mutations])
+    results = [(mutation, ddg, None) for mutation, ddg in zip(mutations, cached) if ddg is not None]
+    groups = {}
+    for (first, second), mutation, ddg in zip(pairs, mutations, cached):
+        if ddg is None:
+            groups.setdefault((first[:-1], second[:-1]), []).append(mutation)
+    pool = ProcessPoolExecutor(feature_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_feature_worker)
+
+    def build(index, sites, mutations):
+        workdir = path.join(scratch, 'pair{}'.format(index))
+        wildtype, mutants, interfacefile = build_pair(builder, pdbfile, partners, sites, mutations, workdir, foldx_batch)
+        mutinfo = ['{}_{}'.format(site[1], site[2:]) for site in sites]
+        # wildtype first, so that it can be embedded while the mutants are featurized
+        chunks = [[wildtype]] + [mutants[i:i + batch_size] for i in range(0, len(mutants), batch_size)]
+        return [pool.submit(featurize_models, chunk, interfacefile, mutinfo, partners) for chunk in chunks]
+
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+    with ThreadPoolExecutor(foldx_workers) as threads:
+        futures = [threads.submit(build, i, sites, mutations) for i, (sites, mutations) in enumerate(groups.items())]
+        for (sites, mutations), future in zip(groups.items(), futures):
+            try:
+                chunks = future.result()
+                [(A, E)] = chunks[0].result()
+                # reused for every chunk, so it must not hold on to the autograd graph
+                with torch.no_grad():
+                    embedding = model.embed(A, E) if hasattr(model, 'pool_features') else None
+                ddgs = []
+                for chunk in chunks[1:]:
+                    ddgs += GeoPPIpredictShared(A, E, chunk.result(), model, forest, sorted_idx, plan, embedding)
+                results += [(mutation, ddg, None) for mutation, ddg in zip(mutations, ddgs)]
+                if cache is not None:
+                    cache.add([(pdbfile, mutation, partners, ddg) for mutation, ddg in zip(mutations, ddgs)])
+            except Exception as e:
+                results += [(mutation, None, str(e)) for mutation in mutations]
+            print('{} {}: {} double mutants'.format(*sites, len(mutations)))
+    pool.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict double mutants of interface positions')
+    parser.add_argument('pdbfile')
+    parser.add_argument('partners', help='Binding partners, e.g. E_I')
+    parser.add_argument('--positions', help='Positions such as "TI17 LI18"; every --substitutions at each is a candidate')
+    parser.add_argument('--substitutions', default=AMINO_ACIDS)
+    parser.add_argument('--singles', metavar='CSV', help='Candidates from a single-mutant scan (pdb, mutation, partners, ddg)')
+    parser.add_argument('--top', type=int, help='Keep the N candidates with the largest |ddG| (needs --singles)')
+    parser.add_argument('--pairs', choices=['all', 'adjacent'], default='all')
+    parser.add_argument('--distance', type=float, default=8.0, help='Heavy-atom distance of adjacent positions (A)')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--foldx-batch', type=int, default=50, help='Double mutants per FoldX call')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--cache', metavar='FILE', help='Prediction cache (default: $GEOPPI_CACHE)')
+    parser.add_argument('--scratch', default='doubles_tmp')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    from pipeline import StructureBuilder
+    from run import load_models, validate_inputs
+
+    single_ddgs = {}
+    if args.singles:
+        from adaptive_scan import read_rows
+        for pdb, mutation, partners, ddg in read_rows(args.singles):
+            if path.basename(pdb) == path.basename(args.pdbfile) and partners == args.partners and ddg is not None:
+                single_ddgs[mutation] = ddg
+        candidates = [x for x in single_ddgs if x[0] != x[-1]]
+        if args.positions:
+            candidates = [x for x in candidates if x[:-1] in args.positions.split()]
+    elif args.positions:
+        candidates = [site + x for site in args.positions.split() for x in args.substitutions if x != site[0]]
+    else:
+        parser.error('give --positions or --singles')
+    if args.top:
+        if not single_ddgs:
+            parser.error('--top needs --singles')
+        candidates = sorted(candidates, key=lambda x: -abs(single_ddgs[x]))[:args.top]
+    for site in sorted(set(x[:-1] for x in candidates)):
+        problems = validate_inputs(args.pdbfile, site + site[0], args.partners)
+        if problems:
+            parser.error('; '.join(problems))
+
+    pairs = select_pairs(candidates, args.pairs, residue_coords(args.pdbfile) if args.pairs == 'adjacent' else None,
+                         args.distance)
+    print('{} candidate single mutations, {} double mutants at {} position pairs'.format(
+        len(candidates), len(pairs), len(set((a[:-1], b[:-1]) for a, b in pairs))))
+    if not pairs:
+        return
+
+    from prediction_cache import open_cache
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    model, forest, sorted_idx = load_models(precision=precision)
+    cache = open_cache(args.cache, precision)
+    builder = StructureBuilder(args.scratch)
+    start = time.time()
+    results = scan_pairs(pairs, args.pdbfile, args.partners, model, forest, sorted_idx, builder, builder.scratch,
+                         args.foldx_workers, args.feature_workers, args.foldx_batch, args.batch_size, cache)
+    wall = time.time() - start
+    if not args.keep:
+        shutil.rmtree(args.scratch, ignore_errors=True)
+
+    output = args.output or path.basename(args.pdbfile).split('.')[0] + '_doubles_ddg.csv'
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pdb', 'mutation', 'partners', 'ddg', 'ddg_first', 'ddg_second', 'epistasis', 'error'])
+        for mutation, ddg, error in results:
+            first, second = [single_ddgs.get(x) for x in mutation.split(',')]
+            epistasis = None if None in (ddg, first, second) else round(ddg - first - second, 2)
+            writer.writerow([args.pdbfile, mutation, args.partners, '' if ddg is None else ddg,
+                             '' if first is None else first, '' if second is None else second,
+                             '' if epistasis is None else epistasis, error or ''])
+    print('{} double mutants in {:.1f} s ({:.2f} per minute)'.format(len(results), wall, 60*len(results)/max(wall, 1e-9)))
+    if cache is not None:
+        print(cache.summary())
+    print('Results written to {}'.format(output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Ensemble prediction: one mutation across every model of a structure.
+
+NMR-style files hold several MODEL ... ENDMDL blocks (or several
+pdbx_PDB_model_num values in mmCIF), and structure predictors write several
+ranked models. run.py reads all ATOM records of a PDB file as one structure,
+so it refuses multi-model files (validate_inputs). Here the models of a file
+are written out as PDB members, or the PDB and mmCIF files of a directory
+(e.g. AlphaFold 3 output) are the members, and every (member, mutation) pair
+goes through pipeline.py in a single run: interface detection and FoldX
+builds of different members run in parallel, and the encoder scores all
+members in shared batches.
+
+The output has one row per mutation: the mean ddG over the members that
+succeeded, its standard deviation, minimum and maximum, and the ddG of each
+member.
+
+Usage:
+    python ensemble.py [pdb or mmCIF file, or directory] "[mutations]" [partnerA_partnerB] [pipeline.py options] [-o FILE]
+    python ensemble.py nmr_models.pdb "TI17R TI17A" E_I
+    python ensemble.py af3_models/ KW84A WV_HL
+"""
+
+import argparse
+import csv
+import glob
+import os
+import os.path as path
+import shutil
+
+import numpy as np
+
+from run import CIF_SUFFIXES
+
+
+def split_models(pdbfile, outdir):
+    """
+    Write each MODEL of pdbfile to outdir/[name]_model[n].pdb; returns the files, in order.
+    A file with fewer than two models is its own only member.
+    """
+    stem = path.basename(pdbfile).split('.')[0]
+    if pdbfile.endswith(CIF_SUFFIXES):
+        from mmcif import model_atom_sites, write_pdb_columns
+        # the file is parsed once; every member is written from its columns
+        models = model_atom_sites(pdbfile)
+        if len(models) < 2:
+            return [pdbfile]
+        members = []
+        for model, columns in models:
+            member = path.join(outdir, '{}_model{}.pdb'.format(stem, model))
+            write_pdb_columns(columns, member)
+            members.append(member)
+        return members
+    members, lines, model = [], [], None
+    with open(pdbfile) as f:
+        for line in f:
+            if line[0:6] == 'MODEL ':
+                model, lines = line[10:14].strip() or str(len(members) + 1), []
+            elif line[0:6] == 'ENDMDL' and model is not None:
+                member = path.join(outdir, '{}_model{}.pdb'.format(stem, model))
+                with open(member, 'w') as out:
+                    out.writelines(lines + ['END\n'])
+                members.append(member)
+                model = None
+            elif model is not None and line[0:6] in ('ATOM  ', 'HETATM', 'TER   ', 'TER\n'):
+                lines.append(line)
+    return members if len(members) > 1 else [pdbfile]
+
+
+def ensemble_members(source, outdir):
+    """Member structure files of a multi-model file or a directory of structures"""
+    if path.isdir(source):
+        return sorted(x for suffix in ('.pdb',) + CIF_SUFFIXES for x in glob.glob(path.join(source, '*' + suffix)))
+    os.makedirs(outdir, exist_ok=True)
+    return split_models(source, outdir)
+
+
+def summarize(ddgs):
+    """mean, standard deviation, minimum and maximum of the ddGs that are not None"""
+    values = np.array([x for x in ddgs if x is not None], dtype=float)
+    if len(values) == 0:
+        return None, None, None, None
+    return (round(float(values.mean()), 2), round(float(values.std()), 2),
+            float(values.min()), float(values.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict mutations across every model of an ensemble')
+    parser.add_argument('source', help='Multi-model PDB or mmCIF file, or a directory of PDB and mmCIF files')
+    parser.add_argument('mutations', help='Mutations such as "TI17R TI17A"')
+    parser.add_argument('partners', help='Binding partners, e.g. E_I')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--crop', type=float, metavar='SHELL')
+    parser.add_argument('--graph-store', metavar='DIR')
+    parser.add_argument('--feature-store', metavar='DIR')
+    parser.add_argument('--cache', metavar='FILE', help='Prediction cache (default: $GEOPPI_CACHE)')
+    parser.add_argument('--scratch', default='ensemble_tmp')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    from pipeline import Job, print_report, run_pipeline
+    from run import load_models
+
+    members = ensemble_members(args.source, path.join(args.scratch, 'members'))
+    if not members:
+        parser.error('no structures in {}'.format(args.source))
+    mutations = args.mutations.replace(',', ' ').split()
+    print('{} members x {} mutations'.format(len(members), len(mutations)))
+
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    model, forest, sorted_idx = load_models(precision=precision)
+    features = None
+    if args.feature_store:
+        from feature_store import FeatureStore, encoder_id
+        features = FeatureStore(args.feature_store, encoder_id(precision=precision))
+    from prediction_cache import open_cache
+    cache = open_cache(args.cache, precision, crop=args.crop)
+    jobs = [Job(i, member, mutation, args.partners)
+            for i, (mutation, member) in enumerate((x, y) for x in mutations for y in members)]
+    # members are split into the scratch directory, so it is only removed at the end
+    results, wall, stats = run_pipeline(jobs, model, forest, sorted_idx, args.foldx_workers, args.feature_workers,
+                                        args.batch_size, crop=args.crop, graph_store=args.graph_store,
+                                        features=features, scratch=path.join(args.scratch, 'builds'),
+                                        keep_builds=args.keep, verbose=False, cache=cache)
+    if not args.keep:
+        shutil.rmtree(args.scratch, ignore_errors=True)
+    print_report(results, wall, stats)
+    if cache is not None:
+        print(cache.summary())
+
+    names = [path.basename(member).split('.')[0] for member in members]
+    output = args.output or path.basename(args.source.rstrip('/')).split('.')[0] + '_ensemble_ddg.csv'
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['mutation', 'partners', 'members', 'mean_ddg', 'std_ddg', 'min_ddg', 'max_ddg'] + names)
+        print('\n{:12s} {:>7s} {:>8s} {:>7s} {:>13s}'.format('mutation', 'members', 'mean', 'std', 'range'))
+        for i, mutation in enumerate(mutations):
+            rows = results[i*len(members):(i + 1)*len(members)]
+            ddgs = [job.ddg if job.error is None else None for job in rows]
+            mean, std, low, high = summarize(ddgs)
+            ok = sum(x is not None for x in ddgs)
+            writer.writerow([mutation, args.partners, ok] + ['' if x is None else x for x in (mean, std, low, high)] +
+                            [x if x is not None else 'error' for x in ddgs])
+            if mean is None:
+                print('{:12s} {:>7d} {:>8s}'.format(mutation, 0, 'error'))
+            else:
+                print('{:12s} {:>7d} {:>8.2f} {:>7.2f} {:>6.2f}..{:.2f}'.format(mutation, ok, mean, std, low, high))
+            for job in rows:
+                if job.error is not None:
+                    print('  {} {}: {}'.format(path.basename(job.pdbfile), mutation, job.error))
+    print('Results written to {}'.format(output))
+
+if __name__ == "__main__":
+    main()
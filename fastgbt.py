@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Flat NumPy representation of the GBT regressor.
+
+trainedmodels/gbt-s4169.pkl is a scikit-learn GradientBoostingRegressor, so
+loading it imports scikit-learn (pinned to 0.24.1) and predicting walks the
+trees one Python object at a time. This module exports the ensemble once to a
+.npz file of flat node arrays (feature, threshold, children, values) and
+evaluates all trees for a batch of rows at once with NumPy. Predictions are
+identical to forest.predict.
+
+Usage:
+    python fastgbt.py [gbt.pkl] [gbt.npz]
+
+    # defaults: trainedmodels/gbt-s4169.pkl -> trainedmodels/gbt-s4169.npz
+"""
+
+import sys
+import numpy as np
+
+
+class ArrayForest(object):
+    """Gradient-boosted regression trees stored as flat node arrays.
+
+    Nodes of all trees are concatenated; children hold global node indices and
+    are -1 at leaves. roots holds the index of the first node of every tree.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, init, learning_rate, n_features):
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.init = float(init)
+        self.learning_rate = float(learning_rate)
+        self.n_features = int(n_features)
+
+    @classmethod
+    def from_sklearn(cls, forest):
+        """Convert a fitted single-output GradientBoostingRegressor"""
+        n_features = getattr(forest, 'n_features_in_', None) or forest.n_features_
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        offset = 0
+        for estimator in forest.estimators_[:, 0]:
+            tree = estimator.tree_
+            leaf = tree.children_left == -1
+            roots.append(offset)
+            # leaves keep feature 0 so that gathering X[:, feature] stays in bounds
+            feature.append(np.where(leaf, 0, tree.feature))
+            threshold.append(tree.threshold)
+            left.append(np.where(leaf, -1, tree.children_left + offset))
+            right.append(np.where(leaf, -1, tree.children_right + offset))
+            value.append(tree.value[:, 0, 0])
+            offset += tree.node_count
+
+        if forest.init_ == 'zero':
+            init = 0.0
+        else:
+            init = forest._raw_predict_init(np.zeros((1, n_features), dtype=np.float32))[0, 0]
+
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(left),
+                   np.concatenate(right), np.concatenate(value), roots, init,
+                   forest.learning_rate, n_features)
+
+    def save(self, path):
+        np.savez(path, feature=self.feature, threshold=self.threshold, left=self.left,
+                 right=self.right, value=self.value, roots=self.roots, init=self.init,
+                 learning_rate=self.learning_rate, n_features=self.n_features)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(arrays['feature'], arrays['threshold'], arrays['left'], arrays['right'],
+                   arrays['value'], arrays['roots'], arrays['init'], arrays['learning_rate'],
+                   arrays['n_features'])
+
+    def predict(self, X):
+        """Predict a batch of rows, matching GradientBoostingRegressor.predict"""
+        # scikit-learn casts inputs to float32 before comparing with float64 thresholds
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError('Expected input of shape (n, {}), got {}'.format(self.n_features, X.shape))
+
+        n = X.shape[0]
+        rows = np.arange(n)[:, None]
+        nodes = np.repeat(self.roots[None, :], n, axis=0)  # n, n_trees
+        while True:
+            left = self.left[nodes]
+            inner = left >= 0
+            if not inner.any():
+                break
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(inner, np.where(go_left, left, self.right[nodes]), nodes)
+
+        # accumulate stage by stage, in the same order as scikit-learn
+        stages = np.empty((n, len(self.roots) + 1))
+        stages[:, 0] = self.init
+        stages[:, 1:] = self.learning_rate * self.value[nodes]
+        return np.add.accumulate(stages, axis=1)[:, -1]
+
+
+def check_equivalence(forest, arrays, n_rows=2000, seed=0):
+    """Compare both models on rows built from the split thresholds; return max |diff|"""
+    rng = np.random.RandomState(seed)
+    pool = arrays.threshold[arrays.left >= 0]
+    X = rng.choice(pool, size=(n_rows, arrays.n_features))
+    X = X + rng.choice([-1e-3, 0.0, 1e-3], size=X.shape)
+    return np.max(np.abs(forest.predict(X) - arrays.predict(X)))
+
+
+def main():
+    pklfile = sys.argv[1] if len(sys.argv) > 1 else 'trainedmodels/gbt-s4169.pkl'
+    npzfile = sys.argv[2] if len(sys.argv) > 2 else pklfile.rsplit('.', 1)[0] + '.npz'
+
+    import pickle
+    try:
+        with open(pklfile, 'rb') as pickle_file:
+            forest = pickle.load(pickle_file)
+    except Exception as e:
+        print('File reading error: could not load {} ({})'.format(pklfile, e))
+        sys.exit(1)
+
+    arrays = ArrayForest.from_sklearn(forest)
+    diff = check_equivalence(forest, arrays)
+    if diff != 0.0:
+        print('Conversion check failed: max |difference| to forest.predict is {}'.format(diff))
+        sys.exit(1)
+
+    arrays.save(npzfile)
+    print('Exported {} trees ({} nodes) to {}; predictions identical to {}'.format(
+        len(arrays.roots), len(arrays.feature), npzfile, pklfile))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Columnar store of encoder feature vectors.
+
+The rounded 18x256 vector from gen_features is the only input of the GBT.
+A FeatureStore keeps every vector computed with it, with the mutation and the
+encoder that produced it, so that a new or retrained regressor can re-score a
+campaign, and the GBT can be retrained from the stored vectors without FoldX
+or the encoder.
+
+A store is a directory of shards, part-<time>-<random>.npz, one per flush.
+Each shard holds these columns:
+
+    features   float32 (n, 4608) rounded feature vectors (all 18 blocks)
+    pdb, mutation, partners   str (n,)
+    flag       bool (n,)  no-op mutation (ddG forced to 0)
+    ddg        float (n,) ddG predicted when the vector was stored
+    label      float (n,) experimental ddG, NaN when unknown
+    encoder    str        encoder_id(): the encoder file loaded and the precision it ran in
+
+Shards are written to a temporary name and renamed, so concurrent writers
+(SGE tasks, pipeline runs) never see each other's partial files.
+
+Usage:
+    python feature_store.py info STORE
+    python feature_store.py score STORE [--gbt trainedmodels/gbt-s4169.npz]
+                                        [--sortidx trainedmodels/sortidx.npy] [-o scores.csv]
+
+    run.py, pipeline.py and graph_store.py score take --feature-store STORE.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+import uuid
+from collections import namedtuple
+
+import numpy as np
+
+from keys import file_sha256
+from run import resolve_encoder
+
+FeatureTable = namedtuple('FeatureTable', ['features', 'pdb', 'mutation', 'partners', 'flag', 'ddg', 'label', 'encoder'])
+
+COLUMNS = ['pdb', 'mutation', 'partners', 'flag', 'ddg', 'label']
+
+
+def encoder_id(precision='fp32', gnnfile='trainedmodels/GeoEnc.tor', jitfile='trainedmodels/GeoEnc.pt'):
+    """
+    Identify the encoder that produces feature vectors for a GEOPPI_PRECISION mode: the file
+    load_models loads and the precision it runs in (a reduced mode can fall back to fp32)
+    """
+    encoderfile, precision = resolve_encoder(precision, gnnfile, jitfile)
+    return '{}-{}'.format(file_sha256(encoderfile)[:16], precision)
+
+
+class FeatureStore(object):
+    def __init__(self, directory, encoder, flush_every=256):
+        self.directory = directory
+        self.encoder = encoder
+        self.flush_every = flush_every
+        self.rows = []
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, features, pdb, mutation, partners, flag, ddg=None, label=None):
+        self.rows.append((np.asarray(features, dtype=np.float32), pdb, mutation, partners, bool(flag),
+                          np.nan if ddg is None else float(ddg), np.nan if label is None else float(label)))
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        name = 'part-{}-{}.npz'.format(int(time.time()), uuid.uuid4().hex[:12])
+        tmpfile = os.path.join(self.directory, '.' + name)
+        with open(tmpfile, 'wb') as f:
+            np.savez_compressed(f, features=np.stack(columns[0]), encoder=np.array(self.encoder),
+                                **dict((key, np.array(values)) for key, values in zip(COLUMNS, columns[1:])))
+        os.rename(tmpfile, os.path.join(self.directory, name))
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def load_features(directory, encoder=None):
+    """Concatenate the shards of a store (only those of encoder, if given) into a FeatureTable"""
+    parts = []
+    for shard in sorted(glob.glob(os.path.join(directory, 'part-*.npz'))):
+        with np.load(shard) as arrays:
+            shard_encoder = str(arrays['encoder'])
+            if encoder is not None and shard_encoder != encoder:
+                continue
+            n = len(arrays['pdb'])
+            parts.append([arrays['features']] + [arrays[key] for key in COLUMNS] + [np.array([shard_encoder]*n)])
+    if not parts:
+        return None
+    return FeatureTable(*[np.concatenate(column) for column in zip(*parts)])
+
+
+def score(table, forest, sorted_idx, n_select=None):
+    """ddGs of every stored vector under a (possibly different) GBT and feature ranking"""
+    from models import GeoPPIregress, n_selected
+    if n_select is None:
+        n_select = n_selected(forest)
+    return GeoPPIregress(table.features[:, np.asarray(sorted_idx[:n_select])], forest, table.flag)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or re-score a feature store')
+    parser.add_argument('command', choices=['info', 'score'])
+    parser.add_argument('store')
+    parser.add_argument('--encoder', help='Only use vectors of this encoder_id')
+    parser.add_argument('--gbt', default='trainedmodels/gbt-s4169.npz', help='.npz (fastgbt.py) or .pkl regressor')
+    parser.add_argument('--sortidx', default='trainedmodels/sortidx.npy')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    table = load_features(args.store, args.encoder)
+    if table is None:
+        print('Error: no feature vectors in {}'.format(args.store))
+        sys.exit(1)
+
+    if args.command == 'info':
+        encoders, counts = np.unique(table.encoder, return_counts=True)
+        print('{} vectors of dimension {}, {} labelled'.format(len(table.pdb), table.features.shape[1],
+                                                              int(np.sum(~np.isnan(table.label)))))
+        for encoder, count in zip(encoders, counts):
+            print('  encoder {}: {}'.format(encoder, count))
+        return
+
+    if args.gbt.endswith('.npz'):
+        from fastgbt import ArrayForest
+        forest = ArrayForest.load(args.gbt)
+    else:
+        import pickle
+        with open(args.gbt, 'rb') as f:
+            forest = pickle.load(f)
+    import models  # imports torch; keep it out of the timing
+    start = time.time()
+    ddgs = score(table, forest, np.load(args.sortidx))
+    print('Scored {} vectors in {:.2f} s'.format(len(ddgs), time.time() - start))
+
+    if args.output:
+        import csv
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['pdb', 'mutation', 'partners', 'ddg', 'stored_ddg', 'label'])
+            for row in zip(table.pdb, table.mutation, table.partners, ddgs, table.ddg, table.label):
+                writer.writerow(row)
+        print('Results written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
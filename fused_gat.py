@@ -0,0 +1,118 @@
+"""
+Fused, inference-only attention layers for the geometric encoder.
+
+torch_geometric's GATConv and cgat.CGAT re-add self-loops and regroup the
+softmax over edge_index in every layer, and gather x_i/x_j per edge (CGAT also
+concatenates three slices per edge to score it). Here the self-looped,
+destination-sorted edge list and its softmax segments are built once per graph
+and shared by all four layers, and the attention logits are split into a
+per-node destination term plus a per-node source term, so only (edges, heads)
+logits and one gather of the messages are formed per layer. Only plain torch
+indexing and reductions are used.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Tuple
+
+
+def build_segments(edge_index, num_nodes: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Self-looped edges grouped by destination node.
+    Returns src, dst (sorted) and slot, the position of each edge within its
+    destination's neighbourhood, used to lay the logits out as (N, max_degree).
+    """
+    edge_index = edge_index[:, edge_index[0] != edge_index[1]]
+    loop = torch.arange(num_nodes, dtype=edge_index.dtype, device=edge_index.device)
+    src = torch.cat([edge_index[0], loop])
+    dst = torch.cat([edge_index[1], loop])
+
+    dst, perm = torch.sort(dst)
+    src = src[perm]
+    degree = torch.bincount(dst, minlength=num_nodes)
+    start = torch.cumsum(degree, 0) - degree
+    slot = torch.arange(dst.size(0), dtype=dst.dtype, device=dst.device) - start[dst]
+    return src, dst, slot
+
+
+def attend(score_dst, score_src, values, src, dst, slot, negative_slope: float, chunk: int = 0):
+    """
+    Softmax attention over the segments of build_segments.
+    score_dst, score_src: (N, H); values: (N, H, C) -> (N, H, C)
+    With chunk > 0 the weighted messages, (edges, H, C), are formed and summed
+    chunk edges at a time (same order of additions, same result).
+    """
+    num_nodes, heads = score_dst.size(0), score_dst.size(1)
+    alpha = F.leaky_relu(score_dst[dst] + score_src[src], negative_slope)  # E, H
+
+    # segment max through a padded (N, max_degree, H) view of the logits;
+    # every node has its self-loop, so each segment has a finite maximum
+    padded = torch.full((num_nodes, int(slot.max().item()) + 1, heads), float('-inf'),
+                        dtype=alpha.dtype, device=alpha.device)
+    padded[dst, slot] = alpha
+    alpha = (alpha - padded.max(dim=1)[0][dst]).exp()
+    alpha = alpha / (torch.zeros_like(score_dst).index_add_(0, dst, alpha)[dst] + 1e-16)
+
+    out = torch.zeros_like(values)
+    if chunk <= 0 or chunk >= dst.size(0):
+        return out.index_add_(0, dst, alpha.unsqueeze(2) * values[src])
+    for start in range(0, dst.size(0), chunk):
+        end = min(start + chunk, dst.size(0))
+        out.index_add_(0, dst[start:end], alpha[start:end].unsqueeze(2) * values[src[start:end]])
+    return out
+
+
+class FusedCGAT(nn.Module):
+    """Inference-only cgat.CGAT.
+
+    CGAT scores an edge j->i with att . [a_i, a_j, b_i - b_j] where x W = [a, b];
+    this equals (att1 . a_i + att3 . b_i) + (att2 . a_j - att3 . b_j).
+    """
+    def __init__(self, conv):
+        super(FusedCGAT, self).__init__()
+        self.heads = conv.heads
+        self.out_channels = conv.out_channels
+        self.negative_slope = conv.negative_slope
+        # x W stored as a bias-free Linear so that dynamic quantization can replace it
+        self.proj = nn.Linear(conv.in_channels, conv.weight.size(1), bias=False)
+        self.proj.weight = nn.Parameter(conv.weight.detach().t().contiguous())
+        self.att = nn.Parameter(conv.att.detach().clone())
+        self.bias = nn.Parameter(conv.bias.detach().clone())
+        # edges per chunk of the weighted messages, 0 for all at once (memory_budget.configure_encoder)
+        self.edge_chunk = 0
+
+    def forward(self, x, src, dst, slot):
+        H, C = self.heads, self.out_channels
+        x = self.proj(x).view(-1, H, 2*C)
+        a, b = x[:, :, :C], x[:, :, C:]
+        att_i, att_j, att_ij = self.att[:, :, :C], self.att[:, :, C:2*C], self.att[:, :, 2*C:]
+
+        score_dst = (a * att_i).sum(dim=-1) + (b * att_ij).sum(dim=-1)
+        score_src = (a * att_j).sum(dim=-1) - (b * att_ij).sum(dim=-1)
+        out = attend(score_dst, score_src, a, src, dst, slot, self.negative_slope, self.edge_chunk)
+        return out.reshape(-1, H*C) + self.bias
+
+
+class FusedGAT(nn.Module):
+    """Inference-only torch_geometric GATConv (1.4.x)"""
+    def __init__(self, conv):
+        super(FusedGAT, self).__init__()
+        self.heads = conv.heads
+        self.out_channels = conv.out_channels
+        self.negative_slope = conv.negative_slope
+        # x W stored as a bias-free Linear so that dynamic quantization can replace it
+        self.proj = nn.Linear(conv.in_channels, conv.weight.size(1), bias=False)
+        self.proj.weight = nn.Parameter(conv.weight.detach().t().contiguous())
+        self.att = nn.Parameter(conv.att.detach().clone())
+        self.bias = nn.Parameter(conv.bias.detach().clone())
+        self.edge_chunk = 0
+
+    def forward(self, x, src, dst, slot):
+        H, C = self.heads, self.out_channels
+        x = self.proj(x).view(-1, H, C)
+
+        score_dst = (x * self.att[:, :, :C]).sum(dim=-1)
+        score_src = (x * self.att[:, :, C:]).sum(dim=-1)
+        out = attend(score_dst, score_src, x, src, dst, slot, self.negative_slope, self.edge_chunk)
+        return out.reshape(-1, H*C) + self.bias
@@ -14,14 +14,18 @@ chainsAB = chainsAB[0]+chainsAB[1]
 workdir=  sys.argv[3]
 cmd.load(pdbobject)
 interfaces= []
+dasa = []
 
 for i in range(len(chainsAB)):
 	for j in range(i+1,len(chainsAB)):
 		cha,chb=chainsAB[i],chainsAB[j]
 		if cha==chb:continue
-		cmd.do('interfaceResidue {}, chain {}, chain {}'.format(name, cha, chb))
+		# written inside workdir so that several structures can be processed at once
+		txtfile = '{}/temp.txt'.format(workdir)
+		dasafile = '{}/dasa_temp.txt'.format(workdir)
+		cmd.do('interfaceResidue {}, chain {}, chain {}, txtfile={}, dasafile={}'.format(name, cha, chb, txtfile, dasafile))
 		mapp = {'chA':cha,'chB':chb}
-		ffile = open('temp/temp.txt','r')
+		ffile = open(txtfile,'r')
 		for line in ffile.readlines():
 			linee = line.strip().split('_')
 			resid = linee[0]
@@ -29,10 +33,19 @@ for i in range(len(chainsAB)):
 			inter='{}_{}_{}_{}'.format(cha,chb,chainn,resid)
 			if inter not in interfaces:
 				interfaces.append(inter)
-		os.system('rm temp/temp.txt')
+		os.system('rm {}'.format(txtfile))
+		# per-residue dASA, used to prioritize positions (adaptive_scan.py)
+		for line in open(dasafile).readlines():
+			residue, value = line.strip().split('\t')
+			linee = residue.split('_')
+			dasa.append('{}_{}_{}_{}\t{}'.format(cha,chb,mapp[linee[1]],linee[0],value))
+		os.system('rm {}'.format(dasafile))
 ffile = open('{}/interface.txt'.format(workdir),'w')
 for x in interfaces:
 	ffile.write(x+'\n')
+ffile = open('{}/dasa.txt'.format(workdir),'w')
+for x in dasa:
+	ffile.write(x+'\n')
 cmd.save(pdbobject)
 cmd.delete('all')
 
@@ -14,6 +14,8 @@ import argparse
 import sys
 import os
 import glob
+import itertools
+import numpy as np
 from Bio import PDB
 from Bio.Data.IUPACData import protein_letters_3to1
 from collections import namedtuple
@@ -24,9 +26,14 @@ three_to_one = {k.upper(): v for k, v in protein_letters_3to1.items()}
 
 # Named tuple for sequence matches
 Match = namedtuple("Match", ["chain_id", "start_resnum", "end_resnum", "mismatches", "sequence"])
+# Chain sequences for motif searches: residue letters as uint8 codes and residue numbers
+ChainSequence = namedtuple("ChainSequence", ["chain_id", "codes", "res_nums"])
+# Codes of motif padding (matches anything) and of chain breaks (matches nothing)
+WILDCARD = 0
+SEPARATOR = 1
 
-def extract_interface_residues(pdbfile, chains_info, workdir='temp_interface', cutoff=1.0):
-    """Extract interface residues using PyMOL"""
+def extract_interface_residues(pdbfile, chains_info, workdir='temp_interface', cutoff=1.0, distance_cutoff=5.0):
+    """Extract interface residues using PyMOL (distance_cutoff: A, for the distance-based fallback)"""
     # Parse pdb name
     namepdb = os.path.basename(pdbfile)
     name = namepdb.split('.')[0]
@@ -43,35 +50,44 @@ def extract_interface_residues(pdbfile, chains_info, workdir='temp_interface', c
     chainsAB = chains_info.replace('_', '')
     interfaces = []
     
+    # Import InterfaceResidues module if available
+    try:
+        import InterfaceResidues
+    except ImportError:
+        InterfaceResidues = None
+        print("Warning: InterfaceResidues module not found. Using distance-based method.")
+    
     # Find all interfaces between specified chains
+    pairs = []
     for i in range(len(chainsAB)):
         for j in range(i+1, len(chainsAB)):
             cha, chb = chainsAB[i], chainsAB[j]
             if cha == chb:
                 continue
+            pairs.append((cha, chb))
+            if InterfaceResidues is None:
+                continue
             
-            # Import InterfaceResidues module if available
-            try:
-                import InterfaceResidues
-                cmd.do(f'interfaceResidues {name}, chain {cha}, chain {chb}')
-                
-                mapp = {'chA': cha, 'chB': chb}
-                temp_file = f'{workdir}/temp_{cha}_{chb}.txt'
-                
-                if os.path.exists('temp/temp.txt'):
-                    with open('temp/temp.txt', 'r') as f:
-                        for line in f:
-                            linee = line.strip().split('_')
-                            if len(linee) >= 2:
-                                resid = linee[0]
-                                chainn = mapp.get(linee[1], linee[1])
-                                inter = f'{cha}_{chb}_{chainn}_{resid}'
-                                if inter not in interfaces:
-                                    interfaces.append(inter)
-                    os.remove('temp/temp.txt')
-            except ImportError:
-                print("Warning: InterfaceResidues module not found. Using distance-based method.")
-                interfaces.extend(find_interface_by_distance(pdbfile, cha, chb, cutoff=5.0))
+            cmd.do(f'interfaceResidues {name}, chain {cha}, chain {chb}')
+            
+            mapp = {'chA': cha, 'chB': chb}
+            temp_file = f'{workdir}/temp_{cha}_{chb}.txt'
+            
+            if os.path.exists('temp/temp.txt'):
+                with open('temp/temp.txt', 'r') as f:
+                    for line in f:
+                        linee = line.strip().split('_')
+                        if len(linee) >= 2:
+                            resid = linee[0]
+                            chainn = mapp.get(linee[1], linee[1])
+                            inter = f'{cha}_{chb}_{chainn}_{resid}'
+                            if inter not in interfaces:
+                                interfaces.append(inter)
+                os.remove('temp/temp.txt')
+    
+    # All chain pairs in one neighbor search
+    if InterfaceResidues is None:
+        interfaces.extend(find_interfaces_by_distance(pdbfile, pairs, cutoff=distance_cutoff))
     
     # Write interface file
     interface_file = f'{workdir}/interface.txt'
@@ -82,41 +98,79 @@ def extract_interface_residues(pdbfile, chains_info, workdir='temp_interface', c
     cmd.delete('all')
     return interface_file, interfaces
 
-def find_interface_by_distance(pdbfile, chain1, chain2, cutoff=5.0):
-    """Fallback method to find interface residues by distance"""
+def contacting_atoms(coords, groups, allowed, cutoff=5.0, block=200000):
+    """
+    Boolean (atoms, groups) array: [i, g] is True when atom i has an atom of group g
+    closer than cutoff, for the group pairs allowed[group of i, g] (cell lists)
+    """
+    hits = np.zeros((len(coords), len(allowed)), dtype=bool)
+    if len(coords) == 0:
+        return hits
+    # cells of cutoff A: atoms closer than cutoff are in the same or a neighboring cell
+    cells = np.floor((coords - coords.min(0)) / cutoff).astype(np.int64) + 1
+    span = cells.max(0) + 2
+    keys = (cells[:, 0]*span[1] + cells[:, 1])*span[2] + cells[:, 2]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    for start in range(0, len(coords), block):
+        atoms = np.arange(start, min(start + block, len(coords)))
+        for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+            neighbors = keys[atoms] + (dx*span[1] + dy)*span[2] + dz
+            first, last = np.searchsorted(sorted_keys, neighbors, 'left'), np.searchsorted(sorted_keys, neighbors, 'right')
+            counts = last - first
+            if not counts.any():
+                continue
+            a = np.repeat(atoms, counts)
+            b = order[np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            keep = allowed[groups[a], groups[b]]
+            a, b = a[keep], b[keep]
+            close = ((coords[a] - coords[b])**2).sum(1) < cutoff*cutoff
+            hits[a[close], groups[b[close]]] = True
+    return hits
+
+def find_interfaces_by_distance(pdbfile, pairs, cutoff=5.0):
+    """
+    Fallback method to find interface residues by distance: the residues of each chain
+    pair (chain1, chain2) with an atom closer than cutoff to the other chain, as
+    chain1_chain2_chain_resid tokens
+    """
     parser = PDB.PDBParser(QUIET=True)
     structure = parser.get_structure("protein", pdbfile)
     model = structure[0]
     
-    interfaces = []
-    
-    if chain1 not in model or chain2 not in model:
-        return interfaces
-    
-    ch1 = model[chain1]
-    ch2 = model[chain2]
-    
-    # Find residues within cutoff distance
-    for res1 in ch1:
-        if res1.id[0] != ' ':
-            continue
-        for res2 in ch2:
-            if res2.id[0] != ' ':
+    pairs = [(a, b) for a, b in pairs if a in model and b in model]
+    chains = list(dict.fromkeys(c for pair in pairs for c in pair))
+    index = {c: g for g, c in enumerate(chains)}
+    allowed = np.zeros((len(chains), len(chains)), dtype=bool)
+    for a, b in pairs:
+        allowed[index[a], index[b]] = allowed[index[b], index[a]] = True
+    
+    # Atoms of the standard residues of every chain involved, in one array
+    coords, groups, resids = [], [], []
+    for chain_id in chains:
+        for res in model[chain_id]:
+            if res.id[0] != ' ':
                 continue
-            
-            # Check atom distances
-            for atom1 in res1:
-                for atom2 in res2:
-                    dist = atom1 - atom2
-                    if dist < cutoff:
-                        interfaces.append(f'{chain1}_{chain2}_{chain1}_{res1.id[1]}')
-                        interfaces.append(f'{chain1}_{chain2}_{chain2}_{res2.id[1]}')
-                        break
-                else:
-                    continue
-                break
-    
-    return list(set(interfaces))
+            for atom in res:
+                coords.append(atom.coord)
+                groups.append(index[chain_id])
+                resids.append(res.id[1])
+    coords = np.array(coords, dtype=float).reshape(-1, 3)
+    groups = np.array(groups, dtype=np.int64)
+    resids = np.array(resids, dtype=np.int64)
+    hits = contacting_atoms(coords, groups, allowed, cutoff)
+    
+    interfaces = []
+    for chain1, chain2 in pairs:
+        for chain, other in ((chain1, chain2), (chain2, chain1)):
+            near = (groups == index[chain]) & hits[:, index[other]]
+            for resid in dict.fromkeys(resids[near].tolist()):
+                interfaces.append(f'{chain1}_{chain2}_{chain}_{resid}')
+    return interfaces
+
+def find_interface_by_distance(pdbfile, chain1, chain2, cutoff=5.0):
+    """Interface residues of one chain pair by distance (see find_interfaces_by_distance)"""
+    return find_interfaces_by_distance(pdbfile, [(chain1, chain2)], cutoff)
 
 def parse_interface_file(interface_file, target_chains=None):
     """Parse interface file and extract residue information"""
@@ -152,32 +206,67 @@ def extract_chain_sequence(chain):
     
     return sequence, res_nums
 
-def find_sequence_matches(structure, query, max_mismatches=0):
-    """Find all occurrences of a query sequence in the PDB structure"""
-    model = structure[0]
-    query = query.upper()
-    matches = []
-    
-    for chain in model:
-        chain_id = chain.id
+def extract_sequences(structure):
+    """Sequences of the chains of the first model, once, as ChainSequence tuples of uint8 (ASCII) codes"""
+    sequences = []
+    for chain in structure[0]:
         sequence, res_nums = extract_chain_sequence(chain)
-        
-        if not sequence or len(sequence) < len(query):
-            continue
-        
-        # Search for matches with sliding window
-        for i in range(len(sequence) - len(query) + 1):
-            window = sequence[i:i+len(query)]
-            mismatches = sum(a != b for a, b in zip(query, window))
-            
-            if mismatches <= max_mismatches:
-                start_res = res_nums[i]
-                end_res = res_nums[i + len(query) - 1]
-                matched_seq = ''.join(window)
-                matches.append(Match(chain_id, start_res, end_res, mismatches, matched_seq))
-    
+        if sequence:
+            codes = np.frombuffer(''.join(sequence).encode('ascii'), dtype=np.uint8)
+            sequences.append(ChainSequence(chain.id, codes, res_nums))
+    return sequences
+
+def find_motif_matches(sequences, queries, max_mismatches=0, block=1 << 22):
+    """
+    Find all occurrences of every query with up to max_mismatches mismatches in the
+    sequences of extract_sequences, all chains and queries in one pass.
+    Returns {query: [Match, ...]} (queries upper-cased), in chain and position order.
+    """
+    queries = [q for q in dict.fromkeys(q.upper() for q in queries) if q]
+    matches = {q: [] for q in queries}
+    if not queries or not sequences:
+        return matches
+    
+    # Queries padded to the longest with wildcards, chains joined by separators
+    length = max(len(q) for q in queries)
+    motifs = np.full((len(queries), length), WILDCARD, dtype=np.uint8)
+    for i, q in enumerate(queries):
+        motifs[i, :len(q)] = np.frombuffer(q.encode('ascii'), dtype=np.uint8)
+    lengths = np.array([len(q) for q in queries])
+    separator = np.array([SEPARATOR], dtype=np.uint8)
+    text = np.concatenate([x for s in sequences for x in (s.codes, separator)] +
+                          [np.full(length, SEPARATOR, dtype=np.uint8)])
+    # residues left in the chain from each position (windows stay inside one chain),
+    # and the chain and residue number of each position
+    room = np.concatenate([x for s in sequences for x in (np.arange(len(s.codes), 0, -1), [0])] +
+                          [np.zeros(length, dtype=np.int64)])
+    chains = np.repeat(np.arange(len(sequences) + 1), [len(s.codes) + 1 for s in sequences] + [length])
+    res_nums = np.concatenate([x for s in sequences for x in (s.res_nums, [0])] + [np.zeros(length, dtype=np.int64)])
+    chain_ids = [s.chain_id for s in sequences] + [None]
+    
+    windows = len(text) - length + 1
+    step = max(block // len(queries), 1)
+    for first in range(0, windows, step):
+        last = min(first + step, windows)
+        mismatches = np.zeros((len(queries), last - first), dtype=np.int32)
+        for j in range(length):
+            column = motifs[:, j:j+1]
+            mismatches += (column != text[None, first+j:last+j]) & (column != WILDCARD)
+        hits = (mismatches <= max_mismatches) & (room[None, first:last] >= lengths[:, None])
+        rows, offsets = np.nonzero(hits)
+        positions = first + offsets
+        ends = positions + lengths[rows] - 1
+        for i, position, chain, start_res, end_res, count in zip(
+                rows.tolist(), positions.tolist(), chains[positions].tolist(), res_nums[positions].tolist(),
+                res_nums[ends].tolist(), mismatches[rows, offsets].tolist()):
+            matched_seq = text[position:position + lengths[i]].tobytes().decode('ascii')
+            matches[queries[i]].append(Match(chain_ids[chain], start_res, end_res, count, matched_seq))
     return matches
 
+def find_sequence_matches(structure, query, max_mismatches=0):
+    """Find all occurrences of a query sequence in the PDB structure"""
+    return find_motif_matches(extract_sequences(structure), [query], max_mismatches).get(query.upper(), [])
+
 def generate_position_list(structure, positions, output_file, format='mutatex'):
     """Generate position list in MutateX or Rosetta format"""
     model = structure[0]
@@ -216,9 +305,10 @@ def generate_position_list(structure, positions, output_file, format='mutatex'):
     
     return pos_entries
 
-def interactive_mode(structure, interface_residues=None):
+def interactive_mode(structure, interface_residues=None, max_mismatches=0):
     """Interactive mode for exploring and selecting positions"""
     model = structure[0]
+    sequences = extract_sequences(structure)
     
     print("\n=== Interactive Mode ===")
     
@@ -274,11 +364,13 @@ def interactive_mode(structure, interface_residues=None):
                 print(f"Added {len(filtered)} residues from chain(s) {', '.join(selected_chains)}")
         
         elif choice == '3':
-            query = input("Enter sequence to search (1-letter code): ").strip().upper()
-            if not query:
+            query = input("Enter sequence(s) to search (1-letter code, comma-separated): ").strip().upper()
+            queries = [q.strip() for q in query.split(',') if q.strip()]
+            if not queries:
                 continue
             
-            matches = find_sequence_matches(structure, query)
+            found = find_motif_matches(sequences, queries, max_mismatches)
+            matches = [match for q in queries for match in found[q]]
             if not matches:
                 print(f"No matches found for '{query}'")
             else:
@@ -292,7 +384,8 @@ def interactive_mode(structure, interface_residues=None):
                                 overlap.append(resnum)
                     
                     overlap_info = f" (interface: {len(overlap)} residues)" if overlap else ""
-                    print(f"  {i+1}. Chain {match.chain_id}: {match.start_resnum}-{match.end_resnum} [{match.sequence}]{overlap_info}")
+                    mismatch_info = f" ({match.mismatches} mismatches)" if match.mismatches else ""
+                    print(f"  {i+1}. Chain {match.chain_id}: {match.start_resnum}-{match.end_resnum} [{match.sequence}]{mismatch_info}{overlap_info}")
                 
                 selected = input("\nSelect matches (comma-separated numbers, or 'all'): ").strip()
                 if selected.lower() == 'all':
@@ -343,6 +436,9 @@ Examples:
   # Search for motif in interfaces
   %(prog)s -p structure.pdb -c AB_CD -q EVQLVQ
   
+  # Search for several motifs, allowing one mismatch
+  %(prog)s -p structure.pdb -c AB_CD -q DIQMTQ -q EVQLVQ --mismatches 1
+  
   # Rosetta format output
   %(prog)s -p structure.pdb -c AB_CD -f rosetta -o resfile.txt
         """
@@ -354,10 +450,13 @@ Examples:
     parser.add_argument("-f", "--format", choices=['mutatex', 'rosetta'], default='mutatex', 
                        help="Output format (default: mutatex)")
     parser.add_argument("-i", "--interactive", action='store_true', help="Interactive mode")
-    parser.add_argument("-q", "--query", help="Search for sequence motif in structure")
+    parser.add_argument("-q", "--query", action='append', help="Search for sequence motif in structure (repeat for several)")
+    parser.add_argument("--mismatches", type=int, default=0, help="Mismatches allowed in motif matches (default: 0)")
     parser.add_argument("--include-spans", nargs='+', help="Additional residue spans to include")
     parser.add_argument("--interface-only", action='store_true', help="Only include interface residues")
     parser.add_argument("--cutoff", type=float, default=1.0, help="Interface cutoff for PyMOL (default: 1.0)")
+    parser.add_argument("--distance-cutoff", type=float, default=5.0,
+                       help="Atom distance cutoff in A of the fallback without InterfaceResidues (default: 5.0)")
     parser.add_argument("--workdir", default="temp_interface", help="Working directory for temporary files")
     
     args = parser.parse_args()
@@ -367,7 +466,7 @@ Examples:
     
     # Extract interface residues
     interface_file, interface_raw = extract_interface_residues(
-        args.pdb, args.chains, args.workdir, args.cutoff
+        args.pdb, args.chains, args.workdir, args.cutoff, args.distance_cutoff
     )
     
     # Parse interface residues
@@ -387,17 +486,19 @@ Examples:
     
     # Interactive mode
     if args.interactive:
-        selected = interactive_mode(structure, interface_residues)
+        selected = interactive_mode(structure, interface_residues, args.mismatches)
         positions.extend(selected)
     
     # Query sequence search
     if args.query:
-        matches = find_sequence_matches(structure, args.query)
-        print(f"\nFound {len(matches)} matches for '{args.query}':")
-        for match in matches:
-            print(f"  Chain {match.chain_id}: {match.start_resnum}-{match.end_resnum}")
-            for resnum in range(match.start_resnum, match.end_resnum + 1):
-                positions.append((match.chain_id, resnum))
+        found = find_motif_matches(extract_sequences(structure), args.query, args.mismatches)
+        for query, matches in found.items():
+            print(f"\nFound {len(matches)} matches for '{query}':")
+            for match in matches:
+                mismatch_info = f" [{match.sequence}, {match.mismatches} mismatches]" if match.mismatches else ""
+                print(f"  Chain {match.chain_id}: {match.start_resnum}-{match.end_resnum}{mismatch_info}")
+                for resnum in range(match.start_resnum, match.end_resnum + 1):
+                    positions.append((match.chain_id, resnum))
     
     # Additional spans
     if args.include_spans:
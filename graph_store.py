@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped on-disk store of featurized samples.
+
+gen_graph_data dominates the cost of re-scoring a dataset once FoldX models
+exist, and run.py throws its graphs away. A GraphStore keeps the wildtype and
+mutant graphs ([atoms, edge_sparse, edge_attr_sp] each) of many samples in
+three flat files, plus an append-only index:
+
+    atoms.f32       float32 atom features, all samples back to back
+    edges.i64       int64 edge_sparse rows
+    edge_attr.i64   int64 edge_attr_sp values
+    index.jsonl     one line per sample: key, metadata, and the offsets in
+                    each of the files above and sizes of its two graphs
+
+Samples are keyed by (sha256 of the input PDB file, mutation, partners,
+cutoff), plus the crop shell for cropped builds. get() returns torch tensors
+that map the files directly (copy-on-write, so nothing is read until used).
+Appends take an exclusive lock, so several processes can share a store. The
+index is written last: data past the end of the last indexed sample (left by
+a writer that died) is truncated before the next append, and a data file
+shorter than the index says is refused.
+
+Usage:
+    python graph_store.py info STORE
+    python graph_store.py score STORE [-o scores.csv] [--feature-store FEATURES]
+
+    python run.py ... --graph-store STORE and python pipeline.py ... --graph-store STORE
+    fill the store and skip FoldX and featurization for samples already in it.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+FILES = (('atoms', 'atoms.f32', np.float32), ('edges', 'edges.i64', np.int64), ('edge_attr', 'edge_attr.i64', np.int64))
+
+
+class GraphStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.index_size = 0
+        # elements of each data file covered by the index
+        self.ends = dict((name, 0) for name, _, _ in FILES)
+        self.maps = {}
+        self._read_index()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_index(self):
+        """Read index lines appended since the last call (by any process)"""
+        path = self._path('index.jsonl')
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            f.seek(self.index_size)
+            for line in f:
+                # a line without its newline is still being written
+                if not line.endswith('\n'):
+                    break
+                entry = json.loads(line)
+                self.index[entry['key']] = entry
+                for atom_offset, n, cols, edges_offset, attr_offset, k in entry['graphs']:
+                    for name, end in (('atoms', atom_offset + n*cols), ('edges', edges_offset + 2*k),
+                                      ('edge_attr', attr_offset + k)):
+                        self.ends[name] = max(self.ends[name], end)
+                self.index_size += len(line.encode())
+
+    def __contains__(self, key):
+        return self.get_entry(key) is not None
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index)
+
+    def get_entry(self, key):
+        if key not in self.index:
+            with self.lock:
+                self._read_index()
+        return self.index.get(key)
+
+    def _map(self, name, end):
+        """Copy-on-write memory map of a data file covering at least end elements"""
+        current = self.maps.get(name)
+        if current is None or len(current) < end:
+            filename, dtype = dict((n, (f, d)) for n, f, d in FILES)[name]
+            current = self.maps[name] = np.memmap(self._path(filename), dtype=dtype, mode='c')
+        return current
+
+    def get(self, key):
+        """Returns ([A, E, Ea], [A_m, E_m, Ea_m], flag) as zero-copy tensors, or None"""
+        import torch
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        graphs = []
+        with self.lock:
+            for atom_offset, n, cols, edges_offset, attr_offset, k in entry['graphs']:
+                atoms = self._map('atoms', atom_offset + n*cols)[atom_offset:atom_offset + n*cols].reshape(n, cols)
+                edges = self._map('edges', edges_offset + 2*k)[edges_offset:edges_offset + 2*k].reshape(k, 2)
+                attr = self._map('edge_attr', attr_offset + k)[attr_offset:attr_offset + k]
+                graphs.append([torch.from_numpy(atoms), torch.from_numpy(edges), torch.from_numpy(attr)])
+        return graphs[0], graphs[1], entry['flag']
+
+    def _check_files(self):
+        """Truncate data past the end of the index (a writer died before indexing it); refuse missing data"""
+        for name, filename, dtype in FILES:
+            path = self._path(filename)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            end = self.ends[name]*np.dtype(dtype).itemsize
+            if size < end:
+                raise RuntimeError('{} has {} bytes but the index of {} needs {}'.format(
+                    filename, size, self.directory, end))
+            if size > end:
+                os.truncate(path, end)
+
+    def put(self, key, wildtype, mutant, flag, **metadata):
+        """Append the [A, E, Ea] graphs of a sample; a key already present is left unchanged"""
+        arrays = [[np.ascontiguousarray(x.numpy() if hasattr(x, 'numpy') else x) for x in graph]
+                  for graph in (wildtype, mutant)]
+        with self.lock, open(self._path('index.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._read_index()
+            if key in self.index:
+                return
+            self._check_files()
+            handles = dict((name, open(self._path(filename), 'ab')) for name, filename, _ in FILES)
+            try:
+                graphs = []
+                for atoms, edges, attr in arrays:
+                    n, cols = atoms.shape
+                    k = edges.shape[0]
+                    offsets = {}
+                    for (name, _, dtype), array in zip(FILES, (atoms, edges, attr)):
+                        handle, itemsize = handles[name], np.dtype(dtype).itemsize
+                        offsets[name] = handle.tell() // itemsize
+                        array.astype(dtype, copy=False).tofile(handle)
+                        handle.flush()
+                        if handle.tell() != (offsets[name] + array.size)*itemsize:
+                            raise RuntimeError('short write to {} in {}'.format(name, self.directory))
+                    graphs.append([offsets['atoms'], n, cols, offsets['edges'], offsets['edge_attr'], k])
+            finally:
+                for handle in handles.values():
+                    handle.close()
+
+            entry = dict(metadata, key=key, flag=bool(flag), graphs=graphs)
+            with open(self._path('index.jsonl'), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self._read_index()
+
+
+def score(store, batch_size=64, output=None, feature_store=None):
+    """Predict every stored sample with the current models, optionally saving the feature vectors"""
+    from models import FeaturePlan, n_selected, GeoPPIpredictBatch
+    from run import load_models
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    model, forest, sorted_idx = load_models(precision=precision)
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+    features = None
+    if feature_store:
+        from feature_store import FeatureStore, encoder_id
+        features = FeatureStore(feature_store, encoder_id(precision=precision))
+
+    keys = store.keys()
+    rows = []
+    start = time.time()
+    for i in range(0, len(keys), batch_size):
+        batch = [(key, store.get(key)) for key in keys[i:i + batch_size]]
+        samples = [(wt[0], wt[1], mt[0], mt[1], flag) for _, (wt, mt, flag) in batch]
+        if features is None:
+            ddgs, vectors = GeoPPIpredictBatch(samples, model, forest, sorted_idx, plan), [None]*len(batch)
+        else:
+            ddgs, vectors = GeoPPIpredictBatch(samples, model, forest, sorted_idx, plan, True)
+        for (key, (_, _, flag)), ddg, vector in zip(batch, ddgs, vectors):
+            entry = store.get_entry(key)
+            rows.append([entry.get('pdb'), entry.get('mutation'), entry.get('partners'), ddg])
+            if features is not None:
+                features.add(vector, entry.get('pdb'), entry.get('mutation'), entry.get('partners'), flag, ddg)
+    if features is not None:
+        features.flush()
+    seconds = time.time() - start
+    print('Scored {} samples in {:.1f} s ({:.1f} per second)'.format(len(rows), seconds, len(rows)/max(seconds, 1e-9)))
+
+    if output:
+        import csv
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['pdb', 'mutation', 'partners', 'ddg'])
+            writer.writerows(rows)
+        print('Results written to {}'.format(output))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or score a graph store')
+    parser.add_argument('command', choices=['info', 'score'])
+    parser.add_argument('store')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--feature-store', metavar='DIR', help='Also save the feature vectors to this feature store')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.store, 'index.jsonl')):
+        print('Error: {} is not a graph store'.format(args.store))
+        sys.exit(1)
+    store = GraphStore(args.store)
+    if args.command == 'info':
+        sizes = sum(os.path.getsize(os.path.join(args.store, filename)) for _, filename, _ in FILES)
+        print('{} samples, {:.1f} MB of graphs'.format(len(store), sizes/1e6))
+        structures = sorted(set(entry.get('pdb') for entry in store.index.values()))
+        print('{} structures: {}'.format(len(structures), ', '.join(str(x) for x in structures[:20])))
+    else:
+        score(store, args.batch_size, args.output, args.feature_store)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+TorchScript export of the trained GeometricEncoder.
+
+Building models.GeometricEncoder imports torch_geometric, constructs the
+module and loads the state dict, and every attention layer then goes through
+MessagePassing's Python dispatch. This module re-expresses the encoder in
+plain torch (the residue-index sin/cos encoding of step, the fused attention
+layers of fused_gat.py and the pooling of gen_features), compiles it with
+torch.jit.script and saves a self-contained artifact that loads without
+torch_geometric or any other extension.
+
+Usage:
+    python jit_encoder.py [GeoEnc.tor] [GeoEnc.pt]
+
+    # defaults: trainedmodels/GeoEnc.tor -> trainedmodels/GeoEnc.pt
+    # the export is checked against the eager model on data/testExamples
+"""
+
+import sys, os, glob
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Dict, List, Optional, Tuple
+from fused_gat import build_segments, FusedCGAT, FusedGAT
+
+
+class JitEncoder(nn.Module):
+    """Scriptable equivalent of models.GeometricEncoder.step and gen_features"""
+    def __init__(self, model):
+        super(JitEncoder, self).__init__()
+        self.conv1 = FusedCGAT(model.conv1)
+        self.conv2 = FusedGAT(model.conv2)
+        self.conv3 = FusedGAT(model.conv3)
+        self.conv4 = FusedGAT(model.conv4)
+        self.lin1 = model.lin1
+        self.lin2 = model.lin2
+        self.lin3 = model.lin3
+        self.lin4 = model.lin4
+        # layers 2-4 run in this buffer's dtype (see precision.py); pooling stays float32
+        self.register_buffer('dtype_ref', torch.zeros(0))
+
+    @torch.jit.export
+    def step(self, X, E) -> Tuple[torch.Tensor, torch.Tensor]:
+        x_init = X[:, :-1]
+        resid_max = float(torch.max(x_init[:, 27]).item())/6.283
+        sinx = torch.sin(x_init[:, 27:28]/resid_max)
+        cosx = torch.cos(x_init[:, 27:28]/resid_max)
+        x = torch.cat([x_init[:, :27], sinx, cosx, x_init[:, 28:]], 1)
+        # self-looped neighbourhoods are built once and shared by the four layers
+        src, dst, slot = build_segments(E.t(), X.size(0))
+
+        # the first layer reads raw coordinates and always runs in float32
+        x = F.elu(self.conv1(x, src, dst, slot) + self.lin1(x)).type_as(self.dtype_ref)
+        x = F.elu(self.conv2(x, src, dst, slot) + self.lin2(x))
+        x3 = F.elu(self.conv3(x, src, dst, slot) + self.lin3(x))
+        x4 = F.elu(self.conv4(x3, src, dst, slot) + self.lin4(x3))
+        return x3.float(), x4.float()
+
+    def pool(self, b: int, x3, x4, x3_m, x4_m, idx, idxm, id_contact, idm_contact):
+        """Block b (0-15) of models.FEATURE_BLOCKS"""
+        rel = b % 8
+        mutant = rel % 2 == 1
+        if b < 8:
+            h = x4_m if mutant else x4
+        else:
+            h = x3_m if mutant else x3
+        if rel < 4:
+            rows = idxm if mutant else idx
+        else:
+            rows = idm_contact if mutant else id_contact
+
+        if (rel // 2) % 2 == 0:
+            return torch.max(h[rows, :], 0)[0]
+        if b < 8:
+            return torch.sum(h[rows, :], 0)
+        return torch.mean(h[rows, :], 0)
+
+    @torch.jit.export
+    def gen_features(self, X, E, Ea, X_m, E_m, Ea_m, blocks: Optional[List[int]] = None):
+        x3, x4 = self.step(X, E)
+        x3_m, x4_m = self.step(X_m, E_m)
+        return self.pool_features(X, x3, x4, X_m, x3_m, x4_m, blocks)
+
+    @torch.jit.export
+    def embed(self, X, E) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.step(X, E)
+
+    @torch.jit.export
+    def pool_features(self, X, x3, x4, X_m, x3_m, x4_m, blocks: Optional[List[int]] = None):
+        idx = torch.nonzero((X[:, -1] == 1).float()).view(-1)
+        idxm = torch.nonzero((X_m[:, -1] == 1).float()).view(-1)
+        id_contact = torch.nonzero((X[:, 24] == 1).float()).view(-1)
+        idm_contact = torch.nonzero((X_m[:, 24] == 1).float()).view(-1)
+
+        if blocks is None:
+            blocks = list(range(18))
+        cache: Dict[int, torch.Tensor] = {}
+        rep: List[torch.Tensor] = []
+        for b in blocks:
+            if b >= 16:
+                # difference blocks: max or sum of x4, wildtype minus mutant
+                a = 2*(b - 16)
+                first = cache[a] if a in cache else self.pool(a, x3, x4, x3_m, x4_m, idx, idxm, id_contact, idm_contact)
+                second = cache[a+1] if a+1 in cache else self.pool(a+1, x3, x4, x3_m, x4_m, idx, idxm, id_contact, idm_contact)
+                block = first - second
+            else:
+                block = self.pool(b, x3, x4, x3_m, x4_m, idx, idxm, id_contact, idm_contact)
+            cache[b] = block
+            rep.append(block)
+        return torch.cat(rep, 0)
+
+    def forward(self, X, E, X_m, E_m):
+        return self.gen_features(X, E, E, X_m, E_m, E_m, None)
+
+
+def load_encoder(jitfile, device='cpu'):
+    """Load a TorchScript encoder saved by export_encoder"""
+    model = torch.jit.load(jitfile, map_location=device)
+    model.eval()
+    return model
+
+
+def export_encoder(gnnfile, jitfile, hidden_size=256):
+    """Script the trained encoder and save it; returns (eager model, scripted model)"""
+    from models import GeometricEncoder
+    model = GeometricEncoder(hidden_size)
+    model.load_state_dict(torch.load(gnnfile, map_location='cpu'))
+    model.eval()
+    scripted = torch.jit.script(JitEncoder(model).eval())
+    scripted.save(jitfile)
+    return model, scripted
+
+
+def middle_residue(lines):
+    """chain_resid token of the residue in the middle of the ATOM records"""
+    atoms = [line for line in lines if line[0:4] == 'ATOM']
+    line = atoms[len(atoms)//2]
+    return '{}_{}'.format(line[21], line[22:28].strip())
+
+
+def check_equivalence(model, scripted, pdbfiles, cutoff=3, rtol=1e-4, atol=1e-3):
+    """
+    Compare eager and scripted features on each structure; returns [(pdbfile, max |diff|, ok)].
+    The fused layers reassociate float32 sums, so features agree to within the
+    3-decimal rounding applied before the GBT rather than bit for bit.
+    """
+    from run import build_graph
+    results = []
+    for pdbfile in pdbfiles:
+        lines = open(pdbfile).read().splitlines()
+        site = middle_residue(lines)
+        sample = build_graph(lines, [], [site], cutoff, 12)
+        if sample is None:
+            continue
+        A, E, Ea = sample
+        with torch.no_grad():
+            ref = model.gen_features(A, E, Ea, A, E, Ea)
+            out = scripted.gen_features(A, E, Ea, A, E, Ea)
+        results.append((pdbfile, (ref - out).abs().max().item(), torch.allclose(ref, out, rtol=rtol, atol=atol)))
+    return results
+
+
+def main():
+    gnnfile = sys.argv[1] if len(sys.argv) > 1 else 'trainedmodels/GeoEnc.tor'
+    jitfile = sys.argv[2] if len(sys.argv) > 2 else gnnfile.rsplit('.', 1)[0] + '.pt'
+
+    model, _ = export_encoder(gnnfile, jitfile)
+    scripted = load_encoder(jitfile)
+    results = check_equivalence(model, scripted, sorted(glob.glob('data/testExamples/*.pdb')))
+    for pdbfile, diff, ok in results:
+        print('{:40s} max |diff| {:.2e} {}'.format(pdbfile, diff, 'ok' if ok else 'MISMATCH'))
+    if not all(ok for _, _, ok in results):
+        print('The TorchScript encoder does not match the eager model; removed {}'.format(jitfile))
+        os.remove(jitfile)
+        sys.exit(1)
+    print('Saved TorchScript encoder to {}'.format(jitfile))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Content hashes and sample keys shared by the graph store, the prediction cache
+and training.
+
+Only the standard library is imported here, so that run.py can look a
+prediction up in the cache without loading NumPy or torch.
+"""
+
+import hashlib
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sample_key(structure_hash, mutation, partners, cutoff, crop=None):
+    """Key of a sample: the structure's file_sha256, mutation, partners, cutoff and crop shell"""
+    key = '{}:{}:{}:{:g}'.format(structure_hash, mutation, partners, cutoff)
+    if crop is not None:
+        key += ':crop{:g}'.format(crop)
+    return key
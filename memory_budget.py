@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Memory estimates and a memory budget for the graph stages.
+
+build_graph keeps the atoms within 12 A of the interface and the mutation
+and finds their edges from dense (N, N) tensors, about 56 bytes per pair of
+graph atoms; every attention layer of the encoder forms an (edges, 256)
+tensor of weighted messages, twice, besides its activations. Both are known
+from the atom and edge counts before they run; the rest of the process
+(Python, torch, the models and the parsed structure) is estimated from the
+model files and the structure's atom count. The constants below were
+measured with benchmarks/synthetic.py complexes.
+
+With a budget in MB ($GEOPPI_MEMORY_MB), the stages whose estimate exceeds
+their share of it run in pieces with the same results:
+
+    build_graph   finds the edges TILE atoms at a time (graph_tile)
+    encoder       forms and sums the weighted messages a chunk of edges at a
+                  time (configure_encoder; TorchScript exports of
+                  jit_encoder.py and precision.py made since this option,
+                  not the eager torch_geometric model)
+
+Without a budget nothing changes. The estimate command reports the peak of a
+prediction before running it; the SGE scripts in "wynton submission
+scripts" request memory from it.
+
+Usage:
+    python memory_budget.py estimate [pdb file] [Mutation[,Mutation...]] [partnerA_partnerB] [--interface interface.txt]
+
+    # without interface.txt (from gen_interface.py), the interface is every residue
+    # with a heavy atom within 5 A of the other partner, close to PyMOL's
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from run import AA_CODES, CIF_SUFFIXES, GRAPH_RESIDUES, read_atoms, read_inter_result
+
+# build_graph's dense step: the (N, N) int64 atom and edge types, and the (N, N, 3) float32
+# row, col and direction tensors at once, per pair of graph atoms (52-58 measured)
+PAIR_BYTES = 56
+# tiled: a (tile, N, 3) difference and its square, and (tile, N) distances and flags, per pair;
+# 36 bytes, but up to 94 were measured with what the allocator keeps between tiles
+TILE_PAIR_BYTES = 96
+# encoder: the (edges, 256) float32 gather and weighted messages of an attention layer, and
+# the (edges, 8) logits, per edge
+EDGE_BYTES = 2*256*4 + 8*4*8
+# encoder: activations, projections and outputs of the four layers, per node (measured)
+NODE_BYTES = 30*256*4
+# the PDB lines, the AtomTable and build_graph's atom tokens, per atom of the structure
+ATOM_BYTES = 600
+# edges per graph atom within the 3 A cutoff, self-loops included (6.8 on data/testExamples)
+EDGES_PER_NODE = 7.5
+# Python and torch before any model or graph (the encoder and GBT files are added to it)
+BASE_MB = 500
+# shares of the budget left to each stage, the rest being the base process and the graphs
+GRAPH_SHARE = 0.5
+ENCODER_SHARE = 0.25
+MB = float(1 << 20)
+
+
+def budget_mb():
+    """The memory budget in MB ($GEOPPI_MEMORY_MB), None without one"""
+    value = os.environ.get('GEOPPI_MEMORY_MB')
+    return float(value) if value else None
+
+
+def graph_mb(nodes, tile=None):
+    """Peak MB of build_graph's edge step for a graph of nodes atoms, dense or in tiles of tile atoms"""
+    if tile is None:
+        return PAIR_BYTES*nodes*nodes / MB
+    return TILE_PAIR_BYTES*min(tile, nodes)*nodes / MB
+
+
+def encoder_mb(nodes, edges=None, chunk=0):
+    """Peak MB of one encoder pass; edges defaults to EDGES_PER_NODE per node"""
+    if edges is None:
+        edges = EDGES_PER_NODE*nodes
+    if chunk > 0:
+        edges = min(edges, chunk)
+    return (EDGE_BYTES*edges + NODE_BYTES*nodes) / MB
+
+
+def base_mb(models='trainedmodels'):
+    """MB of the process before any graph: Python and torch, the encoder, and the GBT as load_models reads it"""
+    gbt = os.path.join(models, 'gbt-s4169.npz')
+    if not os.path.exists(gbt):
+        gbt = os.path.join(models, 'gbt-s4169.pkl')
+    encoder = os.path.join(models, 'GeoEnc.pt')
+    if not os.path.exists(encoder):
+        encoder = os.path.join(models, 'GeoEnc.tor')
+    # unpickled trees take about twice their file size
+    return BASE_MB + sum(factor*os.path.getsize(x) / MB for x, factor in ((gbt, 2), (encoder, 1)) if os.path.exists(x))
+
+
+def graph_tile(nodes, budget=None):
+    """Atoms per tile of build_graph's edge step, or None when the dense step fits the budget"""
+    budget = budget_mb() if budget is None else budget
+    if budget is None or graph_mb(nodes) <= GRAPH_SHARE*budget:
+        return None
+    return max(int(GRAPH_SHARE*budget*MB / (TILE_PAIR_BYTES*nodes)), 1)
+
+
+def encoder_chunk(budget=None):
+    """Edges per chunk of the encoder's attention layers for the budget, 0 without one"""
+    budget = budget_mb() if budget is None else budget
+    if budget is None:
+        return 0
+    return max(int(ENCODER_SHARE*budget*MB / EDGE_BYTES), 1024)
+
+
+def configure_encoder(model, budget=None):
+    """
+    Chunk the attention layers of a TorchScript encoder for the budget; returns the
+    chunk, or None when the model has no chunked layers (eager model, older export)
+    """
+    chunk = encoder_chunk(budget)
+    layers = [getattr(model, name, None) for name in ('conv1', 'conv2', 'conv3', 'conv4')]
+    if not all(hasattr(layer, 'edge_chunk') for layer in layers):
+        return None
+    for layer in layers:
+        layer.edge_chunk = chunk
+    return chunk
+
+
+def estimate(nodes, edges=None, atoms=0, budget=None, models='trainedmodels'):
+    """
+    Estimated peak MB of a prediction on a graph of nodes atoms (and edges edges) from a
+    structure of atoms atoms, by stage
+    """
+    budget = budget_mb() if budget is None else budget
+    tile = graph_tile(nodes, budget)
+    chunk = encoder_chunk(budget)
+    base = base_mb(models) + ATOM_BYTES*atoms / MB
+    stages = {'base': base, 'build_graph': graph_mb(nodes, tile), 'encoder': encoder_mb(nodes, edges, chunk)}
+    # the wildtype and mutant graphs are both alive while the encoder runs
+    graphs = 2*(nodes*33*4 + (EDGES_PER_NODE*nodes if edges is None else edges)*3*8) / MB
+    return dict(stages, graphs=graphs, tile=tile, chunk=chunk or None,
+                peak=base + graphs + max(stages['build_graph'], stages['encoder']))
+
+
+def graph_nodes(table, interface_res, mutinfo, max_dis=12):
+    """The number of atoms build_graph keeps of an AtomTable: those within max_dis of the interface or the mutation"""
+    keep = []
+    for atom, resname in zip(table.atom, table.resname):
+        element = [x for x in atom if x.isalpha()][:1]
+        keep.append(bool(element) and element[0] in 'CNOS' and (resname in GRAPH_RESIDUES or resname[1:] in GRAPH_RESIDUES))
+    keep = np.array(keep, dtype=bool)
+    sites = set(interface_res) | set(mutinfo)
+    tokens = np.array(['{}_{}'.format(chain, resid) for chain, resid in zip(table.chain, table.resid)])
+    centers = keep & np.isin(tokens, list(sites))
+    if not centers.any():
+        return 0
+    coords = np.asarray(table.coords, dtype=float)
+    center_coords = coords[centers]
+    near = np.zeros(len(coords), dtype=bool)
+    step = max(int(2e7 // len(center_coords)), 1)
+    for start in range(0, len(coords), step):
+        block = coords[start:start + step]
+        near[start:start + step] = (((block[:, None, :] - center_coords[None, :, :])**2).sum(2) < max_dis*max_dis).any(1)
+    return int((keep & (near | centers)).sum())
+
+
+def contact_residues(table, first, second, cutoff=5.0):
+    """chain_resid tokens of the residues of chains first and second with a heavy atom within cutoff A of the other"""
+    chains = np.array(table.chain)
+    heavy = np.array([not x.startswith('H') for x in table.atom], dtype=bool)
+    coords = np.asarray(table.coords, dtype=float)
+    tokens = np.array(['{}_{}'.format(chain, resid) for chain, resid in zip(table.chain, table.resid)])
+    side_a = np.flatnonzero(heavy & np.isin(chains, list(first)))
+    side_b = np.flatnonzero(heavy & np.isin(chains, list(second)))
+    if len(side_a) == 0 or len(side_b) == 0:
+        return []
+    # only atoms within cutoff of the other side's bounding box can touch it
+    a, b = coords[side_a], coords[side_b]
+    side_a = side_a[((a > b.min(0) - cutoff) & (a < b.max(0) + cutoff)).all(1)]
+    side_b = side_b[((b > a.min(0) - cutoff) & (b < a.max(0) + cutoff)).all(1)]
+    hits_a = np.zeros(len(side_a), dtype=bool)
+    hits_b = np.zeros(len(side_b), dtype=bool)
+    step = max(int(2e7 // max(len(side_b), 1)), 1)
+    for start in range(0, len(side_a), step):
+        close = ((coords[side_a[start:start + step], None, :] - coords[None, side_b, :])**2).sum(2) <= cutoff*cutoff
+        hits_a[start:start + step] = close.any(1)
+        hits_b |= close.any(0)
+    return list(dict.fromkeys(tokens[side_a[hits_a]].tolist() + tokens[side_b[hits_b]].tolist()))
+
+
+def estimate_structure(pdbfile, mutations, partners, interfacefile=None, budget=None, models='trainedmodels'):
+    """
+    Estimates of the mutations (e.g. ['TI17R']) of a structure, in order; the interface
+    is approximated without interfacefile. models is the trainedmodels directory.
+    """
+    if pdbfile.endswith(CIF_SUFFIXES):
+        from mmcif import read_mmcif
+        table = read_mmcif(pdbfile)
+    else:
+        with open(pdbfile) as f:
+            table = read_atoms(f.read().splitlines())
+    contacts = {}
+    estimates = []
+    for mutation in mutations:
+        chainid, resid = mutation[1], mutation[2:-1]
+        if interfacefile is not None:
+            interface = read_inter_result(interfacefile, partners, [chainid])
+        else:
+            # like read_inter_result, the interface of the mutated chain with the other partner
+            if chainid not in contacts:
+                other = [x for x in partners.split('_') if chainid not in x]
+                contacts[chainid] = contact_residues(table, chainid, other[0] if other else '')
+            interface = contacts[chainid]
+        nodes = graph_nodes(table, interface, ['{}_{}'.format(chainid, resid)])
+        estimates.append(dict(estimate(nodes, atoms=len(table.atom), budget=budget, models=models),
+                              mutation=mutation, nodes=nodes))
+    return estimates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate the peak memory of GeoPPI predictions')
+    parser.add_argument('command', choices=['estimate'])
+    parser.add_argument('pdbfile')
+    parser.add_argument('mutations', help='Mutation, or comma-separated mutations, e.g. TI17R,TI17A')
+    parser.add_argument('partners', help='Binding partners, e.g. E_I')
+    parser.add_argument('--interface', help='interface.txt of gen_interface.py (default: 5 A contacts)')
+    parser.add_argument('--budget', type=float, help='Memory budget in MB (default: $GEOPPI_MEMORY_MB)')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.pdbfile):
+        print('Error: {} does not exist'.format(args.pdbfile))
+        sys.exit(1)
+    mutations = args.mutations.split(',')
+    for mutation in mutations:
+        if mutation[0] not in AA_CODES.values() or mutation[-1] not in AA_CODES.values():
+            print('Error: {} is not a mutation such as TI17R'.format(mutation))
+            sys.exit(1)
+    budget = args.budget if args.budget is not None else budget_mb()
+    for entry in estimate_structure(args.pdbfile, mutations, args.partners, args.interface, budget):
+        print('{}: {} graph atoms, peak ~{:.0f} MB (base {:.0f}, graphs {:.0f}, build_graph {:.0f}{}, encoder {:.0f}{})'.format(
+            entry['mutation'], entry['nodes'], entry['peak'], entry['base'], entry['graphs'], entry['build_graph'],
+            '' if entry['tile'] is None else ' in tiles of {}'.format(entry['tile']), entry['encoder'],
+            '' if entry['chunk'] is None else ' in chunks of {} edges'.format(entry['chunk'])))
+    if budget is not None:
+        print('Budget: {:.0f} MB'.format(budget))
+
+if __name__ == "__main__":
+    main()
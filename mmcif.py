@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+mmCIF and BinaryCIF structures.
+
+AlphaFold 3 and the PDB archive write mmCIF. Here the _atom_site loop is read
+column-wise: the loop is cut out of the file in one piece and split into
+tokens at once (a regular expression only when values are quoted), the tokens
+become one NumPy row per atom with the columns as views, models and ATOM
+records are selected with boolean masks, and coordinates are converted a
+column at a time. Splitting the text dominates, so a 200k-atom file loads in
+about the time read_atoms takes on the same atoms as PDB text; what is saved
+is the conversion to PDB. BinaryCIF (.bcif) columns are decoded with NumPy and
+need the msgpack package.
+
+read_mmcif returns the run.AtomTable that build_graph consumes, so
+gen_graph_data reads .cif files without going through PDB text. FoldX and
+PyMOL still need a PDB file; run.py and pipeline.py write one with write_pdb
+when they copy the input structure for its builds.
+
+PDB records have one column for the chain ID. Chains with longer IDs (e.g.
+AA, or the B-2 of assemblies) are given unused single-character IDs, in order
+of appearance, by read_mmcif and write_pdb alike; mutations and binding
+partners refer to those. python mmcif.py info shows the mapping.
+
+Usage:
+    python mmcif.py info [structure.cif]
+    python mmcif.py convert [structure.cif] [structure.pdb]
+"""
+
+import re
+import string
+import sys
+import time
+
+import numpy as np
+
+from run import AtomTable
+
+# quoted values end at a quote followed by whitespace, so O5' and "O5'" are both one token
+TOKEN = re.compile(r"""'(.*?)'(?=\s|$)|"(.*?)"(?=\s|$)|(\S+)""", re.S)
+# the line that ends a loop: a comment, another loop or item, or another data block
+LOOP_END = re.compile(r'\n(?:#|loop_|_|data_)')
+SINGLE_CHAIN_IDS = string.ascii_uppercase + string.ascii_lowercase + string.digits
+MISSING = ('.', '?')
+# the _atom_site columns of an AtomTable
+TABLE_COLUMNS = ('auth_atom_id', 'auth_comp_id', 'auth_asym_id', 'auth_seq_id', 'pdbx_PDB_ins_code', 'label_alt_id',
+                 'Cartn_x', 'Cartn_y', 'Cartn_z')
+
+# BinaryCIF ByteArray type codes
+BCIF_TYPES = {1: '<i1', 2: '<i2', 3: '<i4', 4: '<u1', 5: '<u2', 6: '<u4', 32: '<f4', 33: '<f8'}
+
+
+def _tokens(block):
+    if "'" not in block and '"' not in block:
+        return block.split()
+    return [a or b or c for a, b, c in TOKEN.findall(block)]
+
+
+def read_cif_loop(text, category='_atom_site'):
+    """The columns of a loop_ category of mmCIF text as {name: array of strings}"""
+    header = re.search(r'^loop_\s*\n(\s*{}\.\S+\s*\n)+'.format(re.escape(category)), text, re.M)
+    if header is None:
+        raise ValueError('no {} loop'.format(category))
+    names = [x.strip()[len(category) + 1:] for x in header.group(0).splitlines()[1:]]
+    start = header.end()
+    end = LOOP_END.search(text, start - 1)
+    tokens = _tokens(text[start:end.start() if end else len(text)])
+    if len(tokens) % len(names):
+        raise ValueError('{} values do not fill {} columns of {}'.format(len(tokens), len(names), category))
+    # one row per atom; the columns are views of it
+    table = np.array(tokens, dtype=object).reshape(-1, len(names))
+    return dict((name, table[:, i]) for i, name in enumerate(names))
+
+
+def _decode(data, encodings):
+    """Undo the BinaryCIF encodings of a column, last first"""
+    for encoding in reversed(encodings):
+        kind = encoding['kind']
+        if kind == 'ByteArray':
+            data = np.frombuffer(data, dtype=BCIF_TYPES[encoding['type']])
+        elif kind == 'FixedPoint':
+            data = data.astype(np.float64) / encoding['factor']
+        elif kind == 'IntervalQuantization':
+            step = (encoding['max'] - encoding['min']) / max(encoding['numSteps'] - 1, 1)
+            data = encoding['min'] + step*data.astype(np.float64)
+        elif kind == 'RunLength':
+            data = np.repeat(data[0::2], data[1::2])
+        elif kind == 'Delta':
+            data = np.cumsum(data.astype(np.int64)) + encoding['origin']
+        elif kind == 'IntegerPacking':
+            # values beyond the packed range are sums of limit values and one remainder
+            upper = (1 << 8*encoding['byteCount']) - 1 if encoding['isUnsigned'] else (1 << 8*encoding['byteCount'] - 1) - 1
+            lower = None if encoding['isUnsigned'] else -upper - 1
+            data = data.astype(np.int64)
+            last = (data != upper) if lower is None else (data != upper) & (data != lower)
+            ends = np.flatnonzero(last)
+            data = np.add.reduceat(data, np.concatenate([[0], ends[:-1] + 1])) if len(ends) else data[:0]
+        elif kind == 'StringArray':
+            offsets = _decode(encoding['offsets'], encoding['offsetEncoding'])
+            strings = encoding['stringData']
+            table = np.array([strings[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)] + [''], dtype=object)
+            data = table[_decode(data, encoding['dataEncoding'])]
+        else:
+            raise ValueError('unknown BinaryCIF encoding {}'.format(kind))
+    return data
+
+
+def read_bcif_category(source, category='_atom_site'):
+    """The columns of a BinaryCIF category as {name: array of strings}"""
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError('reading BinaryCIF needs the msgpack package (pip install msgpack)')
+    with open(source, 'rb') as f:
+        content = msgpack.unpackb(f.read(), raw=False)
+    for block in content['dataBlocks']:
+        for found in block['categories']:
+            if found['name'] != category:
+                continue
+            columns = {}
+            for column in found['columns']:
+                values = _decode(column['data']['data'], column['data']['encoding'])
+                values = np.array([str(x) for x in values.tolist()], dtype=object)
+                if column.get('mask'):
+                    mask = _decode(column['mask']['data'], column['mask']['encoding'])
+                    values = np.where(mask == 0, values, np.array(('',) + MISSING, dtype=object)[mask])
+                columns[column['name']] = values
+            return columns
+    raise ValueError('no {} category in {}'.format(category, source))
+
+
+def _read_atom_site(source):
+    if source.endswith('.bcif'):
+        return read_bcif_category(source)
+    with open(source) as f:
+        return read_cif_loop(f.read())
+
+
+def _read_auth_atom_site(source):
+    columns = _read_atom_site(source)
+    for name in ('atom_id', 'comp_id', 'asym_id', 'seq_id'):
+        if 'auth_' + name not in columns:
+            columns['auth_' + name] = columns['label_' + name]
+    return columns
+
+
+def _rows(columns, keep):
+    """The rows of columns where the boolean array keep is set"""
+    return dict((name, values[keep]) for name, values in columns.items())
+
+
+def _in_order(values):
+    """The distinct values of an array, in order of first appearance"""
+    unique, first = np.unique(values, return_index=True)
+    return unique[np.argsort(first)].tolist()
+
+
+def _missing(values):
+    return (values == '?') | (values == '.')
+
+
+def model_atom_sites(source):
+    """[(model number, _atom_site columns)] of every model of an mmCIF or BinaryCIF file, reading it once"""
+    columns = _read_auth_atom_site(source)
+    models = columns.get('pdbx_PDB_model_num')
+    if models is None or not len(models):
+        return [('1', columns)]
+    numbers = _in_order(models)
+    if len(numbers) == 1:
+        return [(numbers[0], columns)]
+    return [(model, _rows(columns, models == model)) for model in numbers]
+
+
+def atom_site(source, model=None):
+    """The _atom_site columns of one model (the first by default) of an mmCIF or BinaryCIF file"""
+    columns = _read_auth_atom_site(source)
+    models = columns.get('pdbx_PDB_model_num')
+    if models is not None and len(models):
+        keep = models == (models[0] if model is None else str(model))
+        if not keep.all():
+            columns = _rows(columns, keep)
+    return columns
+
+
+def chain_map(chains):
+    """Single-character PDB chain IDs of mmCIF chain IDs, in order of appearance"""
+    chains = _in_order(chains)
+    free = [x for x in SINGLE_CHAIN_IDS if x not in chains]
+    mapping = {}
+    for chain in chains:
+        if len(chain) == 1:
+            mapping[chain] = chain
+        elif not free:
+            raise ValueError('{} chains do not fit single-character chain IDs'.format(len(chains)))
+        else:
+            mapping[chain] = free.pop(0)
+    return mapping
+
+
+def _resids(columns):
+    codes = columns.get('pdbx_PDB_ins_code')
+    if codes is None:
+        return columns['auth_seq_id']
+    missing = _missing(codes)
+    if missing.all():
+        return columns['auth_seq_id']
+    return np.where(missing, columns['auth_seq_id'], columns['auth_seq_id'] + codes)
+
+
+def _coords(columns):
+    return np.stack([columns[name].astype(float) for name in ('Cartn_x', 'Cartn_y', 'Cartn_z')], axis=1)
+
+
+def read_mmcif(source, model=None):
+    """The ATOM records of an mmCIF or BinaryCIF file as a run.AtomTable"""
+    return atom_table(atom_site(source, model))
+
+
+def atom_table(columns):
+    """The ATOM records of the _atom_site columns of one model as a run.AtomTable"""
+    mapping = chain_map(columns['auth_asym_id'])
+    atoms = columns['group_PDB'] == 'ATOM'
+    columns = dict((name, columns[name]) for name in TABLE_COLUMNS if name in columns)
+    if not atoms.all():
+        columns = _rows(columns, atoms)
+    resnames, alts = columns['auth_comp_id'], columns.get('label_alt_id')
+    if alts is not None:
+        missing = _missing(alts)
+        if not missing.all():
+            # like PDB columns 17-21, the residue name carries the altLoc indicator
+            resnames = np.where(missing, resnames, alts + resnames)
+    chains = columns['auth_asym_id']
+    if any(len(x) > 1 for x in mapping):
+        ids, inverse = np.unique(chains, return_inverse=True)
+        chains = np.array([mapping[x] for x in ids], dtype=object)[inverse]
+    # build_graph walks the table atom by atom, which is faster over lists than arrays
+    return AtomTable(columns['auth_atom_id'].tolist(), resnames.tolist(), chains.tolist(),
+                     _resids(columns).tolist(), _coords(columns))
+
+
+def _atom_name(name, element):
+    # PDB convention: names of one-letter elements start in column 14 unless they fill all four columns
+    return ' ' + name if len(name) < 4 and len(element) == 1 else name
+
+
+def write_pdb(source, outfile, model=None):
+    """Write the ATOM and HETATM records of an mmCIF or BinaryCIF file as a PDB file; returns the chain mapping"""
+    return write_pdb_columns(atom_site(source, model), outfile)
+
+
+def write_pdb_columns(columns, outfile):
+    """Write _atom_site columns of one model as a PDB file; returns the chain mapping"""
+    n = len(columns['group_PDB'])
+    mapping = chain_map(columns['auth_asym_id'])
+    coords = _coords(columns)
+    resids = _resids(columns).tolist()
+    # the records are formatted one by one, from lists
+    columns = dict((name, values.tolist()) for name, values in columns.items())
+    alts = columns.get('label_alt_id', ['.']*n)
+    elements = columns.get('type_symbol', ['']*n)
+    occupancy = columns.get('occupancy', ['1']*n)
+    bfactor = columns.get('B_iso_or_equiv', ['0']*n)
+    lines, previous = [], None
+    for i in range(n):
+        chain = mapping[columns['auth_asym_id'][i]]
+        if previous is not None and chain != previous:
+            lines.append('TER\n')
+        previous = chain
+        resid = resids[i]
+        number, code = (resid[:-1], resid[-1]) if resid[-1].isalpha() else (resid, ' ')
+        if len(number) > 4:
+            raise ValueError('residue number {} of chain {} does not fit a PDB file'.format(number, chain))
+        element = elements[i] if elements[i] not in MISSING else ''
+        alt = alts[i] if alts[i] not in MISSING else ' '
+        lines.append('{:<6s}{:>5d} {:<4s}{:1s}{:>3s} {:1s}{:>4s}{:1s}   {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}          {:>2s}\n'.format(
+            columns['group_PDB'][i], (i + 1) % 100000, _atom_name(columns['auth_atom_id'][i], element), alt,
+            columns['auth_comp_id'][i], chain, number, code, coords[i, 0], coords[i, 1], coords[i, 2],
+            float(occupancy[i]) if occupancy[i] not in MISSING else 1.0,
+            float(bfactor[i]) if bfactor[i] not in MISSING else 0.0, element))
+    with open(outfile, 'w') as f:
+        f.writelines(lines + ['TER\n', 'END\n'])
+    return mapping
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ('info', 'convert') or (sys.argv[1] == 'convert' and len(sys.argv) < 4):
+        print(__doc__.split('Usage:')[1].rstrip())
+        sys.exit(1)
+    source = sys.argv[2]
+    start = time.time()
+    table = read_mmcif(source)
+    elapsed = time.time() - start
+    print('{}: {} atoms, {} residues in {:.3f} s'.format(source, len(table.atom),
+                                                     len(set(zip(table.chain, table.resid))), elapsed))
+    mapping = chain_map(atom_site(source)['auth_asym_id'])
+    for chain, pdb_chain in mapping.items():
+        print('  chain {:6s} -> {}'.format(chain, pdb_chain))
+    if sys.argv[1] == 'convert':
+        write_pdb(source, sys.argv[3])
+        print('Written to {}'.format(sys.argv[3]))
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,6 @@
 import torch
 import  torch.nn  as nn
 import torch.nn.functional as F
-from torch_geometric.data import DataLoader
-from torch_geometric.nn import GATConv, NNConv, FeaStConv
-from cgat import CGAT
 import numpy as np
 
 
@@ -11,6 +8,9 @@ import numpy as np
 class GeometricEncoder(torch.nn.Module):
     def __init__(self, hidden_size,nheads=8):
         super(GeometricEncoder, self).__init__()
+        # torch_geometric is only needed to build the eager model, not to run a TorchScript export
+        from torch_geometric.nn import GATConv
+        from cgat import CGAT
         num_edge_feature = 4
         num_atom_feature = 33
         nf = hidden_size
@@ -45,60 +45,157 @@ class GeometricEncoder(torch.nn.Module):
 
         return x3,x4
 
-    def gen_features(self, X, E, Ea, X_m, E_m, Ea_m):
-
+    def gen_features(self, X, E, Ea, X_m, E_m, Ea_m, blocks=None):
+        """
+        blocks: indices into FEATURE_BLOCKS to compute, in output order (default: all 18)
+        """
         x3,x4 = self.step(X,E,Ea)
         x3_m,x4_m = self.step(X_m,E_m,Ea_m)
+        return self.pool_features(X, x3, x4, X_m, x3_m, x4_m, blocks)
+
+    def embed(self, X, E):
+        """step() of one graph, as gen_features calls it; returns x3, x4"""
+        return self.step(X, E, E)
 
+    def pool_features(self, X, x3, x4, X_m, x3_m, x4_m, blocks=None):
+        """gen_features from the embeddings of both graphs, so that a wildtype's can be reused"""
         idx = torch.nonzero((X[:,-1]==1).float()).view(-1)
         idxm = torch.nonzero((X_m[:,-1]==1).float()).view(-1)
-        maxx4 = torch.max(x4[idx,:],0)[0]
-        maxx4m = torch.max(x4_m[idxm,:],0)[0]
-        meanx4 = torch.sum(x4[idx,:],0)
-        meanx4m = torch.sum(x4_m[idxm,:],0)
-
-        maxx3 = torch.max(x3[idx,:],0)[0]
-        maxx3m = torch.max(x3_m[idxm,:],0)[0]
-        meanx3 = torch.mean(x3[idx,:],0)
-        meanx3m = torch.mean(x3_m[idxm,:],0)
-
         id_contact = torch.nonzero((X[:,24]==1).float()).view(-1)
         idm_contact = torch.nonzero((X_m[:,24]==1).float()).view(-1)
 
-        maxx4_contact = torch.max(x4[id_contact,:],0)[0]
-        maxx4m_contact = torch.max(x4_m[idm_contact,:],0)[0]
-        meanx4_contact = torch.sum(x4[id_contact,:],0)
-        meanx4m_contact = torch.sum(x4_m[idm_contact,:],0)
-
-
-        maxx3_contact = torch.max(x3[id_contact,:],0)[0]
-        maxx3m_contact = torch.max(x3_m[idm_contact,:],0)[0]
-        meanx3_contact = torch.mean(x3[id_contact,:],0)
-        meanx3m_contact = torch.mean(x3_m[idm_contact,:],0)
-
-
-        rep1 = [maxx4, maxx4m, meanx4, meanx4m, maxx4_contact, maxx4m_contact, meanx4_contact,meanx4m_contact,\
-                maxx3, maxx3m, meanx3, meanx3m, maxx3_contact, maxx3m_contact, meanx3_contact,meanx3m_contact]
-        
-        rep = torch.cat(rep1+[maxx4-maxx4m, meanx4-meanx4m],0) # (2d
+        # each entry pools one 256-d block of FEATURE_BLOCKS; only requested ones are evaluated
+        pools = [
+            lambda: torch.max(x4[idx,:],0)[0],
+            lambda: torch.max(x4_m[idxm,:],0)[0],
+            lambda: torch.sum(x4[idx,:],0),
+            lambda: torch.sum(x4_m[idxm,:],0),
+            lambda: torch.max(x4[id_contact,:],0)[0],
+            lambda: torch.max(x4_m[idm_contact,:],0)[0],
+            lambda: torch.sum(x4[id_contact,:],0),
+            lambda: torch.sum(x4_m[idm_contact,:],0),
+            lambda: torch.max(x3[idx,:],0)[0],
+            lambda: torch.max(x3_m[idxm,:],0)[0],
+            lambda: torch.mean(x3[idx,:],0),
+            lambda: torch.mean(x3_m[idxm,:],0),
+            lambda: torch.max(x3[id_contact,:],0)[0],
+            lambda: torch.max(x3_m[idm_contact,:],0)[0],
+            lambda: torch.mean(x3[id_contact,:],0),
+            lambda: torch.mean(x3_m[idm_contact,:],0),
+            lambda: block(0)-block(1),
+            lambda: block(2)-block(3),
+        ]
+        cache = {}
+        def block(b):
+            if b not in cache:
+                cache[b] = pools[b]()
+            return cache[b]
+
+        if blocks is None:
+            blocks = range(len(FEATURE_BLOCKS))
+        rep = torch.cat([block(b) for b in blocks],0) # (2d
         return rep
 
 
-def GeoPPIpredict(A, E, A_m, E_m, model, forest, sorted_idx,flag):
-
+# Layout of the vector returned by GeometricEncoder.gen_features; each block is hidden_size wide.
+# "sum" blocks are named mean* in gen_features for historical reasons.
+FEATURE_BLOCKS = ['max_x4', 'max_x4_m', 'sum_x4', 'sum_x4_m',
+        'max_x4_contact', 'max_x4_m_contact', 'sum_x4_contact', 'sum_x4_m_contact',
+        'max_x3', 'max_x3_m', 'mean_x3', 'mean_x3_m',
+        'max_x3_contact', 'max_x3_m_contact', 'mean_x3_contact', 'mean_x3_m_contact',
+        'max_x4_diff', 'sum_x4_diff']
+
+
+def n_selected(forest, default=240):
+    """Top-ranked features the regressor was fitted on (train_gbt.py --n-select; 240 for gbt-s4169)"""
+    for name in ('n_features', 'n_features_in_', 'n_features_'):
+        n = getattr(forest, name, None)
+        if n:
+            return int(n)
+    return default
+
+
+class FeaturePlan(object):
+    """
+    Which feature blocks the regressor reads, derived from sortidx.npy.
+
+    The GBT only consumes sorted_idx[:n_select] of the full 18*dim vector
+    (n_select = n_selected(forest)), so
+    gen_features(blocks=plan.blocks) skips every pooled block outside that set
+    and plan.index selects the same columns from the compact vector
+    (plan.selected from the full vector).
+    """
+    def __init__(self, sorted_idx, n_select=240, dim=256):
+        selected = np.asarray(sorted_idx[:n_select])
+        self.selected = selected
+        self.blocks = [int(b) for b in sorted(set(selected // dim))]
+        position = {b:i for i,b in enumerate(self.blocks)}
+        self.index = np.array([position[i // dim]*dim + i % dim for i in selected])
+
+    def __repr__(self):
+        return 'FeaturePlan({} of {} blocks: {})'.format(len(self.blocks), len(FEATURE_BLOCKS),
+                ', '.join(FEATURE_BLOCKS[b] for b in self.blocks))
+
+
+def GeoPPIpredict(A, E, A_m, E_m, model, forest, sorted_idx,flag, plan=None):
+
+    return GeoPPIpredictBatch([(A, E, A_m, E_m, flag)], model, forest, sorted_idx, plan)[0]
+
+
+def GeoPPIpredictBatch(samples, model, forest, sorted_idx, plan=None, return_features=False):
+    """
+    GeoPPIpredict for a list of (A, E, A_m, E_m, flag), with one GBT call for the whole batch.
+    With return_features, all 18 blocks are computed and (ddgs, rounded feature vectors) is returned;
+    without a forest the ddgs are None.
+    """
+    if forest is None:
+        # feature vectors only (train_gbt.py)
+        blocks, index = None, None
+    else:
+        if plan is None:
+            plan = FeaturePlan(sorted_idx, n_selected(forest))
+        blocks, index = (None, plan.selected) if return_features else (plan.blocks, plan.index)
     with torch.no_grad():
-        fea = model.gen_features(A, E, E, A_m, E_m, E_m)
-
-    features = np.round(fea.cpu().view(1,-1).numpy(),3)
-    ddg = forest.predict(features[:,sorted_idx[:240]])
-    ddg = np.round(ddg[0],2)
-    if ddg>8.0:
-        ddg =8.0
-    elif ddg<-8.0:
-        ddg = -8.0
-    # Note that our model is able to predict a small value to the case of "no mutaiton" (e.g., TI17T). To further calibrate the prediction, we set the output of this case to zero.
-    if flag: ddg=0.0
- 
-    return ddg
-
-
+        fea = [model.gen_features(A, E, E, A_m, E_m, E_m, blocks=blocks).cpu() for A, E, A_m, E_m, _ in samples]
+
+    features = np.round(torch.stack(fea).numpy(),3)
+    if forest is None:
+        return [None]*len(samples), features
+    ddgs = GeoPPIregress(features[:,index], forest, [flag for _, _, _, _, flag in samples])
+    if return_features:
+        return ddgs, features
+    return ddgs
+
+
+def GeoPPIpredictShared(A, E, mutants, model, forest, sorted_idx, plan=None, embedding=None):
+    """
+    ddGs of several mutants [(A_m, E_m)] of one wildtype graph, which is embedded only once
+    (or not at all, given its model.embed output). Encoders exported without pool_features
+    fall back to gen_features.
+    """
+    if plan is None:
+        plan = FeaturePlan(sorted_idx, n_selected(forest))
+    with torch.no_grad():
+        if hasattr(model, 'pool_features'):
+            x3, x4 = embedding if embedding is not None else model.embed(A, E)
+            fea = [model.pool_features(A, x3, x4, A_m, *model.embed(A_m, E_m), plan.blocks).cpu() for A_m, E_m in mutants]
+        else:
+            fea = [model.gen_features(A, E, E, A_m, E_m, E_m, blocks=plan.blocks).cpu() for A_m, E_m in mutants]
+
+    features = np.round(torch.stack(fea).numpy(),3)
+    return GeoPPIregress(features[:,plan.index], forest, [False]*len(mutants))
+
+
+def GeoPPIregress(features, forest, flags):
+    """The GBT head: ddGs for rows of selected, rounded features"""
+    ddgs = []
+    for ddg, flag in zip(forest.predict(features), flags):
+        ddg = np.round(ddg,2)
+        if ddg>8.0:
+            ddg =8.0
+        elif ddg<-8.0:
+            ddg = -8.0
+        # Note that our model is able to predict a small value to the case of "no mutaiton" (e.g., TI17T). To further calibrate the prediction, we set the output of this case to zero.
+        if flag: ddg=0.0
+        ddgs.append(ddg)
+    return ddgs
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+"""
+Pipelined batch prediction: FoldX builds, featurization and inference overlap.
+
+run.py handles one mutation at a time, so FoldX idles while graphs are
+parsed and the encoder idles while FoldX builds the next model. Here each
+mutation flows through three stages connected by bounded queues:
+
+    structures  a pool of threads running PyMOL interface detection (once per
+                structure and partners) and FoldX BuildModel (the wildtype
+                self-mutation once per position, then the mutant), each in
+                its own scratch directory
+    features    a pool of processes running gen_graph_data on both models and
+                writing the graphs into shared memory (shared_graphs.py)
+    inference   one encoder and GBT in this process, scoring whatever is
+                queued in batches of up to --batch-size
+
+A full queue blocks the stage feeding it, so no more than a few structures
+wait between stages, and throughput approaches that of the slowest stage.
+Busy, starved (waiting for input) and blocked (waiting for room downstream)
+time are reported for every stage.
+
+Usage:
+    # saturation mutagenesis of positions, as batch_saturation.py
+    python pipeline.py [pdb file] "[positions]" [partnerA_partnerB] [options]
+    python pipeline.py data/testExamples/1CZ8.pdb "KW84 HL112" WV_HL
+
+    # any list of mutations: CSV with pdb,mutation,partners columns
+    python pipeline.py --jobs jobs.csv [options]
+
+Options:
+    --foldx-workers N     concurrent FoldX/PyMOL builds (default: 4)
+    --feature-workers N   featurization processes (default: 2)
+    --batch-size N        largest inference batch (default: 16)
+    --queue-size N        capacity of each queue between stages (default: 8)
+    --shm-slots N         graphs in flight between featurization and inference
+                          (default: --feature-workers + --queue-size)
+    --shm-slot-mb MB      shared memory per graph pair (default: 64); 0 sends
+                          the graphs through the process pipe instead
+    --crop SHELL          FoldX builds only the residues within SHELL A of the
+                          interface and the mutation (see crop.py)
+    --graph-store DIR     skip FoldX and featurization for samples already in
+                          this graph store, and save new ones (graph_store.py)
+    --feature-store DIR   save every encoder feature vector (feature_store.py)
+    --cache FILE          skip mutations already in this prediction cache, and
+                          save new ddGs (prediction_cache.py; default:
+                          $GEOPPI_CACHE)
+    --scratch DIR         build directory (default: pipeline_tmp)
+    --keep                keep the FoldX models in the build directory
+    -o FILE               output CSV (default: [pdb]_pipeline_ddg.csv)
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import os.path as path
+import queue
+import resource
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from run import parse_mutation, read_residues, run_foldx, validate_inputs, AMINO_ACIDS, CIF_SUFFIXES
+
+
+class Job(object):
+    """One mutation and everything built for it on the way through the pipeline"""
+    def __init__(self, index, pdbfile, mutation, partners, label=None):
+        self.index = index
+        self.pdbfile = pdbfile
+        self.mutation = mutation
+        self.partners = partners
+        self.workdir = None
+        self.structures = None  # wildtypefile, mutantfile, interfacefile, graph_mutinfo, flag
+        self.sample = None      # A, E, A_m, E_m, flag
+        self.slot = None        # shared-memory slot holding the sample's tensors
+        self.key = None         # graph store key
+        self.label = label      # experimental ddG, saved with the feature vector
+        self.ddg = None
+        self.cached = False     # ddg from the prediction cache
+        self.error = None
+
+
+class StageStats(object):
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, busy=0.0, starved=0.0, blocked=0.0, items=0, errors=0):
+        with self.lock:
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+            self.items += items
+            self.errors += errors
+
+    def utilization(self, wall):
+        return self.busy / (wall * self.workers) if wall > 0 else 0.0
+
+
+class Stage(object):
+    """
+    Worker threads applying func to the jobs of inbox and passing them to outbox.
+    Jobs that already failed pass through untouched; a failure in func is
+    recorded on the job. None marks the end of the input.
+    """
+    def __init__(self, name, func, workers, inbox, outbox):
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stats = StageStats(name, workers)
+        self.finished = 0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name='{}-{}'.format(name, i), daemon=True)
+                        for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            start = time.time()
+            job = self.inbox.get()
+            ready = time.time()
+            if job is None:
+                # let the other workers of this stage see the end marker too
+                self.inbox.put(None)
+                break
+
+            error = 0
+            if job.error is None:
+                try:
+                    self.func(job)
+                except Exception as e:
+                    job.error = '{}: {}'.format(self.stats.name, e)
+                    error = 1
+            done = time.time()
+            self.outbox.put(job)
+            self.stats.add(busy=done - ready, starved=ready - start, blocked=time.time() - done, items=1, errors=error)
+
+        with self.lock:
+            self.finished += 1
+            last = self.finished == len(self.threads)
+        if last:
+            self.outbox.put(None)
+
+
+class StructureBuilder(object):
+    """
+    Interface detection and FoldX builds in per-job directories under scratch.
+    The interface (which also rewrites the PDB file through PyMOL, as in run.py)
+    is computed once per structure and partners, and the wildtype self-mutation
+    once per position, however many mutants share them. With crop, FoldX builds
+    from the residues within crop A of the position's sites (see crop.py).
+    """
+    def __init__(self, scratch, crop=None):
+        self.scratch = path.abspath(scratch)
+        self.crop = crop
+        self.lock = threading.Lock()
+        self.prepared = {}
+        self.wildtypes = {}
+
+    def _once(self, cache, key, build):
+        with self.lock:
+            future = cache.get(key)
+            owner = future is None
+            if owner:
+                future = cache[key] = Future()
+        if owner:
+            try:
+                future.set_result(build())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def prepare(self, pdbfile, partners):
+        """Copy the structure into its own directory and detect the interface; returns (dir, pdb name)"""
+        name = path.basename(pdbfile)
+        structdir = path.join(self.scratch, '{}_{}'.format(name.split('.')[0], partners))
+        os.makedirs(structdir, exist_ok=True)
+        if pdbfile.endswith(CIF_SUFFIXES):
+            # FoldX and PyMOL read PDB files
+            from mmcif import write_pdb
+            name = name.split('.')[0] + '.pdb'
+            write_pdb(pdbfile, path.join(structdir, name))
+        else:
+            shutil.copy(pdbfile, path.join(structdir, name))
+        os.system('python gen_interface.py {} {} {} > {}/pymol.log'.format(
+            path.join(structdir, name), partners, structdir, structdir))
+        if not path.exists(path.join(structdir, 'interface.txt')):
+            raise RuntimeError('interface detection failed (see {}/pymol.log)'.format(structdir))
+        return structdir, name
+
+    def foldx(self, structdir, name, mutation, workdir):
+        """Build one FoldX model of structdir/name into workdir; returns the model file"""
+        os.makedirs(workdir, exist_ok=True)
+        run_foldx(name, [mutation], workdir, listfile=path.join(workdir, 'individual_list.txt'), pdb_dir=structdir)
+        model = path.join(workdir, '{}_1.pdb'.format(name.split('.')[0]))
+        if not path.exists(model):
+            raise RuntimeError('FoldX did not build {} (see {}/foldx.log)'.format(mutation, workdir))
+        return model
+
+    def wildtype(self, structdir, name, partners, wildname, chainid, resid):
+        """Build the self-mutation of a position; returns (FoldX input directory, wildtype model)"""
+        posdir = path.join(structdir, 'wildtype_{}{}'.format(chainid, resid))
+        sourcedir = structdir
+        if self.crop is not None:
+            from crop import crop_structure
+            from run import read_inter_result
+            os.makedirs(posdir, exist_ok=True)
+            sites = read_inter_result(path.join(structdir, 'interface.txt'), partners, [chainid])
+            crop_structure(path.join(structdir, name), path.join(posdir, name),
+                           sites + ['{}_{}'.format(chainid, resid)], self.crop)
+            sourcedir = posdir
+        model = self.foldx(sourcedir, name, '{}{}{}{}'.format(wildname, chainid, resid, wildname), posdir)
+        return sourcedir, self.uncrop(structdir, name, model)
+
+    def uncrop(self, structdir, name, model):
+        if self.crop is not None:
+            from crop import splice_structure
+            splice_structure(path.join(structdir, name), model, model)
+        return model
+
+    def structure(self, pdbfile, partners):
+        """The prepared structure and interface, built once; returns (dir, pdb name)"""
+        return self._once(self.prepared, (pdbfile, partners), lambda: self.prepare(pdbfile, partners))
+
+    def position(self, pdbfile, partners, wildname, chainid, resid):
+        """Interface and wildtype model of a position, each built once; returns structdir, name, sourcedir, wildtypefile"""
+        structdir, name = self.structure(pdbfile, partners)
+        sourcedir, wildtypefile = self._once(self.wildtypes, (structdir, chainid, resid),
+                                             lambda: self.wildtype(structdir, name, partners, wildname, chainid, resid))
+        return structdir, name, sourcedir, wildtypefile
+
+    def __call__(self, job):
+        if job.sample is not None:
+            return
+        wildname, chainid, resid, mutname = parse_mutation(job.mutation)
+        structdir, name, sourcedir, wildtypefile = self.position(job.pdbfile, job.partners, wildname, chainid, resid)
+
+        flag = wildname == mutname
+        if flag:
+            # FoldX would rebuild the same self-mutation
+            mutantfile = wildtypefile
+        else:
+            job.workdir = path.join(self.scratch, 'job{}'.format(job.index))
+            mutantfile = self.uncrop(structdir, name, self.foldx(sourcedir, name, job.mutation, job.workdir))
+        job.structures = (wildtypefile, mutantfile, path.join(structdir, 'interface.txt'),
+                          ['{}_{}'.format(chainid, resid)], flag)
+
+
+def _init_feature_worker():
+    import torch
+    # the workers already run in parallel; avoid oversubscribing the cores
+    torch.set_num_threads(1)
+
+
+def featurize(wildtypefile, mutantfile, interfacefile, graph_mutinfo, partners, cutoff=3):
+    """gen_graph_data for the wildtype and mutant models; returns A, E, Ea, A_m, E_m, Ea_m"""
+    from run import gen_graph_data
+    wildtype = gen_graph_data(wildtypefile, graph_mutinfo, interfacefile, cutoff, partners)
+    mutant = gen_graph_data(mutantfile, graph_mutinfo, interfacefile, cutoff, partners)
+    if wildtype is None or mutant is None:
+        raise ValueError('fewer than 5 atoms near the interface')
+    return wildtype + mutant
+
+
+def featurize_shared(name, slot, slot_bytes, *args):
+    """featurize, with the tensors written into a slot of a SharedGraphSlots segment"""
+    from shared_graphs import put_shared
+    return put_shared(name, slot, slot_bytes, featurize(*args))
+
+
+class Featurizer(object):
+    """
+    Featurize in the process pool; with slots, the graphs come back through
+    shared memory, and with a graph store they are also saved there.
+    """
+    def __init__(self, pool, slots=None, store=None, crop=None, keep_builds=False):
+        self.pool = pool
+        self.slots = slots
+        self.store = store
+        self.crop = crop
+        self.keep_builds = keep_builds
+
+    def __call__(self, job):
+        if job.sample is not None:
+            return
+        wildtypefile, mutantfile, interfacefile, graph_mutinfo, flag = job.structures
+        args = (wildtypefile, mutantfile, interfacefile, graph_mutinfo, job.partners)
+        try:
+            if self.slots is None:
+                tensors = self.pool.submit(featurize, *args).result()
+            else:
+                slot = self.slots.acquire()
+                try:
+                    kind, payload = self.pool.submit(featurize_shared, self.slots.name, slot,
+                                                     self.slots.slot_bytes, *args).result()
+                except:
+                    self.slots.release(slot)
+                    raise
+                if kind == 'shared':
+                    job.slot = slot
+                    tensors = self.slots.tensors(slot, payload)
+                else:
+                    self.slots.release(slot)
+                    tensors = payload
+        finally:
+            if job.workdir is not None and not self.keep_builds:
+                shutil.rmtree(job.workdir, ignore_errors=True)
+        A, E, Ea, A_m, E_m, Ea_m = tensors
+        if self.store is not None:
+            self.store.put(job.key, [A, E, Ea], [A_m, E_m, Ea_m], flag,
+                           pdb=job.pdbfile, mutation=job.mutation, partners=job.partners, cutoff=3, crop=self.crop)
+        job.sample = (A, E, A_m, E_m, flag)
+
+
+def infer(inbox, model, forest, sorted_idx, batch_size, stats, on_result, features=None):
+    """Score the featurized jobs of inbox in batches until the end marker, saving vectors to a FeatureStore"""
+    from models import FeaturePlan, n_selected, GeoPPIpredictBatch
+    plan = FeaturePlan(sorted_idx, n_selected(forest)) if sorted_idx is not None else None
+    done = False
+    while not done:
+        start = time.time()
+        batch = [inbox.get()]
+        ready = time.time()
+        while len(batch) < batch_size:
+            try:
+                batch.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            batch.pop()
+            done = True
+
+        ok = [job for job in batch if job.error is None]
+        if ok:
+            try:
+                if features is None:
+                    ddgs = GeoPPIpredictBatch([job.sample for job in ok], model, forest, sorted_idx, plan)
+                else:
+                    ddgs, vectors = GeoPPIpredictBatch([job.sample for job in ok], model, forest, sorted_idx, plan, True)
+                    for job, ddg, vector in zip(ok, ddgs, vectors):
+                        features.add(vector, job.pdbfile, job.mutation, job.partners, job.sample[4], ddg, job.label)
+            except Exception as e:
+                ddgs = [None]*len(ok)
+                for job in ok:
+                    job.error = 'inference: {}'.format(e)
+            for job, ddg in zip(ok, ddgs):
+                job.ddg = ddg
+        for job in batch:
+            job.sample = None
+            on_result(job)
+        stats.add(busy=time.time() - ready, starved=ready - start, items=len(batch),
+                  errors=sum(job.error is not None for job in batch))
+
+
+def saturation_jobs(pdbfile, positions, partners):
+    """Every substitution at each position (e.g. KW84), as batch_saturation.py"""
+    jobs = []
+    for position in positions:
+        wildname, chainid, resid = position[0], position[1], position[2:]
+        for mutname in AMINO_ACIDS:
+            if mutname != wildname:
+                jobs.append((pdbfile, '{}{}{}{}'.format(wildname, chainid, resid, mutname), partners))
+    return jobs
+
+
+def read_jobs(jobsfile):
+    with open(jobsfile, newline='') as f:
+        return [(row['pdb'], row['mutation'], row['partners']) for row in csv.DictReader(f)]
+
+
+def run_pipeline(jobs, model, forest, sorted_idx, foldx_workers=4, feature_workers=2, batch_size=16, queue_size=8,
+                 shm_slots=None, shm_slot_mb=64, crop=None, graph_store=None, features=None, scratch='pipeline_tmp',
+                 keep_builds=False, verbose=True, builder=None, cache=None, keep_scratch=False):
+    """
+    Run Jobs through the three stages. forest may be None to only compute feature vectors
+    (into features, a FeatureStore). A StructureBuilder that already holds interfaces and wildtype
+    models can be passed as builder. With cache (prediction_cache.open_cache), cached mutations
+    skip the stages, so they add no feature vectors, and new ddGs are saved. Each job's FoldX
+    models are removed once featurized unless keep_builds; keep_scratch only leaves the scratch
+    directory itself (and the builder's wildtype models in it) for another run.
+    Returns the jobs in input order, the wall time and the stage stats.
+    """
+    # read each structure once, not once per mutation
+    structures = {}
+    for job in jobs:
+        if job.pdbfile not in structures:
+            structures[job.pdbfile] = read_residues(job.pdbfile) if path.isfile(job.pdbfile) else None
+        problems = validate_inputs(job.pdbfile, job.mutation, job.partners, structures[job.pdbfile])
+        if problems:
+            job.error = 'input: ' + '; '.join(problems)
+    print('{} mutations, {} with input errors'.format(len(jobs), sum(job.error is not None for job in jobs)))
+
+    if cache is not None and forest is not None:
+        valid = [job for job in jobs if job.error is None]
+        for job, ddg in zip(valid, cache.lookup([(job.pdbfile, job.mutation, job.partners) for job in valid])):
+            if ddg is not None:
+                job.ddg, job.cached = ddg, True
+        print('{} mutations found in {}'.format(sum(job.cached for job in jobs), cache.cache.filename))
+
+    store = None
+    if graph_store:
+        from graph_store import GraphStore
+        from keys import file_sha256, sample_key
+        store = GraphStore(graph_store)
+        hashes = {}
+        for job in jobs:
+            if job.error is not None or job.cached:
+                continue
+            if job.pdbfile not in hashes:
+                hashes[job.pdbfile] = file_sha256(job.pdbfile)
+            job.key = sample_key(hashes[job.pdbfile], job.mutation, job.partners, 3, crop)
+            stored = store.get(job.key)
+            if stored is not None:
+                (A, E, _), (A_m, E_m, _), flag = stored
+                job.sample = (A, E, A_m, E_m, flag)
+        print('{} mutations found in {}'.format(sum(job.sample is not None for job in jobs), graph_store))
+
+    # spawned workers do not inherit the OpenMP state of the inference process
+    pool = ProcessPoolExecutor(feature_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_feature_worker)
+    slots = None
+    if shm_slot_mb > 0:
+        from shared_graphs import SharedGraphSlots
+        slots = SharedGraphSlots(shm_slots or feature_workers + queue_size, shm_slot_mb << 20)
+
+    todo = queue.Queue(queue_size)
+    built = queue.Queue(queue_size)
+    featurized = queue.Queue(queue_size)
+    stages = [Stage('structures', builder or StructureBuilder(scratch, crop), foldx_workers, todo, built),
+              Stage('features', Featurizer(pool, slots, store, crop, keep_builds), feature_workers, built, featurized)]
+    inference = StageStats('inference', 1)
+
+    def feed():
+        for job in jobs:
+            if not job.cached:
+                todo.put(job)
+        todo.put(None)
+
+    results = [job for job in jobs if job.cached]
+    def on_result(job):
+        if job.slot is not None:
+            slots.release(job.slot)
+            job.slot = None
+        if cache is not None and forest is not None and job.error is None:
+            cache.add([(job.pdbfile, job.mutation, job.partners, job.ddg)])
+        results.append(job)
+        if verbose:
+            print('{}: {}'.format(job.mutation, job.ddg if job.error is None else 'error ({})'.format(job.error)))
+
+    start = time.time()
+    threading.Thread(target=feed, daemon=True).start()
+    for stage in stages:
+        stage.start()
+    infer(featurized, model, forest, sorted_idx, batch_size, inference, on_result, features)
+    if features is not None:
+        features.flush()
+    wall = time.time() - start
+    pool.shutdown()
+    if slots is not None:
+        slots.close()
+    if not (keep_builds or keep_scratch):
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    results.sort(key=lambda job: job.index)
+    return results, wall, [stage.stats for stage in stages] + [inference]
+
+
+def print_report(results, wall, stats):
+    print('\n{} mutations in {:.1f} s ({:.2f} per minute)'.format(len(results), wall, 60*len(results)/wall))
+    cached = sum(job.cached for job in results)
+    if cached:
+        print('{} of them from the prediction cache'.format(cached))
+    print('{:12s} {:>7s} {:>6s} {:>6s} {:>9s} {:>9s} {:>9s}'.format(
+        'stage', 'workers', 'items', 'util', 'busy s', 'starved s', 'blocked s'))
+    for stage in stats:
+        print('{:12s} {:>7d} {:>6d} {:>5.0f}% {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            stage.name, stage.workers, stage.items, 100*stage.utilization(wall), stage.busy, stage.starved, stage.blocked))
+    # ru_maxrss is in kB on Linux; children include FoldX and PyMOL
+    print('Peak RSS: {:.0f} MB in this process (encoder and GBT), {:.0f} MB in the largest child process'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict many mutations with FoldX, featurization and inference overlapped')
+    parser.add_argument('pdbfile', nargs='?', help='PDB file for saturation mutagenesis')
+    parser.add_argument('positions', nargs='?', help='Positions such as "KW84 HL112"')
+    parser.add_argument('partners', nargs='?', help='Binding partners, e.g. WV_HL')
+    parser.add_argument('--jobs', help='CSV with pdb,mutation,partners columns instead of saturation')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--shm-slots', type=int)
+    parser.add_argument('--shm-slot-mb', type=int, default=64)
+    parser.add_argument('--crop', type=float, metavar='SHELL',
+                        help='Build with FoldX only the residues within SHELL A of the interface and the mutation')
+    parser.add_argument('--graph-store', metavar='DIR')
+    parser.add_argument('--feature-store', metavar='DIR')
+    parser.add_argument('--cache', metavar='FILE', help='Prediction cache (default: $GEOPPI_CACHE)')
+    parser.add_argument('--scratch', default='pipeline_tmp')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    if args.jobs:
+        jobs = read_jobs(args.jobs)
+        output = args.output or path.splitext(path.basename(args.jobs))[0] + '_pipeline_ddg.csv'
+    elif args.partners:
+        jobs = saturation_jobs(args.pdbfile, args.positions.split(), args.partners)
+        output = args.output or path.basename(args.pdbfile).split('.')[0] + '_pipeline_ddg.csv'
+    else:
+        parser.error('give either [pdb file] [positions] [partners] or --jobs')
+
+    jobs = [Job(i, *job) for i, job in enumerate(jobs)]
+    from run import load_models
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    model, forest, sorted_idx = load_models(precision=precision)
+    features = None
+    if args.feature_store:
+        from feature_store import FeatureStore, encoder_id
+        features = FeatureStore(args.feature_store, encoder_id(precision=precision))
+
+    from prediction_cache import open_cache
+    cache = open_cache(args.cache, precision, crop=args.crop)
+    results, wall, stats = run_pipeline(jobs, model, forest, sorted_idx, args.foldx_workers, args.feature_workers,
+                                        args.batch_size, args.queue_size, args.shm_slots, args.shm_slot_mb, args.crop,
+                                        args.graph_store, features, args.scratch, args.keep, cache=cache)
+
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pdb', 'mutation', 'partners', 'ddg', 'error'])
+        for job in results:
+            writer.writerow([job.pdbfile, job.mutation, job.partners,
+                             job.ddg if job.error is None else 'error', job.error or ''])
+
+    print_report(results, wall, stats)
+    if cache is not None:
+        print(cache.summary())
+    print('Results written to {}'.format(output))
+
+if __name__ == "__main__":
+    main()
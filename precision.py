@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Reduced-precision CPU inference for the geometric encoder.
+
+Opt-in modes for the TorchScript encoder of jit_encoder.py:
+    int8  dynamic int8 quantization of the linear maps of layers 2-4 (lin2-lin4
+          and the attention projections of the fused layers)
+    bf16  bfloat16 layers 2-4
+The first layer, which reads raw coordinates, and the pooling stay float32.
+
+Running this script exports trainedmodels/GeoEnc.<mode>.pt for each mode and
+writes trainedmodels/precision_report.json with the ddG deviation from the
+float32 encoder on data/testExamples (and optionally on a benchmark set), plus
+the per-core encoder throughput of every mode. A mode is accepted when its
+maximum deviation stays within the threshold.
+
+At run time, GEOPPI_PRECISION=int8 (or bf16) selects a mode. run.py falls back
+to float32 when the report is missing, was made for a different GeoEnc.tor, or
+the mode's maximum deviation exceeds the threshold (GEOPPI_PRECISION_TOL
+overrides the one stored in the report).
+
+Usage:
+    python precision.py [--modes int8 bf16] [--threshold 0.05]
+                        [--dataset data/benchmarkDatasets/S4169.csv --pdb-dir PDBS --limit 200]
+
+FoldX is needed to build the mutant structures of the evaluation set.
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from jit_encoder import JitEncoder, load_encoder
+from keys import file_sha256
+from run import REDUCED_MODES, reduced_encoder_file
+
+GNNFILE = 'trainedmodels/GeoEnc.tor'
+REPORTFILE = 'trainedmodels/precision_report.json'
+
+
+# the first layer sees raw coordinates and residue indices (up to a few hundred),
+# whose per-tensor int8/bf16 rounding swamps the signal, so it stays float32
+REDUCED_LAYERS = ['conv2.proj', 'conv3.proj', 'conv4.proj', 'lin2', 'lin3', 'lin4']
+
+
+def reduce_precision(encoder, mode):
+    """Return a copy of an (unscripted) JitEncoder running layers 2-4 in the given mode"""
+    encoder = copy.deepcopy(encoder).eval()
+    if mode == 'int8':
+        qconfig = torch.quantization.default_dynamic_qconfig
+        return torch.quantization.quantize_dynamic(encoder, {name: qconfig for name in REDUCED_LAYERS}, dtype=torch.qint8)
+    if mode == 'bf16':
+        encoder = encoder.to(torch.bfloat16)
+        encoder.conv1.float()
+        encoder.lin1.float()
+        return encoder
+    raise ValueError('Unknown precision mode {}; expected one of {}'.format(mode, ', '.join(REDUCED_MODES)))
+
+
+def load_reduced_encoder(mode, reportfile=REPORTFILE, gnnfile=GNNFILE):
+    """
+    Load the encoder exported for mode if the accuracy report allows it.
+    Returns None (after printing why) when run.py should fall back to float32.
+    """
+    artifact = reduced_encoder_file(mode, reportfile, gnnfile)
+    return None if artifact is None else load_encoder(artifact)
+
+
+def collect_samples(dataset=None, pdb_dir=None, limit=None):
+    """Build (name, A, E, A_m, E_m, flag) for the test examples and an optional benchmark set"""
+    from datasets import TEST_EXAMPLES, read_benchmark
+    from run import prepare_sample
+
+    jobs = list(TEST_EXAMPLES)
+    if dataset is not None:
+        for entry in read_benchmark(dataset, pdb_dir, limit=limit):
+            if entry.pdbfile is not None:
+                jobs.append((entry.pdbfile, entry.mutations[0], entry.partners))
+
+    samples = []
+    for pdbfile, mutation, partners in jobs:
+        name = '{}:{}'.format(os.path.basename(pdbfile).split('.')[0], mutation)
+        try:
+            samples.append((name,) + prepare_sample(pdbfile, mutation, partners))
+        except Exception as e:
+            print('  skipping {}: {}'.format(name, e))
+    return samples
+
+
+def evaluate(encoder, samples, forest, sorted_idx, plan):
+    """Predict every sample; returns (ddgs, seconds spent in the encoder+GBT)"""
+    from models import GeoPPIpredict
+    ddgs = []
+    start = time.time()
+    for _, A, E, A_m, E_m, flag in samples:
+        ddgs.append(GeoPPIpredict(A, E, A_m, E_m, encoder, forest, sorted_idx, flag, plan))
+    return np.array(ddgs, dtype=float), time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export reduced-precision encoders and report their ddG deviation')
+    parser.add_argument('--modes', nargs='+', choices=REDUCED_MODES, default=REDUCED_MODES)
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='Maximum |ddG deviation| (kcal/mol) for a mode to be accepted (default: 0.05)')
+    parser.add_argument('--dataset', help='Benchmark CSV to evaluate in addition to data/testExamples')
+    parser.add_argument('--pdb-dir', help='Directory with the benchmark structures ({pdb}.pdb)')
+    parser.add_argument('--limit', type=int, help='Evaluate at most this many benchmark rows')
+    parser.add_argument('-o', '--output', default=REPORTFILE)
+    args = parser.parse_args()
+
+    from models import FeaturePlan, n_selected, GeometricEncoder
+    from run import load_regressor
+
+    # single-threaded timings give throughput per core
+    torch.set_num_threads(1)
+
+    model = GeometricEncoder(256)
+    model.load_state_dict(torch.load(GNNFILE, map_location='cpu'))
+    model.eval()
+    reference = JitEncoder(model).eval()
+    forest, sorted_idx = load_regressor()
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+
+    print('Building evaluation structures...')
+    samples = collect_samples(args.dataset, args.pdb_dir, args.limit)
+    if not samples:
+        print('Error: no evaluation samples could be built')
+        sys.exit(1)
+
+    base_ddg, base_time = evaluate(torch.jit.script(reference), samples, forest, sorted_idx, plan)
+    report = {
+        'encoder_sha256': file_sha256(GNNFILE),
+        'threshold': args.threshold,
+        'samples': [name for name, *_ in samples],
+        'fp32': {'ddg': base_ddg.tolist(), 'seconds_per_sample': base_time / len(samples)},
+        'modes': {},
+    }
+
+    for mode in args.modes:
+        artifact = 'trainedmodels/GeoEnc.{}.pt'.format(mode)
+        try:
+            scripted = torch.jit.script(reduce_precision(reference, mode))
+            ddg, seconds = evaluate(scripted, samples, forest, sorted_idx, plan)
+        except Exception as e:
+            # e.g. bfloat16 kernels missing from older CPU builds of torch
+            report['modes'][mode] = {'accepted': False, 'error': str(e)}
+            print('{}: not supported here ({})'.format(mode, e))
+            continue
+
+        deviation = np.abs(ddg - base_ddg)
+        accepted = bool(deviation.max() <= args.threshold)
+        scripted.save(artifact)
+        report['modes'][mode] = {
+            'artifact': artifact,
+            'accepted': accepted,
+            'max_abs_ddg_dev': float(deviation.max()),
+            'mean_abs_ddg_dev': float(deviation.mean()),
+            'ddg': ddg.tolist(),
+            'seconds_per_sample': seconds / len(samples),
+            'speedup': base_time / seconds,
+        }
+        print('{}: max |ddG dev| {:.3f}, mean {:.3f} kcal/mol, {:.2f}x float32 throughput -> {}'.format(
+            mode, deviation.max(), deviation.mean(), base_time / seconds, 'accepted' if accepted else 'rejected'))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Report written to {} ({} samples)'.format(args.output, len(samples)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of predicted ddGs.
+
+Campaigns rescore the same mutations again and again: reruns, overlapping
+position lists, several people scanning the same model. A PredictionCache is
+one SQLite file of ddGs keyed by
+
+    sha256 of the input structure file, the normalized mutation, partners,
+    cutoff, the crop shell, and model_id(): a hash of the encoder file
+    load_models runs (GeoEnc.pt, GeoEnc.tor or a reduced-precision export),
+    the GBT (gbt-s4169.npz, or gbt-s4169.pkl without it), sortidx.npy and the
+    precision mode it runs in
+
+so a retrained regressor or a new structure file never returns stale values.
+Any number of processes can share a cache (SQLite locks the file; use a local
+or lock-capable filesystem, not NFS). Lookups update each entry's last use,
+and with a size limit in MB ($GEOPPI_CACHE_MB) the least recently used
+entries are evicted when new ones would exceed it. Hits, misses and evictions
+are counted in the file.
+
+Usage:
+    python prediction_cache.py info CACHE
+    python prediction_cache.py evict CACHE --max-mb 100
+    python prediction_cache.py export CACHE [-o cache.csv]
+
+    run.py, pipeline.py, triage.py, adaptive_scan.py, doubles.py and ensemble.py
+    take --cache CACHE (default: $GEOPPI_CACHE) and only compute the mutations
+    missing from it.
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+from keys import file_sha256, sample_key
+from run import MUTATION_PATTERN, resolve_encoder
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, ddg REAL NOT NULL, pdb TEXT, mutation TEXT,
+       partners TEXT, models TEXT, created REAL, used REAL, hits INTEGER NOT NULL DEFAULT 0)''',
+    'CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used)',
+    'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+]
+# SQLite limits the parameters of one statement
+BATCH = 500
+
+_model_ids = {}
+
+
+def normalize_mutation(mutation):
+    """Canonical form of a mutation, or of comma-separated multiple mutations (sorted)"""
+    parts = []
+    for part in mutation.replace(' ', '').split(','):
+        match = MUTATION_PATTERN.match(part[0].upper() + part[1:-1] + part[-1].upper()) if part else None
+        parts.append(''.join(match.groups()) if match else part)
+    return ','.join(sorted(parts))
+
+
+def model_id(gnnfile='trainedmodels/GeoEnc.tor', gbtfile='trainedmodels/gbt-s4169.pkl',
+             gbtarrays='trainedmodels/gbt-s4169.npz', idxfile='trainedmodels/sortidx.npy', precision='fp32',
+             jitfile='trainedmodels/GeoEnc.pt'):
+    """
+    Identify the encoder, GBT, feature ranking and precision behind a ddG: the files load_models
+    reads, and the precision it runs in (a reduced mode can fall back to fp32, see resolve_encoder)
+    """
+    encoderfile, precision = resolve_encoder(precision, gnnfile, jitfile)
+    files = [encoderfile, gbtarrays if os.path.exists(gbtarrays) else gbtfile, idxfile]
+    stamp = tuple((x, os.path.getsize(x), os.path.getmtime(x)) if os.path.exists(x) else (x,) for x in files)
+    if stamp not in _model_ids:
+        digest = hashlib.sha256()
+        for name in files:
+            if os.path.exists(name):
+                with open(name, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(block)
+            digest.update(b'\0')
+        _model_ids[stamp] = digest.hexdigest()[:16]
+    return '{}-{}'.format(_model_ids[stamp], precision)
+
+
+def prediction_key(structure_hash, mutation, partners, cutoff, crop, models):
+    return '{}:{}'.format(sample_key(structure_hash, normalize_mutation(mutation), partners, cutoff, crop), models)
+
+
+class PredictionCache(object):
+    def __init__(self, filename, max_mb=None):
+        self.filename = filename
+        self.max_bytes = None if max_mb is None else int(max_mb*(1 << 20))
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=120)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def _count(self, **counts):
+        self.db.executemany('INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                            [(name, value) for name, value in counts.items() if value])
+
+    def get_many(self, keys):
+        """{key: ddG} of the keys found; counts hits and misses and marks the entries used"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), BATCH):
+            chunk = keys[start:start + BATCH]
+            query = 'SELECT key, ddg FROM predictions WHERE key IN ({})'.format(','.join('?'*len(chunk)))
+            found.update(self.db.execute(query, chunk).fetchall())
+        with self.db:
+            now = time.time()
+            self.db.executemany('UPDATE predictions SET used = ?, hits = hits + 1 WHERE key = ?',
+                                [(now, key) for key in found])
+            self._count(hits=len(found), misses=len(keys) - len(found))
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, rows):
+        """Add (key, ddG, pdb, mutation, partners, models) rows; keys already present are left unchanged"""
+        if not rows:
+            return
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO predictions (key, ddg, pdb, mutation, partners, models, created, used) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [tuple(row) + (now, now) for row in rows])
+        if self.max_bytes is not None and self.size() > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def put(self, key, ddg, pdb=None, mutation=None, partners=None, models=None):
+        self.put_many([(key, ddg, pdb, mutation, partners, models)])
+
+    def size(self):
+        """Bytes of the pages in use (deleted entries leave free pages that new ones reuse)"""
+        pages, free, page_size = [self.db.execute('PRAGMA {}'.format(x)).fetchone()[0]
+                                  for x in ('page_count', 'freelist_count', 'page_size')]
+        return (pages - free)*page_size
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def evict(self, max_bytes, target=0.9):
+        """Delete the least recently used entries until the cache uses at most target*max_bytes; returns how many"""
+        evicted = 0
+        while self.size() > target*max_bytes:
+            n = len(self)
+            if n == 0:
+                break
+            excess = int(n*(1 - target*max_bytes/self.size())) + 1
+            with self.db:
+                self.db.execute('DELETE FROM predictions WHERE key IN '
+                                '(SELECT key FROM predictions ORDER BY used LIMIT ?)', (excess,))
+                self._count(evictions=min(excess, n))
+            evicted += min(excess, n)
+        return evicted
+
+    def stats(self):
+        counters = dict(self.db.execute('SELECT name, value FROM counters').fetchall())
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return dict(entries=len(self), bytes=self.size(), hits=counters.get('hits', 0),
+                    misses=counters.get('misses', 0), evictions=counters.get('evictions', 0),
+                    hit_rate=counters.get('hits', 0)/lookups if lookups else None)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_cache(filename=None, precision='fp32', cutoff=3, crop=None, max_mb=None):
+    """
+    CachedPredictions of the cache at filename or $GEOPPI_CACHE, limited to max_mb or
+    $GEOPPI_CACHE_MB; None if no cache is given.
+    """
+    filename = filename or os.environ.get('GEOPPI_CACHE')
+    if not filename:
+        return None
+    if max_mb is None and os.environ.get('GEOPPI_CACHE_MB'):
+        max_mb = float(os.environ['GEOPPI_CACHE_MB'])
+    return CachedPredictions(PredictionCache(filename, max_mb), precision, cutoff, crop)
+
+
+class CachedPredictions(object):
+    """
+    Lookups and additions of one run: keys are built for the current models, and the
+    structure files are hashed once. precision is the encoder's GEOPPI_PRECISION mode.
+    """
+    def __init__(self, cache, precision='fp32', cutoff=3, crop=None):
+        self.cache = cache
+        self.models = model_id(precision=precision)
+        self.cutoff = cutoff
+        self.crop = crop
+        self.hashes = {}
+        self.lookups = 0
+        self.hits = 0
+        self.added = 0
+
+    def key(self, pdbfile, mutation, partners):
+        if pdbfile not in self.hashes:
+            self.hashes[pdbfile] = file_sha256(pdbfile)
+        return prediction_key(self.hashes[pdbfile], mutation, partners, self.cutoff, self.crop, self.models)
+
+    def lookup(self, entries):
+        """ddGs of (pdbfile, mutation, partners) entries, None where not cached"""
+        keys = [self.key(*entry) for entry in entries]
+        found = self.cache.get_many(keys)
+        self.lookups += len(keys)
+        self.hits += sum(key in found for key in keys)
+        return [found.get(key) for key in keys]
+
+    def add(self, entries):
+        """Save (pdbfile, mutation, partners, ddG) entries"""
+        rows = [(self.key(pdbfile, mutation, partners), ddg, pdbfile, mutation, partners, self.models)
+                for pdbfile, mutation, partners, ddg in entries if ddg is not None]
+        self.cache.put_many(rows)
+        self.added += len(rows)
+
+    def summary(self):
+        stats = self.cache.stats()
+        return 'Prediction cache {}: {} of {} found, {} added; {} predictions, {:.1f} MB'.format(
+            self.cache.filename, self.hits, self.lookups, self.added, stats['entries'], stats['bytes']/1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect, trim or export a prediction cache')
+    parser.add_argument('command', choices=['info', 'evict', 'export'])
+    parser.add_argument('cache')
+    parser.add_argument('--max-mb', type=float, help='Size to evict down to')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache):
+        print('Error: {} does not exist'.format(args.cache))
+        sys.exit(1)
+    with PredictionCache(args.cache) as cache:
+        if args.command == 'info':
+            stats = cache.stats()
+            print('{} predictions, {:.1f} MB'.format(stats['entries'], stats['bytes']/1e6))
+            print('{} hits, {} misses ({} hit rate), {} evicted'.format(
+                stats['hits'], stats['misses'],
+                '-' if stats['hit_rate'] is None else '{:.0%}'.format(stats['hit_rate']), stats['evictions']))
+            for models, count in cache.db.execute('SELECT models, COUNT(*) FROM predictions GROUP BY models'):
+                print('  models {}: {}'.format(models, count))
+        elif args.command == 'evict':
+            if args.max_mb is None:
+                parser.error('evict needs --max-mb')
+            evicted = cache.evict(args.max_mb*(1 << 20), target=1.0)
+            cache.db.execute('VACUUM')
+            print('Evicted {} predictions; {} left'.format(evicted, len(cache)))
+        else:
+            import csv
+            output = args.output or os.path.splitext(os.path.basename(args.cache))[0] + '.csv'
+            with open(output, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['pdb', 'mutation', 'partners', 'ddg', 'models', 'hits'])
+                writer.writerows(cache.db.execute('SELECT pdb, mutation, partners, ddg, models, hits FROM predictions'))
+            print('Results written to {}'.format(output))
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,45 @@
-import numpy as np
-import sys,os, gc
-import csv, glob
+import sys,os
 import os.path as path
-import torch, pickle
-from models import *
-from sklearn.ensemble import GradientBoostingRegressor,RandomForestRegressor
+import re
+from collections import namedtuple
+# torch, the encoder and the GBT are imported by the stages that use them, so
+# that argument checks and dry runs return without loading them
+
+AMINO_ACIDS = 'ARNDCQEGHILKMFPSTWYV'
+AA_CODES = {'ALA':'A','ARG':'R','ASN':'N','ASP':'D','CYS':'C','GLN':'Q','GLU':'E','GLY':'G','HIS':'H','ILE':'I',
+        'LEU':'L','LYS':'K','MET':'M','PHE':'F','PRO':'P','SER':'S','THR':'T','TRP':'W','TYR':'Y','VAL':'V'}
+MUTATION_PATTERN = re.compile(r'^([A-Z])([A-Za-z0-9])(-?[0-9]+[A-Za-z]?)([A-Z])$')
+CIF_SUFFIXES = ('.cif', '.mmcif', '.bcif')
+# ATOM records as columns: atom name, residue name (with the altLoc column, as in
+# PDB columns 17-21), chain, residue number with insertion code, (x, y, z) rows
+AtomTable = namedtuple('AtomTable', ['atom', 'resname', 'chain', 'resid', 'coords'])
+# order of the residue one-hot in build_graph's atom features
+GRAPH_RESIDUES = ['ARG','MET','VAL','ASN','PRO','THR','PHE','ASP','ILE',
+        'ALA','GLY','GLU','LEU','SER','LYS','TYR','CYS','HIS','GLN','TRP']
 
 
 def gen_graph_data(pdbfile, mutinfo, interfile,  cutoff, if_info=None):
     max_dis = 12
-    pdbfile = open(pdbfile)
-    lines = pdbfile.read().splitlines()
+    if pdbfile.endswith(CIF_SUFFIXES):
+        from mmcif import read_mmcif
+        lines = read_mmcif(pdbfile)
+    else:
+        pdbfile = open(pdbfile)
+        lines = pdbfile.read().splitlines()
     chainid = [x.split('_')[0] for x in mutinfo]
     interface_res = read_inter_result(interfile,if_info, chainid)
     if len(interface_res)==0: print('Warning: We do not find any interface residues between the two parts: {}. Please double check your inputs. Thank you!'.format(if_info))
     sample = build_graph(lines, interface_res,mutinfo, cutoff,max_dis)
     return sample
 
+def read_atoms(lines):
+    """The ATOM records of PDB file lines as an AtomTable"""
+    records = [line for line in lines if line[0:4] == 'ATOM']
+    return AtomTable([line[12:16].strip() for line in records], [line[16:21].strip() for line in records],
+                     [line[21] for line in records], [line[22:28].strip() for line in records],
+                     [(float(line[30:38].strip()), float(line[38:46].strip()), float(line[46:54].strip()))
+                      for line in records])
+
 def read_inter_result(path, if_info=None, chainid=None, old2new=None):
     if if_info is not None:
         info1 = if_info.split('_')
@@ -70,10 +93,16 @@ def read_inter_result(path, if_info=None, chainid=None, old2new=None):
 
     return interface_res
 
-def build_graph(lines, interface_res, mutinfo, cutoff=3, max_dis=12, noisedict = None):
+def build_graph(lines, interface_res, mutinfo, cutoff=3, max_dis=12, noisedict = None, tile=None):
+    """
+    lines: the lines of a PDB file, or an AtomTable (read_atoms, mmcif.read_mmcif)
+    tile: build the edges this many atoms at a time instead of from dense (N, N) tensors;
+    by default only when memory_budget.graph_tile finds that they exceed $GEOPPI_MEMORY_MB
+    """
+    import torch
+    table = lines if isinstance(lines, AtomTable) else read_atoms(lines)
     atomnames = ['C','N','O','S']
-    residues = ['ARG','MET','VAL','ASN','PRO','THR','PHE','ASP','ILE',\
-            'ALA','GLY','GLU','LEU','SER','LYS','TYR','CYS','HIS','GLN','TRP']
+    residues = GRAPH_RESIDUES
     res_code = ['R','M','V','N','P','T','F','D','I',\
             'A','G','E','L','S','K','Y','C','H','Q','W']
     res2code ={x:idxx for x,idxx in zip(residues, res_code)}
@@ -88,45 +117,37 @@ def build_graph(lines, interface_res, mutinfo, cutoff=3, max_dis=12, noisedict =
     interface_coordinates = []
     line_list= []
     mutant_coords = []
-    for line in lines:
-        if line[0:4] == 'ATOM':
-            atomname = line[12:16].strip()
-            elemname = list(filter(lambda x: x.isalpha(), atomname))[0]
-            resname  = line[16:21].strip()
-            chainid =  line[21]
-            res_idx = line[22:28].strip()
-            x = float(line[30:38].strip())
-            y = float(line[38:46].strip())
-            z = float(line[46:54].strip())
-            if elemname not in atomdict:
-                continue
-
-            coords = torch.tensor([x,y,z])
-            atomid = atomdict[elemname]
-            if resname not in resdict:
-                resname = resname[1:]
-            if resname not in resdict:
-                continue
-
-            if chainid not in chain2id:
-                chain2id.append(chainid)
+    for atomname, resname, chainid, res_idx, (x, y, z) in zip(*table):
+        elemname = list(filter(lambda x: x.isalpha(), atomname))[0]
+        if elemname not in atomdict:
+            continue
+
+        coords = torch.tensor([x,y,z])
+        atomid = atomdict[elemname]
+        if resname not in resdict:
+            resname = resname[1:]
+        if resname not in resdict:
+            continue
+
+        if chainid not in chain2id:
+            chain2id.append(chainid)
  
-            line_token = '{}_{}_{}_{}'.format(atomname,resname,chainid, res_idx)
-            if line_token not in line_list:
-                line_list.append(line_token)
-            else:
-                continue
-
-            resid  = resdict[resname]
-            cr_token = '{}_{}'.format(chainid, res_idx)
-            float_cd  = [float(x) for x in coords]
-            cd_tensor = torch.tensor(float_cd)
-            if cr_token in interface_res:
-                interface_coordinates.append(cd_tensor)
-            if mutinfo is not None and cr_token in mutinfo:
-                interface_coordinates.append(cd_tensor)
-                interface_res.append(cr_token)
-                mutant_coords.append(cd_tensor)
+        line_token = '{}_{}_{}_{}'.format(atomname,resname,chainid, res_idx)
+        if line_token not in line_list:
+            line_list.append(line_token)
+        else:
+            continue
+
+        resid  = resdict[resname]
+        cr_token = '{}_{}'.format(chainid, res_idx)
+        float_cd  = [float(x) for x in coords]
+        cd_tensor = torch.tensor(float_cd)
+        if cr_token in interface_res:
+            interface_coordinates.append(cd_tensor)
+        if mutinfo is not None and cr_token in mutinfo:
+            interface_coordinates.append(cd_tensor)
+            interface_res.append(cr_token)
+            mutant_coords.append(cd_tensor)
 
     inter_coors_matrix = torch.stack(interface_coordinates)
     chain2id = {x:i for i,x in enumerate(chain2id)}
@@ -137,81 +158,73 @@ def build_graph(lines, interface_res, mutinfo, cutoff=3, max_dis=12, noisedict =
     atoms = []
     flag_mut = False
     res_index_set = {}
-    for line in lines:
-        if line[0:4] == 'ATOM':
-            features = [0]*n_features
-            atomname = line[12:16].strip()
-            elemname = list(filter(lambda x: x.isalpha(), atomname))[0]
-            resname  = line[16:21].strip()
-            chainid =  line[21]
-            res_idx = line[22:28].strip()
-            x = float(line[30:38].strip())
-            y = float(line[38:46].strip())
-            z = float(line[46:54].strip())
-            if elemname not in atomdict:
-                continue
-
-            coords = torch.tensor([x,y,z])
-            atomid = atomdict[elemname]
-            if resname not in resdict:
-                resname = resname[1:]
-            if resname not in resdict:
-                continue
-            line_token = '{}_{}_{}_{}'.format(atomname,resname,chainid, res_idx)
-            if line_token not in line_list:
-                line_list.append(line_token)
-            else:
-                continue
-
-            resid  = resdict[resname]
-            features[atomid] = 1
-            features[V_atom+resid] = 1
-
-            cr_token = '{}_{}'.format(chainid, res_idx)
-            float_cd  = [float(x) for x in coords]
-            cd_tensor = torch.tensor(float_cd)
-            #24
-            if cr_token in interface_res:
-                features[V_atom+V_res] = 1
-            
-            if mutinfo is not None:
-                for inforrr in mutinfo:
-                    mut_chainid = inforrr.split('_')[0]
-                    if chainid==mut_chainid:
-                        #25
-                        features[V_atom+V_res+1] = 1
-            #26
-            features[V_atom+V_res+2] = chain2id[chainid]
-
-            #27
-            if cr_token not in res_index_set:
-                res_index_set[cr_token] = len(res_index_set)+1
-
-            features[V_atom+V_res+3] = res_index_set[cr_token]
-
-            #28
-            if atomname=='CA':
-                features[V_atom+V_res+4] = res_index_set[cr_token]
-                if noisedict is not None and cr_token in noisedict:
-                    global_resid2noise[res_index_set[cr_token]] = noisedict[cr_token]
-
-            flag = False
-            dissss = torch.norm(cd_tensor-inter_coors_matrix,dim=1)
-            flag = (dissss<max_dis).any()
-
-
-            #29-31
-            features[V_atom+V_res+5:V_atom+V_res+8] = float_cd
-
-            res_iden_token = '{}_{}_{}'.format(chainid, res_idx, resname).upper()
-            if  mutinfo is not None and cr_token in mutinfo:
-                #32
-                features[V_atom+V_res+8]=1
-                flag_mut = True
-                flag = True
-            
-            if flag:
-                atoms.append(features)
+    for atomname, resname, chainid, res_idx, (x, y, z) in zip(*table):
+        features = [0]*n_features
+        elemname = list(filter(lambda x: x.isalpha(), atomname))[0]
+        if elemname not in atomdict:
+            continue
+
+        coords = torch.tensor([x,y,z])
+        atomid = atomdict[elemname]
+        if resname not in resdict:
+            resname = resname[1:]
+        if resname not in resdict:
+            continue
+        line_token = '{}_{}_{}_{}'.format(atomname,resname,chainid, res_idx)
+        if line_token not in line_list:
+            line_list.append(line_token)
+        else:
+            continue
+
+        resid  = resdict[resname]
+        features[atomid] = 1
+        features[V_atom+resid] = 1
+
+        cr_token = '{}_{}'.format(chainid, res_idx)
+        float_cd  = [float(x) for x in coords]
+        cd_tensor = torch.tensor(float_cd)
+        #24
+        if cr_token in interface_res:
+            features[V_atom+V_res] = 1
+        
+        if mutinfo is not None:
+            for inforrr in mutinfo:
+                mut_chainid = inforrr.split('_')[0]
+                if chainid==mut_chainid:
+                    #25
+                    features[V_atom+V_res+1] = 1
+        #26
+        features[V_atom+V_res+2] = chain2id[chainid]
+
+        #27
+        if cr_token not in res_index_set:
+            res_index_set[cr_token] = len(res_index_set)+1
+
+        features[V_atom+V_res+3] = res_index_set[cr_token]
+
+        #28
+        if atomname=='CA':
+            features[V_atom+V_res+4] = res_index_set[cr_token]
+            if noisedict is not None and cr_token in noisedict:
+                global_resid2noise[res_index_set[cr_token]] = noisedict[cr_token]
+
+        flag = False
+        dissss = torch.norm(cd_tensor-inter_coors_matrix,dim=1)
+        flag = (dissss<max_dis).any()
+
+
+        #29-31
+        features[V_atom+V_res+5:V_atom+V_res+8] = float_cd
+
+        res_iden_token = '{}_{}_{}'.format(chainid, res_idx, resname).upper()
+        if  mutinfo is not None and cr_token in mutinfo:
+            #32
+            features[V_atom+V_res+8]=1
+            flag_mut = True
+            flag = True
+        
+        if flag:
+            atoms.append(features)
 
     if mutinfo is not None and len(interface_res)>0:
         assert flag_mut==True
@@ -220,6 +233,14 @@ def build_graph(lines, interface_res, mutinfo, cutoff=3, max_dis=12, noisedict =
         return None
     atoms = torch.tensor(atoms, dtype=torch.float)
     N = atoms.size(0)
+    if tile is None:
+        from memory_budget import graph_tile
+        tile = graph_tile(N)
+    if tile is not None:
+        edge_sparse, edge_attr_sp = tiled_edges(atoms, cutoff, tile)
+        if noisedict is None:
+            return [atoms, edge_sparse, edge_attr_sp]
+        return [atoms, edge_sparse, edge_attr_sp, global_resid2noise]
     atoms_type = torch.argmax(atoms[:,:4],1)
     atoms_type = atoms_type.unsqueeze(1).repeat(1,N)
     edge_type = atoms_type*4+atoms_type.t()
@@ -246,27 +267,95 @@ def build_graph(lines, interface_res, mutinfo, cutoff=3, max_dis=12, noisedict =
         savefilecont = [ atoms, edge_sparse, edge_attr_sp, global_resid2noise]
     return savefilecont
 
-def main():
-    gnnfile = 'trainedmodels/GeoEnc.tor'
-    gbtfile = 'trainedmodels/gbt-s4169.pkl'
-    idxfile = 'trainedmodels/sortidx.npy'
-    pdbfile = sys.argv[1]
-    mutationinfo = sys.argv[2]
-    if_info = sys.argv[3]
-
-
-    try:
-        sorted_idx = np.load(idxfile)
-    except:
-        print('File reading error: Please redownload the file {} from the GitHub website again!'.format(idxfile))
-
+def tiled_edges(atoms, cutoff, tile):
+    """build_graph's edges and edge types, from (tile, N) blocks of distances"""
+    import torch
+    pos = atoms[:,-4:-1]
+    atoms_type = torch.argmax(atoms[:,:4],1)
+    edges = []
+    for start in range(0, pos.size(0), tile):
+        block = pos[start:start+tile]
+        distance = torch.sqrt(torch.sum((block[:,None,:]-pos[None,:,:])**2,2))+1e-10
+        flag = distance<float(cutoff)
+        rows = torch.arange(block.size(0))
+        flag[rows, rows+start] = True
+        edge = torch.nonzero(flag)
+        edge[:,0] += start
+        edges.append(edge)
+    edge_sparse = torch.cat(edges)
+    return edge_sparse, atoms_type[edge_sparse[:,0]]*4+atoms_type[edge_sparse[:,1]]
+
+def parse_mutation(info):
+    """Split a mutation such as TI17F into (wildname, chainid, resid, mutname)"""
+    return info[0], info[1], info[2:-1], info[-1]
+
+def read_residues(pdbfile):
+    """Residue names of pdbfile (of its first model) by (chain, residue number), and its number of models"""
+    residues = {}
+    models = 0
+    if pdbfile.endswith(CIF_SUFFIXES):
+        from mmcif import atom_table, model_atom_sites
+        # one read of _atom_site gives both the first model and the model count
+        sites = model_atom_sites(pdbfile)
+        models = len(sites)
+        table = atom_table(sites[0][1])
+        for name, chain, number in zip(table.resname, table.chain, table.resid):
+            residues.setdefault((chain, number), set()).add(name[-3:])
+    else:
+        with open(pdbfile) as f:
+            for line in f:
+                if line[0:4] == 'ATOM':
+                    residues.setdefault((line[21], line[22:28].strip()), set()).add(line[17:20])
+                elif line[0:6] == 'MODEL ':
+                    models += 1
+    return residues, models
+
+def validate_inputs(pdbfile, mutationinfo, if_info, structure=None):
+    """
+    Check the command-line inputs without running FoldX; returns a list of problems.
+    structure is read_residues(pdbfile), to check many mutations of one file without re-reading it.
+    """
+    match = MUTATION_PATTERN.match(mutationinfo)
+    if match is None or match.group(1) not in AMINO_ACIDS or match.group(4) not in AMINO_ACIDS:
+        return ['Mutation {} is not of the form [wildtype][chain][residue index][mutant], e.g. TI17R'.format(mutationinfo)]
+    wildname, chainid, resid, _ = match.groups()
+
+    problems = []
+    partners = if_info.split('_')
+    if len(partners) != 2 or not all(partners):
+        problems.append('Binding partners {} are not of the form [chains]_[chains], e.g. E_I'.format(if_info))
+    elif chainid not in if_info:
+        problems.append('The mutated chain {} is not one of the binding partners {}'.format(chainid, if_info))
+
+    if not path.isfile(pdbfile):
+        return problems + ['PDB file {} does not exist'.format(pdbfile)]
+    residues, models = structure if structure is not None else read_residues(pdbfile)
+    resnames = residues.get((chainid, resid), set())
+    if models > 1:
+        # build_graph would merge the models into one structure
+        problems.append('{} has {} models; predict them with ensemble.py'.format(pdbfile, models))
+    if not resnames:
+        problems.append('Residue {} of chain {} is not in {}'.format(resid, chainid, pdbfile))
+    elif not any(AA_CODES.get(x) == wildname for x in resnames):
+        problems.append('Residue {}{} in {} is {}, not {}'.format(chainid, resid, pdbfile, '/'.join(sorted(resnames)), wildname))
+    return problems
+
+def run_foldx(pdbfile, mutations, workdir, listfile='individual_list.txt', pdb_dir='./'):
+    """Build one FoldX model per mutation of pdbfile (in pdb_dir) into workdir"""
+    with open(listfile,'w') as f:
+        f.write('\n'.join('{};'.format(x) for x in mutations))
+    comm = './foldx --command=BuildModel --pdb={}  --mutant-file={}  --output-dir={} --pdb-dir={} >{}/foldx.log'.format(\
+                                pdbfile,  listfile, workdir, pdb_dir,workdir)
+    os.system(comm)
 
-    os.system('cp {} ./'.format(pdbfile))
-    pdbfile = pdbfile.split('/')[-1]
+def build_structures(pdbfile, mutationinfo, if_info, workdir='temp', crop=None):
+    """
+    Detect the interface and build the wildtype (mutated to itself) and mutant models with FoldX.
+    pdbfile must be in the current directory. With crop (in A), FoldX only builds the residues
+    within that shell of the interface and the mutation (see crop.py).
+    Returns wildtypefile, mutantfile, interfacefile, graph_mutinfo and whether the mutation is a no-op.
+    """
     pdb = pdbfile.split('.')[0]
-    workdir = 'temp'
-    cutoff = 3
-
     if path.exists('./{}'.format(workdir)):
         os.system('rm -r {}'.format(workdir))
     os.system('mkdir {}'.format(workdir))
@@ -276,67 +365,249 @@ def main():
     interfacefile = '{}/interface.txt'.format(workdir)
 
     # Extract mutation information
-    graph_mutinfo = []
-    flag = False
-    info = mutationinfo
-    wildname = info[0]
-    chainid = info[1] 
-    resid = info[2:-1]
-    mutname = info[-1]
-    if wildname==mutname:flag= True
-    graph_mutinfo.append('{}_{}'.format(chainid,resid))
+    wildname, chainid, resid, mutname = parse_mutation(mutationinfo)
+    flag = wildname==mutname
+    graph_mutinfo = ['{}_{}'.format(chainid,resid)]
+
+    pdb_dir = './'
+    if crop is not None:
+        from crop import crop_structure
+        sites = read_inter_result(interfacefile, if_info, [chainid]) + graph_mutinfo
+        crop_structure(pdbfile, '{}/{}'.format(workdir, pdbfile), sites, crop)
+        pdb_dir = workdir
 
     # build a pdb file that is mutated to it self
-    with open('individual_list.txt','w') as f:
-        cont = '{}{}{}{};'.format(wildname,chainid,resid,wildname)
-        f.write(cont)
-    comm = './foldx --command=BuildModel --pdb={}  --mutant-file={}  --output-dir={} --pdb-dir={} >{}/foldx.log'.format(\
-                                pdbfile,  'individual_list.txt', workdir, './',workdir)
-    os.system(comm)
+    run_foldx(pdbfile, ['{}{}{}{}'.format(wildname,chainid,resid,wildname)], workdir, pdb_dir=pdb_dir)
     os.system('mv {}/{}_1.pdb   {}/wildtype.pdb '.format(workdir, pdb, workdir))
 
     # build the mutant file
-    with open('individual_list.txt','w') as f:
-        cont = '{}{}{}{};'.format(wildname,chainid,resid,mutname)
-        f.write(cont)
-    comm = './foldx --command=BuildModel --pdb={}  --mutant-file={}  --output-dir={} --pdb-dir={} >{}/foldx.log'.format(\
-                                pdbfile,  'individual_list.txt', workdir, './',workdir)
-    os.system(comm)
+    run_foldx(pdbfile, ['{}{}{}{}'.format(wildname,chainid,resid,mutname)], workdir, pdb_dir=pdb_dir)
 
-    wildtypefile = '{}/wildtype.pdb'.format(workdir, pdb)
+    wildtypefile = '{}/wildtype.pdb'.format(workdir)
     mutantfile = '{}/{}_1.pdb'.format(workdir, pdb)
+    if crop is not None:
+        # put the rebuilt residues back into the full complex
+        from crop import splice_structure
+        splice_structure(pdbfile, wildtypefile, wildtypefile)
+        splice_structure(pdbfile, mutantfile, mutantfile)
+    return wildtypefile, mutantfile, interfacefile, graph_mutinfo, flag
+
+def prepare_sample(pdbfile, mutationinfo, if_info, workdir='temp', cutoff=3, crop=None, store=None):
+    """
+    Build and featurize the wildtype and mutant structures; returns A, E, A_m, E_m, flag.
+    With a graph_store.GraphStore, stored graphs are reused and new ones are added.
+    """
+    if store is not None:
+        from keys import file_sha256, sample_key
+        key = sample_key(file_sha256(pdbfile), mutationinfo, if_info, cutoff, crop)
+        stored = store.get(key)
+        if stored is not None:
+            (A, E, _), (A_m, E_m, _), flag = stored
+            return A, E, A_m, E_m, flag
+
+    inputfile = pdbfile
+    if pdbfile.endswith(CIF_SUFFIXES):
+        # FoldX and PyMOL read PDB files
+        from mmcif import write_pdb
+        pdbfile = path.basename(pdbfile).split('.')[0] + '.pdb'
+        write_pdb(inputfile, pdbfile)
+    else:
+        os.system('cp {} ./'.format(pdbfile))
+        pdbfile = pdbfile.split('/')[-1]
+    try:
+        wildtypefile, mutantfile, interfacefile, graph_mutinfo, flag = build_structures(pdbfile, mutationinfo, if_info, workdir, crop)
+        wildtype = gen_graph_data(wildtypefile, graph_mutinfo, interfacefile , cutoff, if_info)
+        mutant = gen_graph_data(mutantfile, graph_mutinfo, interfacefile , cutoff, if_info)
+        A, E, _ = wildtype
+        A_m, E_m, _ = mutant
+    finally:
+        os.system('rm ./{}'.format(pdbfile))
+        os.system('rm -f ./individual_list.txt')
+
+    if store is not None:
+        store.put(key, wildtype, mutant, flag, pdb=inputfile, mutation=mutationinfo, partners=if_info, cutoff=cutoff, crop=crop)
+    return A, E, A_m, E_m, flag
+
+REDUCED_MODES = ['int8', 'bf16']
+_resolved_encoders = {}
+
+def reduced_encoder_file(mode, reportfile='trainedmodels/precision_report.json', gnnfile='trainedmodels/GeoEnc.tor'):
+    """
+    The encoder exported for a reduced-precision mode (python precision.py) if its accuracy
+    report allows it; None (after printing why) when run.py should fall back to float32.
+    """
+    import json
+    from keys import file_sha256
+    if mode not in REDUCED_MODES:
+        print('Unknown GEOPPI_PRECISION={}; using float32.'.format(mode))
+        return None
+    try:
+        with open(reportfile) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        print('No precision report at {} (run python precision.py); using float32.'.format(reportfile))
+        return None
 
+    entry = report['modes'].get(mode, {})
+    tolerance = float(os.environ.get('GEOPPI_PRECISION_TOL', report['threshold']))
+    if report.get('encoder_sha256') != file_sha256(gnnfile):
+        print('The precision report was made for a different {}; using float32.'.format(gnnfile))
+        return None
+    if 'max_abs_ddg_dev' not in entry or entry['max_abs_ddg_dev'] > tolerance:
+        print('{} inference deviates by up to {} kcal/mol (tolerance {}); using float32.'.format(
+            mode, entry.get('max_abs_ddg_dev', entry.get('error', 'n/a')), tolerance))
+        return None
+    return entry['artifact']
+
+def resolve_encoder(precision='fp32', gnnfile='trainedmodels/GeoEnc.tor', jitfile='trainedmodels/GeoEnc.pt'):
+    """
+    The encoder file load_models runs for a GEOPPI_PRECISION mode and the mode it runs in:
+    the reduced-precision export when its report allows it, else GeoEnc.pt (or GeoEnc.tor)
+    in fp32. Decided once per process, so the prediction cache keys what is loaded.
+    """
+    key = (precision, gnnfile, jitfile)
+    if key not in _resolved_encoders:
+        encoderfile = reduced_encoder_file(precision, gnnfile=gnnfile) if precision != 'fp32' else None
+        if encoderfile is None:
+            encoderfile, precision = (jitfile if path.exists(jitfile) else gnnfile), 'fp32'
+        _resolved_encoders[key] = (encoderfile, precision)
+    return _resolved_encoders[key]
+
+def load_regressor(gbtfile='trainedmodels/gbt-s4169.pkl', gbtarrays='trainedmodels/gbt-s4169.npz',
+        idxfile='trainedmodels/sortidx.npy'):
+    """Load the GBT and the feature ranking, without the encoder; returns forest, sorted_idx"""
+    import pickle
+    import numpy as np
+    from fastgbt import ArrayForest
+
+    forest, sorted_idx = None, None
     try:
-        A, E, _ =gen_graph_data(wildtypefile, graph_mutinfo, interfacefile , cutoff, if_info)
-        A_m, E_m, _=gen_graph_data(mutantfile, graph_mutinfo, interfacefile , cutoff, if_info)
+        sorted_idx = np.load(idxfile)
     except:
-        print('Data processing error: Please double check your inputs is correct! Such as the pdb file path, mutation information and binding partners. You might find more error details at {}/foldx.log'.format(workdir))
-
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        print('File reading error: Please redownload the file {} from the GitHub website again!'.format(idxfile))
 
-    model = GeometricEncoder(256)
     try:
-        model.load_state_dict(torch.load(gnnfile,map_location='cpu'))
+        # the flat NumPy export (python fastgbt.py) avoids importing scikit-learn
+        if path.exists(gbtarrays):
+            forest = ArrayForest.load(gbtarrays)
+        else:
+            with open(gbtfile, 'rb') as pickle_file:
+                forest = pickle.load(pickle_file)
     except:
-        print('File reading error: Please redownload the file {} from the GitHub website again!'.format(gnnfile))
+        print('File reading error: Please redownload the file {} via the following command: \
+                wget https://media.githubusercontent.com/media/Liuxg16/largefiles/8167d5c365c92d08a81dffceff364f72d765805c/gbt-s4169.pkl -P trainedmodels/'.format(gbtfile))
+    return forest, sorted_idx
+
+def load_models(gnnfile='trainedmodels/GeoEnc.tor', jitfile='trainedmodels/GeoEnc.pt',
+        gbtfile='trainedmodels/gbt-s4169.pkl', gbtarrays='trainedmodels/gbt-s4169.npz', idxfile='trainedmodels/sortidx.npy',
+        precision='fp32', regressor=True):
+    """
+    Load the geometric encoder, the GBT and the feature ranking; returns model, forest, sorted_idx.
+    With regressor=False only the encoder is loaded (forest and sorted_idx are None).
+    """
+    import pickle
+    import torch
+    from jit_encoder import load_encoder
+
+    forest, sorted_idx = None, None
+    if regressor:
+        forest, sorted_idx = load_regressor(gbtfile, gbtarrays, idxfile)
+
+    # the opt-in reduced-precision export (python precision.py), or the float32 one;
+    # the TorchScript exports (python jit_encoder.py) load without torch_geometric
+    encoderfile, precision = resolve_encoder(precision, gnnfile, jitfile)
+    eager = encoderfile == gnnfile
+    if eager:
+        from models import GeometricEncoder
+        try:
+            import torch_geometric.nn
+        except ImportError as e:
+            print('Error: loading {} needs torch_geometric ({}); install it, or export the encoder with python jit_encoder.py where it is installed'.format(gnnfile, e))
+            sys.exit(1)
+    try:
+        if not eager:
+            model = load_encoder(encoderfile)
+        else:
+            model = GeometricEncoder(256)
+            model.load_state_dict(torch.load(gnnfile,map_location='cpu'))
+    except (OSError, RuntimeError, EOFError, pickle.UnpicklingError):
+        print('File reading error: Please redownload the file {} from the GitHub website again!'.format(encoderfile))
+        sys.exit(1)
+
+    model.eval()
+    from memory_budget import budget_mb, configure_encoder
+    if budget_mb() is not None and configure_encoder(model) is None:
+        print('Note: this encoder cannot split its attention layers to fit GEOPPI_MEMORY_MB; rerun python jit_encoder.py')
+    return model, forest, sorted_idx
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Predict the binding affinity change (ddG) of a mutation with GeoPPI')
+    parser.add_argument('pdbfile', help='PDB file of the complex')
+    parser.add_argument('mutation', help='Mutation as [wildtype][chain][residue index][mutant], e.g. TI17R')
+    parser.add_argument('partners', help='Binding partners as [chains]_[chains], e.g. E_I')
+    parser.add_argument('--dry-run', action='store_true', help='Only check the inputs; do not run FoldX or the models')
+    parser.add_argument('--crop', type=float, metavar='SHELL',
+                        help='Build with FoldX only the residues within SHELL A of the interface and the mutation (e.g. 20)')
+    parser.add_argument('--graph-store', metavar='DIR', help='Reuse and save featurized graphs in this graph store')
+    parser.add_argument('--feature-store', metavar='DIR', help='Save the encoder feature vector to this feature store')
+    parser.add_argument('--cache', metavar='FILE', help='Reuse and save ddGs in this prediction cache (default: $GEOPPI_CACHE)')
+    args = parser.parse_args()
+    pdbfile, mutationinfo, if_info = args.pdbfile, args.mutation, args.partners
+    workdir = 'temp'
+    cutoff = 3
 
+    problems = validate_inputs(pdbfile, mutationinfo, if_info)
+    if problems:
+        for problem in problems:
+            print('Input error: {}'.format(problem))
+        sys.exit(1)
+    if args.dry_run:
+        print('Inputs OK: {} {} {}'.format(pdbfile, mutationinfo, if_info))
+        return
+
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    from prediction_cache import open_cache
+    cached = open_cache(args.cache, precision, cutoff, args.crop)
+    if cached is not None:
+        (ddg,) = cached.lookup([(pdbfile, mutationinfo, if_info)])
+        if ddg is not None:
+            print('Found in the prediction cache {}'.format(cached.cache.filename))
+            print_result(ddg)
+            return
+
+    store = None
+    if args.graph_store:
+        from graph_store import GraphStore
+        store = GraphStore(args.graph_store)
 
+    try:
+        A, E, A_m, E_m, flag = prepare_sample(pdbfile, mutationinfo, if_info, workdir, cutoff, args.crop, store)
+    except:
+        print('Data processing error: Please double check your inputs is correct! Such as the pdb file path, mutation information and binding partners. You might find more error details at {}/foldx.log'.format(workdir))
+
+    import torch
+    from models import GeoPPIpredict, GeoPPIpredictBatch
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model, forest, sorted_idx = load_models(precision=precision)
     model.to(device)
-    model.eval()
     A = A.to(device)
     E = E.to(device)
     A_m = A_m.to(device)
     E_m = E_m.to(device)
 
-    try:
-        with open(gbtfile, 'rb') as pickle_file:
-            forest = pickle.load(pickle_file)
-    except:
-        print('File reading error: Please redownload the file {} via the following command: \
-                wget https://media.githubusercontent.com/media/Liuxg16/largefiles/8167d5c365c92d08a81dffceff364f72d765805c/gbt-s4169.pkl -P trainedmodels/'.format(gbtfile))
+    if args.feature_store:
+        from feature_store import FeatureStore, encoder_id
+        (ddg,), features = GeoPPIpredictBatch([(A,E,A_m,E_m,flag)], model, forest, sorted_idx, return_features=True)
+        with FeatureStore(args.feature_store, encoder_id(precision=precision)) as store:
+            store.add(features[0], pdbfile, mutationinfo, if_info, flag, ddg)
+    else:
+        ddg = GeoPPIpredict(A,E,A_m,E_m, model, forest, sorted_idx,flag)
+    if cached is not None:
+        cached.add([(pdbfile, mutationinfo, if_info, ddg)])
+    print_result(ddg)
 
-    ddg = GeoPPIpredict(A,E,A_m,E_m, model, forest, sorted_idx,flag)
- 
+def print_result(ddg):
     print('='*40+'Results'+'='*40)
     if ddg<0:
         mutationeffects = 'destabilizing'
@@ -347,10 +618,5 @@ def main():
     else:
         print('The predicted binding affinity change (wildtype-mutant) is 0.0 kcal/mol.')
 
-
-    os.system('rm ./{}'.format(pdbfile))
-    os.system('rm ./individual_list.txt')
-
 if __name__ == "__main__":
     main()
- 
@@ -0,0 +1,89 @@
+"""
+Shared-memory handoff of featurized graphs between processes.
+
+pipeline.py featurizes in worker processes and scores in one inference
+process, so that the encoder and the GBT are loaded once. Returning the
+graph tensors from a worker pickles them through a pipe. Here the inference
+process instead owns a fixed pool of shared-memory slots: a worker is handed
+a free slot, writes A, E, A_m and E_m into it, and returns only their dtypes,
+shapes and offsets. The inference process wraps the slot in tensors without
+copying, and frees the slot once the batch has been scored.
+
+The number of slots bounds the graphs in flight. A pair of graphs larger than
+a slot is returned through the pipe as before.
+"""
+
+import queue
+from multiprocessing import shared_memory
+
+import numpy as np
+
+ALIGN = 64
+
+# segments attached by this (worker) process, by name
+_attached = {}
+
+
+class SharedGraphSlots(object):
+    """Fixed-size shared-memory slots, each holding the tensors of one sample"""
+    def __init__(self, nslots, slot_bytes):
+        self.nslots = nslots
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=nslots*slot_bytes)
+        self.name = self.shm.name
+        self.free = queue.Queue()
+        for slot in range(nslots):
+            self.free.put(slot)
+
+    def acquire(self):
+        """Block until a slot is free and return it"""
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def tensors(self, slot, layout):
+        """Zero-copy torch views of the tensors a worker wrote into slot"""
+        import torch
+        base = slot*self.slot_bytes
+        return [torch.from_numpy(np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf, offset=base + offset))
+                for dtype, shape, offset in layout]
+
+    def close(self):
+        """Free the segment; every tensor returned by tensors() must be gone by now"""
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(name):
+    """Map a segment created by SharedGraphSlots in another process"""
+    if name not in _attached:
+        # spawned workers share the creator's resource tracker, which unlinks the
+        # segment if the creator dies without closing it
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return _attached[name]
+
+
+def write_tensors(buf, base, capacity, tensors):
+    """Copy tensors into buf[base:base+capacity]; returns their layout, or None if they do not fit"""
+    layout, offset = [], 0
+    for tensor in tensors:
+        array = tensor.contiguous().numpy()
+        if offset + array.nbytes > capacity:
+            return None
+        np.ndarray(array.shape, dtype=array.dtype, buffer=buf, offset=base + offset)[...] = array
+        layout.append((array.dtype.str, array.shape, offset))
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    return layout
+
+
+def put_shared(name, slot, slot_bytes, tensors):
+    """
+    Worker side: write tensors into slot of segment name.
+    Returns ('shared', layout), or ('pickled', tensors) when they do not fit.
+    """
+    shm = attach(name)
+    layout = write_tensors(shm.buf, slot*slot_bytes, slot_bytes, tensors)
+    if layout is None:
+        return 'pickled', tensors
+    return 'shared', layout
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Retrain the GBT head and its feature ranking on a benchmark set.
+
+trainedmodels/gbt-s4169.pkl and sortidx.npy were shipped without the code
+that produced them. This script rebuilds both from a benchmark CSV:
+
+    1. featurize   every single mutation runs through pipeline.py (FoldX,
+                   featurization and the encoder in parallel). The 18x256
+                   vectors go to a feature store (feature_store.py) and the
+                   graphs to a graph store (graph_store.py), so a rerun only
+                   computes what is missing, and a rerun after changing the
+                   encoder only repeats the encoder.
+    2. rank        a random forest on all 4608 features, on --n-jobs cores;
+                   features sorted by decreasing importance give sortidx.npy
+    3. fit         a grid search over GradientBoostingRegressor settings on
+                   the top --n-select (240) features with k-fold cross-validation, on
+                   --n-jobs cores, then a refit of the best setting on all rows
+    4. evaluate    k-fold predictions of the best setting, ranking the
+                   features again on each training fold so that the held-out
+                   rows take no part in the selection
+
+The artifacts go to trainedmodels/<version>/: gbt.pkl, its fastgbt.py export
+gbt.npz, sortidx.npy, and metrics.json (cross-validated Pearson r and RMSE,
+parameters, dataset hash, encoder_id and library versions). To use them, copy
+gbt.pkl, gbt.npz and sortidx.npy over trainedmodels/gbt-s4169.pkl,
+trainedmodels/gbt-s4169.npz and trainedmodels/sortidx.npy.
+
+Labels are the DDG column as is: S4169 uses the same sign convention as the
+predictions (negative values destabilize binding). Use --negate-labels for a
+set with the opposite convention.
+
+Usage:
+    python train_gbt.py --pdb-dir PDBS [--dataset data/benchmarkDatasets/S4169.csv] [--version NAME]
+                        [--n-jobs N] [--folds 10] [--group-by-pdb] [--grid '{"max_depth": [4, 6]}']
+                        [--feature-store train_features] [--graph-store train_graphs]
+                        [--foldx-workers N] [--feature-workers N] [--crop SHELL]
+
+    # run from the GeoPPI directory; featurizing needs FoldX, PyMOL and the benchmark structures
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# GradientBoostingRegressor settings searched by default; --grid replaces entries
+DEFAULT_GRID = {
+    'n_estimators': [1000, 3000],
+    'learning_rate': [0.01, 0.03],
+    'max_depth': [5, 7],
+    'subsample': [0.8],
+    'max_features': ['sqrt'],
+}
+
+
+def pearson(x, y):
+    return float(np.corrcoef(x, y)[0, 1])
+
+
+def rmse(x, y):
+    return float(np.sqrt(np.mean((np.asarray(x) - np.asarray(y))**2)))
+
+
+def featurize(entries, store_dir, encoder, args):
+    """Compute the vectors of entries missing from the feature store; returns (features, labels, pdbs) per entry"""
+    from feature_store import FeatureStore, load_features
+    from pipeline import Job, print_report, run_pipeline
+    from run import load_models
+
+    table = load_features(store_dir, encoder)
+    stored = set() if table is None else set(zip(table.pdb, table.mutation, table.partners))
+    todo, queued = [], set()
+    for entry in entries:
+        key = (entry.pdbfile, entry.mutations[0], entry.partners)
+        if key not in stored and key not in queued:
+            queued.add(key)
+            todo.append(Job(len(todo), entry.pdbfile, entry.mutations[0], entry.partners, entry.ddg))
+    print('{} of {} mutations already featurized in {}'.format(len(entries) - len(todo), len(entries), store_dir))
+
+    if todo:
+        model, _, _ = load_models(precision=args.precision, regressor=False)
+        with FeatureStore(store_dir, encoder) as features:
+            results, wall, stats = run_pipeline(todo, model, None, None, args.foldx_workers, args.feature_workers,
+                                                args.batch_size, crop=args.crop, graph_store=args.graph_store,
+                                                features=features, scratch=args.scratch, verbose=False)
+        print_report(results, wall, stats)
+        for job in results:
+            if job.error is not None:
+                print('  {} {}: {}'.format(job.pdbfile, job.mutation, job.error))
+        table = load_features(store_dir, encoder)
+    if table is None:
+        return None
+
+    rows = dict((key, i) for i, key in enumerate(zip(table.pdb, table.mutation, table.partners)))
+    found = [(rows[key], entry) for entry in entries
+             for key in [(entry.pdbfile, entry.mutations[0], entry.partners)] if key in rows]
+    print('{} of {} mutations have a feature vector'.format(len(found), len(entries)))
+    if not found:
+        return None
+    index = np.array([i for i, _ in found])
+    return (table.features[index], np.array([entry.ddg for _, entry in found]),
+            np.array([entry.pdb for _, entry in found]))
+
+
+def rank_features(X, y, n_trees, n_jobs, seed):
+    """Feature indices by decreasing random forest importance (the order of sortidx.npy)"""
+    from sklearn.ensemble import RandomForestRegressor
+    forest = RandomForestRegressor(n_estimators=n_trees, max_features='sqrt', n_jobs=n_jobs, random_state=seed)
+    forest.fit(X, y)
+    # stable sort, so that ties (e.g. constant features) keep their column order
+    return np.argsort(-forest.feature_importances_, kind='stable')
+
+
+def folds_of(groups, folds, seed):
+    from sklearn.model_selection import GroupKFold, KFold
+    if groups is None:
+        return KFold(folds, shuffle=True, random_state=seed)
+    return GroupKFold(folds)
+
+
+def fit_regressor(X, y, groups, grid, folds, n_jobs, seed):
+    """Grid search with cross-validation; returns the refitted best GBT and its parameters"""
+    from sklearn.ensemble import GradientBoostingRegressor
+    from sklearn.model_selection import GridSearchCV
+
+    search = GridSearchCV(GradientBoostingRegressor(random_state=seed), grid, cv=folds_of(groups, folds, seed),
+                          scoring='neg_root_mean_squared_error', n_jobs=n_jobs, refit=True)
+    search.fit(X, y, groups=groups)
+    return search.best_estimator_, search.best_params_
+
+
+def _predict_fold(X, y, train, test, params, n_select, n_trees, n_jobs, seed):
+    from sklearn.ensemble import GradientBoostingRegressor
+    selected = rank_features(X[train], y[train], n_trees, n_jobs, seed)[:n_select]
+    gbt = GradientBoostingRegressor(random_state=seed, **params).fit(X[train][:, selected], y[train])
+    return test, gbt.predict(X[test][:, selected])
+
+
+def cv_predict(X, y, groups, params, n_select, n_trees, folds, n_jobs, seed):
+    """Held-out predictions of every row, with the features ranked on each training fold alone"""
+    from joblib import Parallel, delayed
+    splits = list(folds_of(groups, folds, seed).split(X, y, groups))
+    workers = min(n_jobs, len(splits))
+    predicted = np.empty(len(y))
+    for test, values in Parallel(n_jobs=workers)(
+            delayed(_predict_fold)(X, y, train, test, params, n_select, n_trees, max(1, n_jobs // workers), seed)
+            for train, test in splits):
+        predicted[test] = values
+    return predicted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Retrain the GBT head and sortidx.npy on a benchmark set')
+    parser.add_argument('--dataset', default='data/benchmarkDatasets/S4169.csv')
+    parser.add_argument('--pdb-dir', required=True, help='Directory with the benchmark structures ({pdb}.pdb)')
+    parser.add_argument('--version', help='Artifact directory under trainedmodels (default: [dataset]-[date])')
+    parser.add_argument('--n-jobs', type=int, default=os.cpu_count(), help='Cores for ranking and cross-validation')
+    parser.add_argument('--folds', type=int, default=10)
+    parser.add_argument('--group-by-pdb', action='store_true', help='Keep the mutations of a structure in one fold')
+    parser.add_argument('--grid', help='JSON object of GradientBoostingRegressor parameter lists, merged into the default grid')
+    parser.add_argument('--n-select', type=int, default=240,
+                        help='Top-ranked features given to the GBT (predictions read it from the GBT\'s feature count)')
+    parser.add_argument('--ranking-trees', type=int, default=500)
+    parser.add_argument('--negate-labels', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--feature-store', default='train_features', metavar='DIR')
+    parser.add_argument('--graph-store', default='train_graphs', metavar='DIR')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--crop', type=float, metavar='SHELL')
+    parser.add_argument('--scratch', default='train_tmp')
+    args = parser.parse_args()
+    args.precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+
+    import sklearn
+    from datasets import read_benchmark
+    from fastgbt import ArrayForest, check_equivalence
+    from feature_store import encoder_id
+    from keys import file_sha256
+
+    name = os.path.splitext(os.path.basename(args.dataset))[0].lower()
+    version = args.version or '{}-{}'.format(name, time.strftime('%Y%m%d-%H%M'))
+    outdir = os.path.join('trainedmodels', version)
+    if os.path.exists(outdir):
+        print('Error: {} already exists; choose another --version'.format(outdir))
+        sys.exit(1)
+    grid = dict(DEFAULT_GRID, **json.loads(args.grid)) if args.grid else DEFAULT_GRID
+
+    entries = [x for x in read_benchmark(args.dataset, args.pdb_dir) if x.pdbfile is not None and x.ddg is not None]
+    if not entries:
+        print('Error: no structures of {} found in {}'.format(args.dataset, args.pdb_dir))
+        sys.exit(1)
+    encoder = encoder_id(precision=args.precision)
+    timings = {}
+
+    start = time.time()
+    data = featurize(entries, args.feature_store, encoder, args)
+    timings['featurize'] = time.time() - start
+    if data is None:
+        print('Error: no mutation could be featurized')
+        sys.exit(1)
+    X, y, pdbs = data
+    if args.negate_labels:
+        y = -y
+    if args.group_by_pdb and len(set(pdbs)) < args.folds:
+        print('Error: {} structures cannot be split into {} folds'.format(len(set(pdbs)), args.folds))
+        sys.exit(1)
+
+    start = time.time()
+    sorted_idx = rank_features(X, y, args.ranking_trees, args.n_jobs, args.seed)
+    timings['rank'] = time.time() - start
+    selected = X[:, sorted_idx[:args.n_select]]
+    print('Ranked {} features in {:.0f} s'.format(X.shape[1], timings['rank']))
+
+    groups = pdbs if args.group_by_pdb else None
+    start = time.time()
+    forest, params = fit_regressor(selected, y, groups, grid, args.folds, args.n_jobs, args.seed)
+    timings['fit'] = time.time() - start
+
+    # the ranking above saw every row, so the estimate ranks again within each fold
+    start = time.time()
+    predicted = cv_predict(X, y, groups, params, args.n_select, args.ranking_trees, args.folds, args.n_jobs, args.seed)
+    timings['cv'] = time.time() - start
+    # the same clipping as GeoPPIregress
+    predicted = np.clip(np.round(predicted, 2), -8.0, 8.0)
+    metrics = {'pearson': pearson(predicted, y), 'rmse': rmse(predicted, y)}
+    print('Best parameters {} ({:.0f} s): {}-fold CV Pearson r {:.3f}, RMSE {:.3f} kcal/mol ({:.0f} s)'.format(
+        params, timings['fit'], args.folds, metrics['pearson'], metrics['rmse'], timings['cv']))
+
+    os.makedirs(outdir)
+    import pickle
+    with open(os.path.join(outdir, 'gbt.pkl'), 'wb') as f:
+        pickle.dump(forest, f)
+    arrays = ArrayForest.from_sklearn(forest)
+    if check_equivalence(forest, arrays) == 0.0:
+        arrays.save(os.path.join(outdir, 'gbt.npz'))
+    else:
+        print('Warning: the fastgbt.py export differs from the GBT; gbt.npz not written')
+    np.save(os.path.join(outdir, 'sortidx.npy'), sorted_idx)
+    with open(os.path.join(outdir, 'metrics.json'), 'w') as f:
+        json.dump({
+            'version': version,
+            'dataset': args.dataset,
+            'dataset_sha256': file_sha256(args.dataset),
+            'encoder': encoder,
+            'mutations': len(y),
+            'structures': len(set(pdbs)),
+            'negate_labels': args.negate_labels,
+            'n_select': args.n_select,
+            'ranking': {'method': 'random forest importance', 'trees': args.ranking_trees},
+            'cv': dict(metrics, folds=args.folds, grouped_by_pdb=args.group_by_pdb,
+                       note='features ranked on each training fold; GBT parameters chosen by a grid search on all rows'),
+            'grid': grid,
+            'params': params,
+            'seconds': timings,
+            'versions': {'numpy': np.__version__, 'sklearn': sklearn.__version__, 'python': sys.version.split()[0]},
+        }, f, indent=1)
+    print('Artifacts written to {}'.format(outdir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Two-tier screening: in-graph substitution triage before full FoldX builds.
+
+Saturation mutagenesis builds a FoldX mutant and a mutant graph for each of
+the 19 substitutions at a position. The triage tier skips both: it builds
+only the wildtype model of each position (which the full path needs anyway)
+and its graph, and derives every mutant graph from it by changing the residue
+one-hot of the mutation-site atoms. With --trim, the site's side chain beyond
+CB (and CB itself for glycine) is removed first, so that the wildtype side
+chain does not stand in for the new one. All substitutions are scored through
+the encoder and GBT in batches.
+
+The triage ddGs only rank candidates. The top --top-k of each position (or
+those with |ddG| >= --threshold) then go through the full FoldX path of
+pipeline.py, which reuses the interfaces and wildtype models already built.
+benchmarks/triage_recall.py measures how many of the top mutations of full
+runs the triage ranking keeps.
+
+Usage:
+    python triage.py [pdb file] "[positions]" [partnerA_partnerB] [--top-k 5 | --threshold 1.0]
+                     [--rank-by magnitude|destabilizing|stabilizing] [--trim] [--triage-only]
+                     [pipeline.py options] [-o FILE]
+    python triage.py data/testExamples/1CZ8.pdb "KW84 HL112" WV_HL --top-k 3
+"""
+
+import argparse
+import multiprocessing
+import os
+import os.path as path
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from run import AA_CODES, AMINO_ACIDS, GRAPH_RESIDUES
+
+# columns of build_graph's atom features: element one-hot (4), residue one-hot, ..., mutation site
+RES_COLUMN = 4
+SITE_COLUMN = RES_COLUMN + len(GRAPH_RESIDUES) + 8
+THREE_LETTER = dict((code, name) for name, code in AA_CODES.items())
+TRIM_KEEP = ('N', 'CA', 'C', 'O', 'CB')
+
+
+def substitute(A, mutname):
+    """A copy of the atom features with the residue one-hot of the mutation-site atoms set to mutname"""
+    A_m = A.clone()
+    site = A_m[:, SITE_COLUMN] == 1
+    A_m[site, RES_COLUMN:RES_COLUMN + len(GRAPH_RESIDUES)] = 0
+    A_m[site, RES_COLUMN + GRAPH_RESIDUES.index(THREE_LETTER[mutname])] = 1
+    return A_m
+
+
+def trim_side_chain(modelfile, outfile, chainid, resid, keep=TRIM_KEEP):
+    """Write modelfile without the atoms of residue chainid resid not named in keep"""
+    with open(modelfile) as f:
+        lines = f.read().splitlines()
+    with open(outfile, 'w') as f:
+        for line in lines:
+            if line[0:4] == 'ATOM' and line[21] == chainid and line[22:28].strip() == resid \
+                    and line[12:16].strip() not in keep:
+                continue
+            f.write(line + '\n')
+
+
+def position_graphs(wildtypefile, interfacefile, chainid, resid, partners, trim, glycine, cutoff=3):
+    """
+    The wildtype graph of a position and the graph its mutants are derived from (the
+    wildtype, or the trimmed wildtype), plus the trimmed graph without CB if glycine.
+    Returns [A, E], [A_stub, E_stub], [A_gly, E_gly] or None; runs in a worker process.
+    """
+    from run import gen_graph_data
+    mutinfo = ['{}_{}'.format(chainid, resid)]
+    wildtype = gen_graph_data(wildtypefile, mutinfo, interfacefile, cutoff, partners)
+    if wildtype is None:
+        raise ValueError('fewer than 5 atoms near the interface')
+    stubs = [wildtype, None]
+    if trim:
+        for i, keep in enumerate([TRIM_KEEP, TRIM_KEEP[:-1]] if glycine else [TRIM_KEEP]):
+            stubfile = '{}.trim{}.pdb'.format(wildtypefile.rsplit('.', 1)[0], i)
+            trim_side_chain(wildtypefile, stubfile, chainid, resid, keep)
+            stubs[i] = gen_graph_data(stubfile, mutinfo, interfacefile, cutoff, partners)
+    return [x if x is None else x[:2] for x in [wildtype] + stubs]
+
+
+def triage(positions, model, forest, sorted_idx, builder, foldx_workers=4, feature_workers=2, trim=False,
+           batch_size=64, mutnames=AMINO_ACIDS):
+    """
+    Triage ddGs of every substitution at positions, a list of (pdbfile, partners, position
+    such as KW84). Returns a list of (pdbfile, mutation, partners, ddG or None, error).
+    """
+    from models import FeaturePlan, n_selected, GeoPPIpredictBatch
+    from pipeline import _init_feature_worker
+    pool = ProcessPoolExecutor(feature_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_feature_worker)
+
+    def build(position):
+        pdbfile, partners, site = position
+        wildname, chainid, resid = site[0], site[1], site[2:]
+        structdir, _, _, wildtypefile = builder.position(pdbfile, partners, wildname, chainid, resid)
+        return pool.submit(position_graphs, wildtypefile, path.join(structdir, 'interface.txt'), chainid, resid, partners,
+                           trim, 'G' in mutnames and wildname != 'G').result()
+
+    plan = FeaturePlan(sorted_idx, n_selected(forest))
+    rows, pending = [], []
+    def flush():
+        if pending:
+            ddgs = GeoPPIpredictBatch([sample for _, sample in pending], model, forest, sorted_idx, plan)
+            for (row, _), ddg in zip(pending, ddgs):
+                rows[row][3] = ddg
+            del pending[:]
+
+    with ThreadPoolExecutor(foldx_workers) as threads:
+        futures = [threads.submit(build, position) for position in positions]
+        for (pdbfile, partners, site), future in zip(positions, futures):
+            wildname = site[0]
+            mutations = [site + mutname for mutname in mutnames if mutname != wildname]
+            try:
+                wildtype, stub, glycine = future.result()
+            except Exception as e:
+                rows += [[pdbfile, mutation, partners, None, 'triage: {}'.format(e)] for mutation in mutations]
+                continue
+            for mutation in mutations:
+                mutname = mutation[-1]
+                A_stub, E_stub = glycine if mutname == 'G' and glycine is not None else stub or wildtype
+                rows.append([pdbfile, mutation, partners, None, None])
+                pending.append((len(rows) - 1, (wildtype[0], wildtype[1], substitute(A_stub, mutname), E_stub, False)))
+                if len(pending) >= batch_size:
+                    flush()
+    flush()
+    pool.shutdown()
+    return [tuple(row) for row in rows]
+
+
+def select(rows, top_k=None, threshold=None, rank_by='magnitude'):
+    """The triaged mutations worth a full build: the top_k of each position, or those past threshold"""
+    key = {'magnitude': abs, 'destabilizing': lambda ddg: -ddg, 'stabilizing': lambda ddg: ddg}[rank_by]
+    by_position = {}
+    for row in rows:
+        if row[3] is not None:
+            by_position.setdefault((row[0], row[2], row[1][:-1]), []).append(row)
+    selected = []
+    for candidates in by_position.values():
+        candidates.sort(key=lambda row: key(row[3]), reverse=True)
+        if top_k is not None:
+            candidates = candidates[:top_k]
+        if threshold is not None:
+            candidates = [row for row in candidates if key(row[3]) >= threshold]
+        selected += candidates
+    return selected
+
+
+def main():
+    import csv
+    from pipeline import Job, StructureBuilder, print_report, run_pipeline
+    from run import load_models, validate_inputs
+
+    parser = argparse.ArgumentParser(description='Triage substitutions in the graph, then build the best with FoldX')
+    parser.add_argument('pdbfile')
+    parser.add_argument('positions', help='Positions such as "KW84 HL112"')
+    parser.add_argument('partners', help='Binding partners, e.g. WV_HL')
+    parser.add_argument('--top-k', type=int, help='Full builds for the best K substitutions of each position')
+    parser.add_argument('--threshold', type=float, help='Full builds for substitutions ranked at least this high (kcal/mol)')
+    parser.add_argument('--rank-by', choices=['magnitude', 'destabilizing', 'stabilizing'], default='magnitude')
+    parser.add_argument('--trim', action='store_true', help='Remove the side chain beyond CB before substituting')
+    parser.add_argument('--triage-only', action='store_true', help='Skip the full builds')
+    parser.add_argument('--foldx-workers', type=int, default=4)
+    parser.add_argument('--feature-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--crop', type=float, metavar='SHELL')
+    parser.add_argument('--graph-store', metavar='DIR')
+    parser.add_argument('--cache', metavar='FILE', help='Prediction cache (default: $GEOPPI_CACHE)')
+    parser.add_argument('--scratch', default='triage_tmp')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+    if args.top_k is None and args.threshold is None and not args.triage_only:
+        parser.error('give --top-k, --threshold or --triage-only')
+
+    positions = args.positions.split()
+    for site in positions:
+        problems = validate_inputs(args.pdbfile, site + site[0], args.partners)
+        if problems:
+            parser.error('; '.join(problems))
+    output = args.output or path.basename(args.pdbfile).split('.')[0] + '_triage_ddg.csv'
+
+    from prediction_cache import open_cache
+    precision = os.environ.get('GEOPPI_PRECISION', 'fp32')
+    model, forest, sorted_idx = load_models(precision=precision)
+    cache = open_cache(args.cache, precision, crop=args.crop)
+    builder = StructureBuilder(args.scratch, args.crop)
+    start = time.time()
+    rows = triage([(args.pdbfile, args.partners, site) for site in positions], model, forest, sorted_idx, builder,
+                  args.foldx_workers, args.feature_workers, args.trim)
+    print('Triaged {} substitutions at {} positions in {:.1f} s'.format(len(rows), len(positions), time.time() - start))
+
+    full = {}
+    if not args.triage_only:
+        selected = select(rows, args.top_k, args.threshold, args.rank_by)
+        jobs = [Job(i, pdbfile, mutation, partners) for i, (pdbfile, mutation, partners, _, _) in enumerate(selected)]
+        results, wall, stats = run_pipeline(jobs, model, forest, sorted_idx, args.foldx_workers, args.feature_workers,
+                                            args.batch_size, crop=args.crop, graph_store=args.graph_store,
+                                            scratch=args.scratch, keep_builds=args.keep, keep_scratch=True,
+                                            builder=builder, cache=cache)
+        print_report(results, wall, stats)
+        if cache is not None:
+            print(cache.summary())
+        full = dict((job.mutation, job) for job in results)
+    if not args.keep:
+        shutil.rmtree(args.scratch, ignore_errors=True)
+
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pdb', 'mutation', 'partners', 'triage_ddg', 'ddg', 'error'])
+        for pdbfile, mutation, partners, triage_ddg, error in rows:
+            job = full.get(mutation)
+            ddg = '' if job is None else job.ddg if job.error is None else 'error'
+            error = error or (job.error if job is not None else None)
+            writer.writerow([pdbfile, mutation, partners, '' if triage_ddg is None else triage_ddg, ddg, error or ''])
+    print('Results written to {}'.format(output))
+
+if __name__ == "__main__":
+    main()
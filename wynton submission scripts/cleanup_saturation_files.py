@@ -30,6 +30,7 @@ def find_saturation_files():
         'Individual results': ['results/*_sat/*.csv', 'results/job_*_sat/*.csv'],
         'Combined results': ['*_sat_all_results.csv', 'job_*_sat_all_results.csv'],
         'Command files': ['*_batch_command.sh', '*_saturation_summary.txt'],
+        'Stage manifests': ['*_sat_stage_manifest.json', 'job_*_sat_stage_manifest.json'],
     }
     
     categorized_files = {}
@@ -5,8 +5,10 @@ Script to prepare SGE array job for batch saturation mutagenesis on Wynton.
 This script:
 1. Takes output from prepare_batch_saturation.py
 2. Creates a residue list file
-3. Generates an SGE array job submission script
-4. Generates a result combination script
+3. Writes a staging manifest of the GeoPPI runtime artifacts (see stage_geoppi.py)
+4. Estimates the memory of a task from the structure (see memory_budget.py)
+5. Generates an SGE array job submission script
+6. Generates a result combination script
 
 Usage:
     python prepare_sge_saturation.py <pdb_file> "<residue_list>" <partner_info> [job_name]
@@ -17,10 +19,48 @@ Example:
 
 import sys
 import os
+import math
 import textwrap
 
-def create_sge_script(pdb_file, residue_file, partner_info, job_name, num_residues):
-    """Generate the SGE array job submission script"""
+from stage_geoppi import write_manifest
+
+# GeoPPI checkout next to the submission scripts, staged into each task's scratch
+GEOPPI_DIR = "GeoPPI"
+# mem_free when the estimate is not available, and the margin of an estimated one
+DEFAULT_MEM = "4G"
+MEM_MARGIN = 1.25
+# FoldX BuildModel and PyMOL run in the same task and are not part of the GeoPPI estimate
+FOLDX_MB = 1024
+
+def estimate_memory(pdb_file, residues, partner_info):
+    """
+    mem_free in MB for the tasks: the largest estimated peak of a prediction at any of
+    the residues plus FOLDX_MB, with a margin, and never below FOLDX_MB plus the GeoPPI
+    process with its models loaded (memory_budget.base_mb);
+    (None, None) when GeoPPI's memory_budget.py cannot be used
+    """
+    sys.path.insert(0, GEOPPI_DIR)
+    try:
+        from memory_budget import base_mb, estimate_structure
+        # the graph does not depend on the mutant residue, so one mutation per position
+        mutations = [res + ('G' if res[0] == 'A' else 'A') for res in residues]
+        models = os.path.join(GEOPPI_DIR, 'trainedmodels')
+        estimates = estimate_structure(pdb_file, mutations, partner_info, models=models)
+        min_mb = FOLDX_MB + base_mb(models)
+    except Exception as e:
+        print(f"Warning: could not estimate the memory of a task ({e}); requesting {DEFAULT_MEM}")
+        return None, None
+    finally:
+        sys.path.remove(GEOPPI_DIR)
+    largest = max(estimates, key=lambda x: x['peak'])
+    mem_mb = int(math.ceil(MEM_MARGIN * max(largest['peak'] + FOLDX_MB, min_mb) / 256.0)) * 256
+    return mem_mb, largest
+
+def create_sge_script(pdb_file, residue_file, partner_info, job_name, num_residues, manifest_file, mem_mb=None):
+    """Generate the SGE array job submission script; mem_mb is the memory of a task (default: DEFAULT_MEM)"""
+    mem_free = f"{mem_mb}M" if mem_mb else DEFAULT_MEM
+    # with a known request, GeoPPI splits the graph stages that would exceed it instead of being killed
+    budget = f"export GEOPPI_MEMORY_MB={mem_mb}" if mem_mb else "# no memory estimate: GEOPPI_MEMORY_MB is not set"
     
     script_content = textwrap.dedent(f"""#!/bin/bash
 #$ -S /bin/bash
@@ -28,7 +68,7 @@ def create_sge_script(pdb_file, residue_file, partner_info, job_name, num_residu
 #$ -N {job_name}
 #$ -t 1-{num_residues}
 #$ -l h_rt=01:00:00
-#$ -l mem_free=4G
+#$ -l mem_free={mem_free}
 #$ -j y
 
 # Create logs directory if it doesn't exist
@@ -54,6 +94,7 @@ conda activate geoppi_clean
 
 # Disable user site-packages
 export PYTHONNOUSERSITE=1
+{budget}
 
 # Get the residue for this array task
 RESIDUE=$(sed -n "${{SGE_TASK_ID}}p" {residue_file})
@@ -67,9 +108,15 @@ SCRATCH_DIR="/scratch/${{USER}}_${{JOB_ID}}_${{SGE_TASK_ID}}"
 echo "Using scratch directory: $SCRATCH_DIR"
 mkdir -p $SCRATCH_DIR
 
-# Copy necessary files to scratch
-echo "Copying files to scratch..."
-cp -r GeoPPI $SCRATCH_DIR/
+# Stage GeoPPI through the node-local artifact cache (filled once per node)
+echo "Staging GeoPPI into scratch..."
+if ! python3 stage_geoppi.py stage {manifest_file} $SCRATCH_DIR/{GEOPPI_DIR}; then
+    echo "WARNING: Staging failed, falling back to a full copy"
+    rm -rf $SCRATCH_DIR/{GEOPPI_DIR}
+    cp -r {GEOPPI_DIR} $SCRATCH_DIR/
+fi
+
+# Copy task inputs to scratch
 cp {pdb_file} $SCRATCH_DIR/
 cp single_residue_saturation.py $SCRATCH_DIR/
 
@@ -245,10 +292,22 @@ def main():
         for res in residues:
             f.write(f"{res}\n")
     
+    # Hash the GeoPPI runtime artifacts for node-local staging
+    manifest_file = f"{job_name}_stage_manifest.json"
+    if os.path.isdir(GEOPPI_DIR):
+        manifest = write_manifest(GEOPPI_DIR, manifest_file)
+        staged_mb = sum(entry['size'] for entry in manifest['files']) / 1e6
+    else:
+        print(f"Warning: {GEOPPI_DIR}/ not found; tasks will fall back to copying it in full")
+        staged_mb = None
+    
+    # Size the memory request from the largest graph of the residues
+    mem_mb, largest = estimate_memory(pdb_file, residues, partner_info)
+    
     # Create SGE submission script
     sge_script = f"submit_{job_name}.sh"
     with open(sge_script, 'w') as f:
-        f.write(create_sge_script(pdb_file, residue_file, partner_info, job_name, num_residues))
+        f.write(create_sge_script(pdb_file, residue_file, partner_info, job_name, num_residues, manifest_file, mem_mb))
     os.chmod(sge_script, 0o755)
     
     # Create combination script
@@ -272,8 +331,15 @@ def main():
     print(f"Number of residues: {num_residues}")
     print(f"Number of mutations per residue: 19")
     print(f"Total mutations to calculate: {num_residues * 19}")
+    if mem_mb:
+        print(f"Memory per task: {mem_mb}M (estimated peak {largest['peak']:.0f} MB at {largest['mutation'][:-1]}, "
+              f"{largest['nodes']} graph atoms)")
+    else:
+        print(f"Memory per task: {DEFAULT_MEM}")
     print(f"\nGenerated files:")
     print(f"  - {residue_file} (list of residues)")
+    if staged_mb is not None:
+        print(f"  - {manifest_file} (staging manifest, {staged_mb:.1f} MB of artifacts)")
     print(f"  - {sge_script} (SGE submission script)")
     print(f"  - {combine_script} (result combination script)")
     print(f"  - {status_script} (job status check script)")
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Stage GeoPPI code and model artifacts into a node-local, content-hashed cache.
+
+Copying the whole GeoPPI checkout into every array task's scratch directory
+re-reads the trained models, the FoldX binary and rotabase.txt from the shared
+filesystem once per task. Staging splits this into two steps:
+
+1. At preparation time the artifacts GeoPPI needs at runtime are hashed into a
+   manifest (prepare_sge_saturation.py does this automatically).
+2. At task start the manifest hash selects a directory in a node-local cache.
+   The first task on a node fills it under a file lock; every task then
+   hardlinks the cached files into its own scratch directory.
+
+Task startup I/O against the shared filesystem is therefore paid once per node
+instead of once per task.
+
+Usage:
+    # Hash the runtime artifacts of a GeoPPI checkout
+    python stage_geoppi.py manifest GeoPPI job_sat_stage_manifest.json
+
+    # Populate the node cache (if needed) and link GeoPPI into scratch
+    python stage_geoppi.py stage job_sat_stage_manifest.json $SCRATCH_DIR/GeoPPI
+
+The cache root defaults to /scratch/$USER/geoppi_cache and can be changed with
+--cache-root or the GEOPPI_STAGE_CACHE environment variable.
+"""
+
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+# Files (relative to the GeoPPI checkout) needed to run run.py
+STAGED_PATTERNS = ['*.py', 'foldx', 'rotabase.txt', 'trainedmodels/*']
+
+CHUNK_SIZE = 1 << 20
+
+
+def default_cache_root():
+    """Return the node-local cache root"""
+    if os.environ.get('GEOPPI_STAGE_CACHE'):
+        return os.environ['GEOPPI_STAGE_CACHE']
+    return os.path.join('/scratch', os.environ.get('USER', 'geoppi'), 'geoppi_cache')
+
+
+def hash_file(path):
+    """Return the SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(geoppi_dir):
+    """Hash the runtime artifacts of a GeoPPI checkout"""
+    root = os.path.abspath(geoppi_dir)
+    paths = set()
+    for pattern in STAGED_PATTERNS:
+        for path in glob.glob(os.path.join(root, pattern)):
+            if os.path.isfile(path):
+                paths.add(os.path.relpath(path, root))
+
+    files = []
+    for rel in sorted(paths):
+        full = os.path.join(root, rel)
+        files.append({
+            'path': rel,
+            'size': os.path.getsize(full),
+            'mode': os.stat(full).st_mode & 0o777,
+            'sha256': hash_file(full),
+        })
+
+    key = hashlib.sha256()
+    for entry in files:
+        key.update('{} {}\n'.format(entry['path'], entry['sha256']).encode())
+
+    return {'source': root, 'key': key.hexdigest(), 'files': files}
+
+
+def write_manifest(geoppi_dir, manifest_file):
+    """Build a manifest for geoppi_dir and save it as JSON"""
+    manifest = build_manifest(geoppi_dir)
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def copy_and_hash(src, dst):
+    """Copy src to dst in one pass and return the SHA-256 of the copied bytes"""
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            fout.write(chunk)
+    return digest.hexdigest()
+
+
+def populate_cache(manifest, entry_dir):
+    """Copy the manifest files from the shared filesystem into entry_dir"""
+    tmp_dir = '{}.tmp.{}'.format(entry_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        for entry in manifest['files']:
+            src = os.path.join(manifest['source'], entry['path'])
+            dst = os.path.join(tmp_dir, entry['path'])
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if copy_and_hash(src, dst) != entry['sha256']:
+                raise ValueError(f"{src} changed since the manifest was written; "
+                                 "rerun prepare_sge_saturation.py")
+            # Cached files are shared by hardlinks, so never let a task write to them
+            os.chmod(dst, entry['mode'] & 0o555)
+        os.rename(tmp_dir, entry_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def ensure_cached(manifest, cache_root):
+    """Return the cache directory for manifest, filling it once per node"""
+    entry_dir = os.path.join(cache_root, manifest['key'])
+    if os.path.isdir(entry_dir):
+        return entry_dir, False
+
+    os.makedirs(cache_root, exist_ok=True)
+    with open(entry_dir + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Another task on this node may have filled the cache while we waited
+            if os.path.isdir(entry_dir):
+                return entry_dir, False
+            populate_cache(manifest, entry_dir)
+            return entry_dir, True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def link_tree(manifest, entry_dir, dest):
+    """Hardlink every cached file into dest, falling back to symlinks"""
+    linked = symlinked = 0
+    for entry in manifest['files']:
+        src = os.path.join(entry_dir, entry['path'])
+        dst = os.path.join(dest, entry['path'])
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+            linked += 1
+        except OSError:
+            # e.g. scratch and cache live on different filesystems
+            os.symlink(src, dst)
+            symlinked += 1
+    return linked, symlinked
+
+
+def stage(manifest_file, dest, cache_root=None):
+    """Stage the artifacts listed in manifest_file into dest"""
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    cache_root = cache_root or default_cache_root()
+
+    entry_dir, filled = ensure_cached(manifest, cache_root)
+    linked, symlinked = link_tree(manifest, entry_dir, dest)
+
+    total = sum(entry['size'] for entry in manifest['files'])
+    print(f"Cache entry: {entry_dir} ({'filled by this task' if filled else 'hit'})")
+    print(f"Staged {len(manifest['files'])} files ({total / 1e6:.1f} MB) into {dest}: "
+          f"{linked} hardlinks, {symlinked} symlinks")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stage GeoPPI artifacts through a node-local cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    manifest_parser = subparsers.add_parser('manifest', help='Hash the runtime artifacts of a GeoPPI checkout')
+    manifest_parser.add_argument('geoppi_dir', help='GeoPPI checkout on the shared filesystem')
+    manifest_parser.add_argument('manifest_file', help='Output manifest (JSON)')
+
+    stage_parser = subparsers.add_parser('stage', help='Link GeoPPI into a scratch directory via the node cache')
+    stage_parser.add_argument('manifest_file', help='Manifest written by the manifest command')
+    stage_parser.add_argument('dest', help='Destination directory (e.g. $SCRATCH_DIR/GeoPPI)')
+    stage_parser.add_argument('--cache-root', help='Node-local cache root (default: /scratch/$USER/geoppi_cache)')
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'manifest':
+            manifest = write_manifest(args.geoppi_dir, args.manifest_file)
+            print(f"Wrote {args.manifest_file}: {len(manifest['files'])} files, key {manifest['key'][:12]}")
+        else:
+            stage(args.manifest_file, args.dest, args.cache_root)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()